@@ -1,34 +1,130 @@
+import collections
+import random
+import threading
 import time
 
 
 class Injector:
-    ''' Generic Injector class
+    ''' Generic Injector class. Whoever acts on the injector acks it by setting ack to True,
+        which wakes up anyone waiting on it right away
     '''
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
-        self.ack = False
+        self.acked = threading.Event()
+
+    @property
+    def ack(self):
+        return self.acked.is_set()
+
+    @ack.setter
+    def ack(self, value):
+        if value:
+            self.acked.set()
+        else:
+            self.acked.clear()
 
     def wait(self, timeout_s=1):
         # Wait for an ack on this injector
-        for i in range(int(timeout_s * 1000)):
-            if self.ack:
-                break
-            time.sleep(timeout_s / 1000)
-        else:
-            assert False, '{} never acked'.format(self.__class__.__name__)
+        assert self.acked.wait(timeout_s), '{} never acked'.format(self.__class__.__name__)
+
+
+def wait_all(injectors, timeout_s=1):
+    ''' Waits for all injectors to be acked, timeout_s is for all of them together
+    '''
+    end_time = time.monotonic() + timeout_s
+    for injector in injectors:
+        injector.wait(max(0, end_time - time.monotonic()))
+
+
+class InjectionRule(Injector):
+    ''' Injector that stays registered and acts on every IO command it triggers on,
+        instead of only once.
+
+        A command matches the rule if its opcode is opc, and its NSID is nsid and its
+        SLBA is in lba_range ([start, end)) when they are given. A matching command
+        triggers the rule with probability (0 to 1), or once every every matches, or
+        always if neither is given. The command then fails with status code sc, or if
+        sc is None completes delay_us later than it would have.
+
+        The rule is acked the first time it triggers
+    '''
+    def __init__(self, opc, nsid=None, lba_range=None, probability=None, every=None, sc=None,
+                 delay_us=0, seed=None):
+        super().__init__(opc=opc, nsid=nsid, lba_range=lba_range, probability=probability,
+                         every=every, sc=sc, delay_us=delay_us)
+        assert probability is None or every is None, 'Use either probability or every'
+        assert (sc is None) != (delay_us == 0), 'Use either sc or delay_us'
+        self.opc = opc
+        self.nsid = nsid
+        self.lba_range = lba_range
+        self.probability = probability
+        self.every = every
+        self.sc = sc
+        self.delay_us = delay_us
+
+        # Commands that matched the rule, and how many of them it triggered on. Commands
+        #  can be processed by more than one simulator thread at the same time
+        self.matched = 0
+        self.triggered = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def trigger(self, command):
+        ''' Returns True if command matches the rule and the rule triggers on it
+        '''
+        if self.nsid is not None and command.NSID != self.nsid:
+            return False
+
+        # SLBA is in DW10 and DW11 for all IO commands with one
+        if self.lba_range is not None:
+            slba = command.DW10 | (command.DW11 << 32)
+            if not self.lba_range[0] <= slba < self.lba_range[1]:
+                return False
+
+        with self.lock:
+            self.matched += 1
+            if self.every is not None:
+                triggered = self.matched % self.every == 0
+            elif self.probability is not None:
+                triggered = self.random.random() < self.probability
+            else:
+                triggered = True
+
+            if triggered:
+                self.triggered += 1
+                self.ack = True
+            return triggered
 
 
 class Injection:
     ''' Injection class which tracks all registered injectors
     '''
     def __init__(self):
-        self.injectors = []
+        # Injectors waiting to be picked up by get(), by class name in the order they were
+        #  registered. The simulator picks them up from its own thread, under lock
+        self.injectors = collections.defaultdict(collections.deque)
+        self.lock = threading.Lock()
+
+        # InjectionRules, by the opcode they match
+        self.rules = {}
 
     def register(self, injector):
         assert issubclass(type(injector), Injector), (
             'Injectors must be a subclass of Injector')
-        self.injectors.append(injector)
+        if isinstance(injector, InjectionRule):
+            self.rules.setdefault(injector.opc, []).append(injector)
+        else:
+            with self.lock:
+                self.injectors[injector.__class__.__name__].append(injector)
+
+    def unregister(self, rule):
+        ''' Removes an InjectionRule, other injectors are removed when they are picked up
+        '''
+        rules = self.rules[rule.opc]
+        rules.remove(rule)
+        if len(rules) == 0:
+            del self.rules[rule.opc]
 
     def get(self, injector_type):
         ''' When a caller calls get on an Injection object, injectors
@@ -38,11 +134,27 @@ class Injection:
             convinient to identify injectors without having them defined everywhere
         '''
         assert type(injector_type) is str, "injector_type must be a string"
-        injectors = [i for i in self.injectors if i.__class__.__name__ == injector_type]
-        if len(injectors) == 0:
-            # Not found, return None
-            return None
-        else:
-            injector = injectors[0]
-            self.injectors.remove(injector)
+        with self.lock:
+            injectors = self.injectors.get(injector_type)
+            if not injectors:
+                # Not found, return None
+                return None
+
+            # Types with no injectors left are dropped, so no injectors is an empty dictionary
+            injector = injectors.popleft()
+            if len(injectors) == 0:
+                del self.injectors[injector_type]
             return injector
+
+    def match(self, command):
+        ''' Returns the first InjectionRule registered for command's opcode that triggers on
+            it, None if none does. Opcodes without rules only cost a dictionary lookup
+        '''
+        rules = self.rules.get(command.OPC)
+        if rules is None:
+            return None
+
+        for rule in rules:
+            if rule.trigger(command):
+                return rule
+        return None
@@ -9,6 +9,7 @@ from lone.injection import Injection
 from lone.nvme.spec.queues import QueueMgr, NVMeSubmissionQueue, NVMeCompletionQueue
 from lone.nvme.spec.prp import PRP
 from lone.nvme.spec.structures import CQE
+from lone.nvme.spec.registers.msix import MSIXTable
 from lone.nvme.spec.commands.admin.identify import (IdentifyController,
                                                     IdentifyNamespace,
                                                     IdentifyNamespaceList,
@@ -17,7 +18,9 @@ from lone.nvme.spec.commands.admin.create_io_completion_q import CreateIOComplet
 from lone.nvme.spec.commands.admin.create_io_submission_q import CreateIOSubmissionQueue
 from lone.nvme.spec.commands.admin.delete_io_completion_q import DeleteIOCompletionQueue
 from lone.nvme.spec.commands.admin.delete_io_submission_q import DeleteIOSubmissionQueue
+from lone.nvme.spec.commands.admin.doorbell_buffer_config import DoorbellBufferConfig
 from lone.nvme.spec.commands.status_codes import status_codes, NVMeStatusCodeException
+from lone.util.trace import mmio_trace
 
 import logging
 logger = logging.getLogger('nvme_device')
@@ -73,6 +76,13 @@ class NVMeDeviceCommon:
         self.int_type = NVMeDeviceIntType.POLLING
         self.get_completions = self.poll_cq_completions
 
+        # MSI-X table, when set vectors are masked while their queues are being drained
+        self.msix_table = None
+
+        # Shadow doorbell and EventIdx buffers, only used after init_doorbell_buffer
+        self.dbbuf_shadow_mem = None
+        self.dbbuf_eventidx_mem = None
+
     def cc_disable(self, timeout_s=10):
         start_time = time.time()
         self.nvme_regs.CC.EN = 0
@@ -81,6 +91,7 @@ class NVMeDeviceCommon:
                 assert False, 'Device did not disable in {}s'.format(timeout_s)
             elif self.nvme_regs.CSTS.CFS == 1:
                 logger.error('Disabling while CFS=1, not watiting for RDY=1')
+                mmio_trace.dump_on_cfs()
                 break
             elif self.nvme_regs.CSTS.RDY == 0:
                 break
@@ -96,6 +107,11 @@ class NVMeDeviceCommon:
             self.free_and_unmap_iova(m)
         self.queue_mem = []
 
+        # The doorbell buffer config does not survive a disable, and its memory is
+        #  part of queue_mem so it was just freed above
+        self.dbbuf_shadow_mem = None
+        self.dbbuf_eventidx_mem = None
+
         # Reset queue manager since all queues are gone after a disable
         # TODO: Technically the user can keep the admin queues intact
         #  during a disable, so we should allow that here. For now, after a
@@ -194,6 +210,11 @@ class NVMeDeviceCommon:
         else:
             create_iocq_cmd.IV = 0
 
+        # A new queue starts with its doorbells at 0, make sure the shadow ones agree
+        if self.dbbuf_shadow_mem is not None:
+            ctypes.c_uint32.from_address(self.dbbuf_addresses(cq_id, completion=True)[0]).value = 0
+            ctypes.c_uint32.from_address(self.dbbuf_addresses(sq_id)[0]).value = 0
+
         # Send the command and wait for a completion
         self.sync_cmd(create_iocq_cmd)
 
@@ -232,6 +253,67 @@ class NVMeDeviceCommon:
                            cq_iv),
                            )
 
+        # Queues created after a Doorbell Buffer Config use the shadow doorbells
+        if self.dbbuf_shadow_mem is not None:
+            self.enable_shadow_doorbells(*self.queue_mgr.get(sq_id, cq_id))
+
+    def dbbuf_addresses(self, qid, completion=False):
+        ''' Returns the (shadow doorbell, EventIdx) addresses for a queue. Both buffers
+            use the same layout as the doorbell registers
+        '''
+        offset = (qid * 8) + (4 if completion else 0)
+        return (self.dbbuf_shadow_mem.vaddr + offset, self.dbbuf_eventidx_mem.vaddr + offset)
+
+    def enable_shadow_doorbells(self, sq, cq):
+        sq.tail.enable_shadow(*self.dbbuf_addresses(sq.qid))
+        cq.head.enable_shadow(*self.dbbuf_addresses(cq.qid, completion=True))
+
+    def init_doorbell_buffer(self):
+        ''' Sends a Doorbell Buffer Config command so that IO queue doorbell updates are
+            written to a shadow doorbell buffer in host memory, and only written to the
+            doorbell registers when the controller's EventIdx asks for it. The Admin
+            queue always uses the doorbell registers.
+        '''
+        assert self.dbbuf_shadow_mem is None, 'Doorbell buffer already configured'
+
+        # One memory page each, the controller reads the shadow doorbells and
+        #  writes the EventIdx values
+        self.dbbuf_shadow_mem = self.malloc_and_map_iova(self.mps,
+                                                         DMADirection.HOST_TO_DEVICE,
+                                                         client='dbbuf_shadow')
+        self.queue_mem.append(self.dbbuf_shadow_mem)
+        ctypes.memset(self.dbbuf_shadow_mem.vaddr, 0, self.mps)
+
+        self.dbbuf_eventidx_mem = self.malloc_and_map_iova(self.mps,
+                                                           DMADirection.DEVICE_TO_HOST,
+                                                           client='dbbuf_eventidx')
+        self.queue_mem.append(self.dbbuf_eventidx_mem)
+        ctypes.memset(self.dbbuf_eventidx_mem.vaddr, 0, self.mps)
+
+        # Seed the shadow doorbells with the current values of IO queues that already
+        #  exist, so the controller picks up where the doorbell registers left off
+        io_queues = [(sq, cq) for (sqid, cqid), (sq, cq) in
+                     self.queue_mgr.nvme_queues.items() if sqid != 0]
+        for sq, cq in io_queues:
+            ctypes.c_uint32.from_address(self.dbbuf_addresses(sq.qid)[0]).value = sq.tail.value
+            ctypes.c_uint32.from_address(
+                self.dbbuf_addresses(cq.qid, completion=True)[0]).value = cq.head.value
+
+        dbbc_cmd = DoorbellBufferConfig()
+        dbbc_cmd.DPTR.PRP.PRP1 = self.dbbuf_shadow_mem.iova
+        dbbc_cmd.DPTR.PRP.PRP2 = self.dbbuf_eventidx_mem.iova
+        try:
+            self.sync_cmd(dbbc_cmd, alloc_mem=False)
+        except NVMeStatusCodeException:
+            # Keep using the doorbell registers, the memory is freed on the next disable
+            self.dbbuf_shadow_mem = None
+            self.dbbuf_eventidx_mem = None
+            raise
+
+        # Switch the existing IO queues over
+        for sq, cq in io_queues:
+            self.enable_shadow_doorbells(sq, cq)
+
     def init_io_queues(self, num_queues=10, queue_entries=256, sq_nvme_set_id=0):
 
         # Has the ADMIN queue been initialized?
@@ -462,8 +544,16 @@ class NVMeDeviceCommon:
             for cq in cqs:
                 vector = cq.int_vector
                 if self.get_msix_vector_pending_count(vector):
+
+                    # Poll the queue with its vector masked so completions that keep coming
+                    #  in while we drain it don't cause more interrupts. Anything posted
+                    #  while masked sets the pending bit and interrupts again on unmask
+                    if self.msix_table is not None:
+                        self.msix_table.mask(vector)
                     while self.get_completion(cq.qid):
                         num_completions += 1
+                    if self.msix_table is not None:
+                        self.msix_table.unmask(vector)
 
             if num_completions >= max_completions:
                 break
@@ -557,7 +647,7 @@ class NVMeDeviceCommon:
         if command.data_in is not None and command.data_out is not None:
             assert False, 'Data IN and OUT not yet supported!'
 
-        elif command.__class__.__name__ == 'Write':
+        elif command.__class__.__name__ in ['Write', 'Compare', 'ZoneAppend']:
             direction = DMADirection.HOST_TO_DEVICE
             size = (command.NLB + 1) * self.namespaces[command.NSID].lba_ds_bytes
 
@@ -616,16 +706,17 @@ class NVMeDeviceCommon:
             command.prps.remove(prp)
 
 
-def NVMeDevice(pci_slot):
+def NVMeDevice(pci_slot, **kwargs):
     ''' Helper function to allow tests/modules/etc to pick a physical or simulated
-        device by using the special nvsim pci_slot name. Any other name is treated
-        as a real device in the pci bus
+        device by using the special nvsim (or nvsim:N, for one of many simulated
+        controllers) pci_slot name. Any other name is treated as a real device in the
+        pci bus. kwargs are passed to the device's constructor
     '''
-    if pci_slot == 'nvsim':
+    if pci_slot == 'nvsim' or pci_slot.startswith('nvsim:'):
         from nvsim import NVMeSimulator
-        return NVMeSimulator(pci_slot)
+        return NVMeSimulator(pci_slot, **kwargs)
     else:
-        return NVMeDevicePhysical(pci_slot)
+        return NVMeDevicePhysical(pci_slot, **kwargs)
 
 
 class NVMeDevicePhysical(NVMeDeviceCommon):
@@ -639,8 +730,11 @@ class NVMeDevicePhysical(NVMeDeviceCommon):
         # Create the PCI Userspace device interface object
         self.pci_userspace_dev_ifc = System.PciUserspaceDevice(pci_slot)
 
-        # Create the object to access PCIe registers
+        # Create the object to access PCIe registers, and find its capabilities. The
+        #  capability layout is cached by slot, resets don't change it. After a FLR use
+        #  init_capabilities(cache_key=pci_slot, refresh=True) to find it again
         self.pcie_regs = self.pci_userspace_dev_ifc.pci_regs()
+        self.pcie_regs.init_capabilities(cache_key=pci_slot)
 
         # Create the object to access NVMe registers
         self.nvme_regs = self.pci_userspace_dev_ifc.nvme_regs()
@@ -682,5 +776,11 @@ class NVMeDevicePhysical(NVMeDeviceCommon):
         self.int_type = NVMeDeviceIntType.MSIX
         self.get_completions = self.get_msix_completions
 
+        # The MSI-X table is in BAR0, mapped at our NVMe registers
+        msix_caps = [cap for cap in self.pcie_regs.capabilities if
+                     cap._cap_id_ == self.pcie_regs.PCICapMSIX._cap_id_]
+        if len(msix_caps):
+            self.msix_table = MSIXTable(msix_caps[0], ctypes.addressof(self.nvme_regs))
+
     def get_msix_vector_pending_count(self, vector):
         return self.pci_userspace_dev_ifc.get_msix_vector_pending_count(vector)
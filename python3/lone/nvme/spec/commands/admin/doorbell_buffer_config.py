@@ -0,0 +1,21 @@
+import ctypes
+from lone.nvme.spec.structures import ADMINCommand
+
+
+class DoorbellBufferConfig(ADMINCommand):
+    ''' PRP1 points to the Shadow Doorbell buffer and PRP2 to the EventIdx buffer,
+        each one memory page in size
+    '''
+    _pack_ = 1
+    _fields_ = [
+        ('DW10', ctypes.c_uint32),
+        ('DW11', ctypes.c_uint32),
+        ('DW12', ctypes.c_uint32),
+        ('DW13', ctypes.c_uint32),
+        ('DW14', ctypes.c_uint32),
+        ('DW15', ctypes.c_uint32),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x7C
+    }
@@ -39,14 +39,17 @@ status_codes.add([
 
 def GetLogPageFactory(name, lid, data_in_type):
     cls = type(name, (GetLogPage,), {"__init__": GetLogPage.__init__})
-    cls.LID = lid
     cls.data_in_type = data_in_type
     cls.data_in_type.size = ctypes.sizeof(data_in_type)
 
-    # Fill in number of DWORDS U/L for this command
+    # Fill in the LID and number of DWORDS U/L for this command
     num_dw = int(ctypes.sizeof(data_in_type) / 4) - 1
-    cls.NUMDL = num_dw & 0xFFFF
-    cls.NUMDH = num_dw >> 16
+    cls._defaults_ = {
+        'OPC': 0x02,
+        'LID': lid,
+        'NUMDL': num_dw & 0xFFFF,
+        'NUMDU': num_dw >> 16,
+    }
     return cls
 
 
@@ -282,11 +282,11 @@ class IdentifyNamespaceZonedData(DataInCommon):
 
     class LBAFormatExtended(ctypes.Structure):
         _pack_ = 1
-        size = 128
+        size = 16
         _fields_ = [
             ('ZSZE', ctypes.c_uint64),
             ('ZDES', ctypes.c_uint8),
-            ('RSVD_0)', ctypes.c_uint8 * 56),
+            ('RSVD_0', ctypes.c_uint8 * 7),
         ]
 
     _fields_ = [
@@ -317,6 +317,23 @@ class IdentifyNamespaceZoned(Identify):
     data_in_type = IdentifyNamespaceZonedData
 
 
+class IdentifyControllerZonedData(DataInCommon):
+    size = 4096
+    _fields_ = [
+        ('ZASL', ctypes.c_uint8),
+        ('RSVD_0', ctypes.c_uint8 * 4095),
+    ]
+
+
+class IdentifyControllerZoned(Identify):
+    _defaults_ = {
+        'OPC': 0x06,
+        'CNS': 0x06,
+        'CSI': 0x02,
+    }
+    data_in_type = IdentifyControllerZonedData
+
+
 class IdentifyIoCmdSetData(DataInCommon):
     size = 4096
 
@@ -341,3 +358,9 @@ class IdentifyIoCmdSet(Identify):
         'CNS': 0x1C,
     }
     data_in_type = IdentifyIoCmdSetData
+
+
+assert ctypes.sizeof(IdentifyNamespaceZonedData) == IdentifyNamespaceZonedData.size
+assert IdentifyNamespaceZonedData.LBAFE_TBL.offset == 2816
+assert ctypes.sizeof(IdentifyControllerZonedData) == IdentifyControllerZonedData.size
+assert ctypes.sizeof(IdentifyIoCmdSetData) == IdentifyIoCmdSetData.size
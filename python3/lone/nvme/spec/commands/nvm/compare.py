@@ -0,0 +1,37 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand
+from lone.nvme.spec.commands.status_codes import NVMeStatusCode, status_codes
+
+
+class Compare(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('SLBA', ctypes.c_uint64),
+
+        ('NLB', ctypes.c_uint32, 16),
+        ('RSVD_0', ctypes.c_uint32, 8),
+        ('STC', ctypes.c_uint32, 1),
+        ('RSVD_1', ctypes.c_uint32, 1),
+        ('PRINFO', ctypes.c_uint32, 4),
+        ('FUA', ctypes.c_uint32, 1),
+        ('LR', ctypes.c_uint32, 1),
+
+        ('DW13', ctypes.c_uint32),
+
+        ('ELBST_EILBRT', ctypes.c_uint32),
+
+        ('ELBAT', ctypes.c_uint32, 16),
+        ('ELBATM', ctypes.c_uint32, 16),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x05
+    }
+
+
+status_codes.add([
+    NVMeStatusCode(0x81, 'Invalid Protection Information', Compare),
+
+    # Media and Data Integrity Errors
+    NVMeStatusCode(0x85, 'Compare Failure', Compare, sct=2),
+])
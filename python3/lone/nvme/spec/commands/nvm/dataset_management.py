@@ -0,0 +1,51 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand, DataOutCommon
+from lone.nvme.spec.commands.status_codes import NVMeStatusCode, status_codes
+
+
+class DatasetManagementRange(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ('CA', ctypes.c_uint32),
+        ('NLB', ctypes.c_uint32),
+        ('SLBA', ctypes.c_uint64),
+    ]
+
+
+class DatasetManagementData(DataOutCommon):
+    size = 4096
+    _fields_ = [
+        ('RANGES', DatasetManagementRange * 256),
+    ]
+
+
+class DatasetManagement(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('NR', ctypes.c_uint32, 8),
+        ('RSVD_0', ctypes.c_uint32, 24),
+
+        ('IDR', ctypes.c_uint32, 1),
+        ('IDW', ctypes.c_uint32, 1),
+        ('AD', ctypes.c_uint32, 1),
+        ('RSVD_1', ctypes.c_uint32, 29),
+
+        ('DW12', ctypes.c_uint32),
+        ('DW13', ctypes.c_uint32),
+        ('DW14', ctypes.c_uint32),
+        ('DW15', ctypes.c_uint32),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x09
+    }
+    data_out_type = DatasetManagementData
+
+
+status_codes.add([
+    NVMeStatusCode(0x20, 'Namespace Write Protected', DatasetManagement),
+    NVMeStatusCode(0x82, 'Attempted Write to Read Only Range', DatasetManagement),
+])
+
+assert ctypes.sizeof(DatasetManagementRange) == 16
+assert ctypes.sizeof(DatasetManagementData) == DatasetManagementData.size
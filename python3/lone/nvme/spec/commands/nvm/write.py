@@ -47,4 +47,11 @@ status_codes.add([
     NVMeStatusCode(0x80, 'Conflicting Attributes', Write),
     NVMeStatusCode(0x81, 'Invalid Protection Information', Write),
     NVMeStatusCode(0x82, 'Attempted Write to Read Only Range', Write),
+    NVMeStatusCode(0xB8, 'Zone Boundary Error', Write),
+    NVMeStatusCode(0xB9, 'Zone Is Full', Write),
+    NVMeStatusCode(0xBA, 'Zone Is Read Only', Write),
+    NVMeStatusCode(0xBB, 'Zone Is Offline', Write),
+    NVMeStatusCode(0xBC, 'Zone Invalid Write', Write),
+    NVMeStatusCode(0xBD, 'Too Many Active Zones', Write),
+    NVMeStatusCode(0xBE, 'Too Many Open Zones', Write),
 ])
@@ -0,0 +1,43 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand
+from lone.nvme.spec.commands.status_codes import NVMeStatusCode, status_codes
+
+
+class WriteZeroes(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('SLBA', ctypes.c_uint64),
+
+        ('NLB', ctypes.c_uint32, 16),
+        ('RSVD_0', ctypes.c_uint32, 8),
+        ('STC', ctypes.c_uint32, 1),
+        ('DEAC', ctypes.c_uint32, 1),
+        ('PRINFO', ctypes.c_uint32, 4),
+        ('FUA', ctypes.c_uint32, 1),
+        ('LR', ctypes.c_uint32, 1),
+
+        ('DW13', ctypes.c_uint32),
+
+        ('ELBST_EILBRT', ctypes.c_uint32),
+
+        ('LBAT', ctypes.c_uint32, 16),
+        ('LBATM', ctypes.c_uint32, 16),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x08
+    }
+
+
+status_codes.add([
+    NVMeStatusCode(0x20, 'Namespace Write Protected', WriteZeroes),
+    NVMeStatusCode(0x81, 'Invalid Protection Information', WriteZeroes),
+    NVMeStatusCode(0x82, 'Attempted Write to Read Only Range', WriteZeroes),
+    NVMeStatusCode(0xB8, 'Zone Boundary Error', WriteZeroes),
+    NVMeStatusCode(0xB9, 'Zone Is Full', WriteZeroes),
+    NVMeStatusCode(0xBA, 'Zone Is Read Only', WriteZeroes),
+    NVMeStatusCode(0xBB, 'Zone Is Offline', WriteZeroes),
+    NVMeStatusCode(0xBC, 'Zone Invalid Write', WriteZeroes),
+    NVMeStatusCode(0xBD, 'Too Many Active Zones', WriteZeroes),
+    NVMeStatusCode(0xBE, 'Too Many Open Zones', WriteZeroes),
+])
@@ -13,11 +13,16 @@ class NVMeStatusCodeException(Exception):
 
 
 class NVMeStatusCode:
-    def __init__(self, value, name, cmd_type=Generic):
+    def __init__(self, value, name, cmd_type=Generic, sct=None):
         self.value = value
         self.name = name
         self.cmd_type = cmd_type
 
+        # Status Code Type, generic (0) or command specific (1) unless told otherwise
+        if sct is None:
+            sct = 0 if cmd_type == Generic else 1
+        self.sct = sct
+
     def __int__(self):
         return int(self.value)
 
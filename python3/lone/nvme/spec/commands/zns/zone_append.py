@@ -0,0 +1,48 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand
+from lone.nvme.spec.commands.status_codes import NVMeStatusCode, status_codes
+
+
+class ZoneAppend(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('ZSLBA', ctypes.c_uint64),
+
+        ('NLB', ctypes.c_uint32, 16),
+        ('RSVD_0', ctypes.c_uint32, 9),
+        ('PIREMAP', ctypes.c_uint32, 1),
+        ('PRINFO', ctypes.c_uint32, 4),
+        ('FUA', ctypes.c_uint32, 1),
+        ('LR', ctypes.c_uint32, 1),
+
+        ('DW13', ctypes.c_uint32),
+
+        ('ILBRT', ctypes.c_uint32),
+
+        ('LBAT', ctypes.c_uint32, 16),
+        ('LBATM', ctypes.c_uint32, 16),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x7D
+    }
+
+    @property
+    def alba(self):
+        ''' LBA the data was written to, from the completion's Dwords 0 and 1
+        '''
+        return self.cqe.CMD_SPEC | (self.cqe.RSVD_0 << 32)
+
+
+status_codes.add([
+    NVMeStatusCode(0x20, 'Namespace Write Protected', ZoneAppend),
+    NVMeStatusCode(0x81, 'Invalid Protection Information', ZoneAppend),
+    NVMeStatusCode(0xB8, 'Zone Boundary Error', ZoneAppend),
+    NVMeStatusCode(0xB9, 'Zone Is Full', ZoneAppend),
+    NVMeStatusCode(0xBA, 'Zone Is Read Only', ZoneAppend),
+    NVMeStatusCode(0xBB, 'Zone Is Offline', ZoneAppend),
+    NVMeStatusCode(0xBC, 'Zone Invalid Write', ZoneAppend),
+    NVMeStatusCode(0xBD, 'Too Many Active Zones', ZoneAppend),
+    NVMeStatusCode(0xBE, 'Too Many Open Zones', ZoneAppend),
+    NVMeStatusCode(0xBF, 'Invalid Zone State Transition', ZoneAppend),
+])
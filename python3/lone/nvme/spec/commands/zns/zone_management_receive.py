@@ -0,0 +1,85 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand, DataInCommon
+
+
+class ZoneDescriptor(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ('ZT', ctypes.c_uint8, 4),
+        ('RSVD_0', ctypes.c_uint8, 4),
+
+        ('RSVD_1', ctypes.c_uint8, 4),
+        ('ZS', ctypes.c_uint8, 4),
+
+        ('ZA', ctypes.c_uint8),
+        ('ZAI', ctypes.c_uint8),
+        ('RSVD_2', ctypes.c_uint8 * 4),
+
+        ('ZCAP', ctypes.c_uint64),
+        ('ZSLBA', ctypes.c_uint64),
+        ('WP', ctypes.c_uint64),
+
+        ('RSVD_3', ctypes.c_uint8 * 32),
+    ]
+
+    # Zone Types
+    ZT_SEQUENTIAL_WRITE_REQUIRED = 0x2
+
+    # Zone States
+    ZS_EMPTY = 0x1
+    ZS_IMPLICITLY_OPENED = 0x2
+    ZS_EXPLICITLY_OPENED = 0x3
+    ZS_CLOSED = 0x4
+    ZS_READ_ONLY = 0xD
+    ZS_FULL = 0xE
+    ZS_OFFLINE = 0xF
+
+
+class ZoneReportData(DataInCommon):
+    size = 4096
+    _fields_ = [
+        ('NZ', ctypes.c_uint64),
+        ('RSVD_0', ctypes.c_uint8 * 56),
+        ('ZDS', ZoneDescriptor * 63),
+    ]
+
+
+class ZoneManagementReceive(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('SLBA', ctypes.c_uint64),
+
+        ('NUMD', ctypes.c_uint32),
+
+        ('ZRA', ctypes.c_uint32, 8),
+        ('ZRASF', ctypes.c_uint32, 8),
+        ('PR', ctypes.c_uint32, 1),
+        ('RSVD_0', ctypes.c_uint32, 15),
+
+        ('DW14', ctypes.c_uint32),
+        ('DW15', ctypes.c_uint32),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x7A,
+        'NUMD': (ZoneReportData.size // 4) - 1,
+    }
+    data_in_type = ZoneReportData
+
+    # Zone Receive Actions
+    REPORT_ZONES = 0x00
+    EXTENDED_REPORT_ZONES = 0x01
+
+    # Zone Receive Action Specific Field values for Report Zones, which zones to list
+    LIST_ALL = 0x00
+    LIST_EMPTY = 0x01
+    LIST_IMPLICITLY_OPENED = 0x02
+    LIST_EXPLICITLY_OPENED = 0x03
+    LIST_CLOSED = 0x04
+    LIST_FULL = 0x05
+    LIST_READ_ONLY = 0x06
+    LIST_OFFLINE = 0x07
+
+
+assert ctypes.sizeof(ZoneDescriptor) == 64
+assert ctypes.sizeof(ZoneReportData) == ZoneReportData.size
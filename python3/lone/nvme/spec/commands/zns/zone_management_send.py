@@ -0,0 +1,41 @@
+import ctypes
+from lone.nvme.spec.structures import NVMCommand
+from lone.nvme.spec.commands.status_codes import NVMeStatusCode, status_codes
+
+
+class ZoneManagementSend(NVMCommand):
+    _pack_ = 1
+    _fields_ = [
+        ('SLBA', ctypes.c_uint64),
+
+        ('DW12', ctypes.c_uint32),
+
+        ('ZSA', ctypes.c_uint32, 8),
+        ('SEL', ctypes.c_uint32, 1),
+        ('ZSASO', ctypes.c_uint32, 1),
+        ('RSVD_0', ctypes.c_uint32, 22),
+
+        ('DW14', ctypes.c_uint32),
+        ('DW15', ctypes.c_uint32),
+    ]
+
+    _defaults_ = {
+        'OPC': 0x79
+    }
+
+    # Zone Send Actions
+    CLOSE = 0x01
+    FINISH = 0x02
+    OPEN = 0x03
+    RESET = 0x04
+    OFFLINE = 0x05
+    SET_ZONE_DESCRIPTOR_EXTENSION = 0x10
+
+
+status_codes.add([
+    NVMeStatusCode(0xBA, 'Zone Is Read Only', ZoneManagementSend),
+    NVMeStatusCode(0xBB, 'Zone Is Offline', ZoneManagementSend),
+    NVMeStatusCode(0xBD, 'Too Many Active Zones', ZoneManagementSend),
+    NVMeStatusCode(0xBE, 'Too Many Open Zones', ZoneManagementSend),
+    NVMeStatusCode(0xBF, 'Invalid Zone State Transition', ZoneManagementSend),
+])
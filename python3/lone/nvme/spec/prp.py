@@ -8,6 +8,45 @@ import logging
 logger = logging.getLogger('prp')
 
 
+def walk_prp(prp1, prp2, num_bytes, mps, iova_base=0):
+    ''' Returns the (address, length) pairs of the data described by prp1 and prp2 for
+            num_bytes, reading PRP lists straight from memory. PRP addresses are iovas,
+            found in memory at iova_base + iova. Only the entries needed for num_bytes
+            are read, so the cost only depends on the size of the transfer.
+    '''
+    # PRP1 may start at an offset into its page
+    length = min(num_bytes, mps - (prp1 % mps))
+    segments = [(iova_base + prp1, length)]
+    remaining = num_bytes - length
+
+    # What is left fits in the page PRP2 points to
+    if 0 < remaining <= mps:
+        segments.append((iova_base + prp2, remaining))
+        remaining = 0
+
+    # Otherwise PRP2 points to a list, which may also start at an offset into its page
+    list_address = prp2
+    while remaining > 0:
+
+        # If more pages are left than there are entries in the rest of this list page,
+        #  the last entry points to the next list page instead of to data
+        num_entries = (mps - (list_address % mps)) // 8
+        chained = remaining > num_entries * mps
+        num_data = (num_entries - 1) if chained else (remaining + mps - 1) // mps
+
+        prp_list = (ctypes.c_uint64 * (num_data + chained)).from_address(
+            iova_base + list_address)
+        for address in prp_list[:num_data]:
+            length = min(remaining, mps)
+            segments.append((iova_base + address, length))
+            remaining -= length
+
+        if chained:
+            list_address = prp_list[num_data]
+
+    return segments
+
+
 class PRP:
 
     def __init__(self, num_bytes, mps):
@@ -91,9 +130,10 @@ class PRP:
             else:
                 assert False, 'Support for PRPs larger than 2M not implemented!'
 
-    def from_address(self, prp1_address, prp2_address=0):
+    def from_address(self, prp1_address, prp2_address=0, iova_base=0):
         ''' Returns a PRP object that starts at address, and is big enough for num_bytes.
                 This assumes that a NVMe PRP starts at address and is properly formatted.
+                PRP addresses are iovas, found in memory at iova_base + iova.
         '''
 
         # TODO: This is mostly untested!!!! ADD TESTS
@@ -101,38 +141,49 @@ class PRP:
             assert prp1_address != 0, (
                 'Must have a PRP1 address for num_bytes {}'.format(self.num_bytes))
             self.prp1 = prp1_address
-            self.prp1_mem = MemoryLocation(self.prp1, self.prp1, self.mps, 'prp.from_address')
+            self.prp1_mem = MemoryLocation(self.prp1 + iova_base, self.prp1, self.mps,
+                                           'prp.from_address')
             self.mem_list.append(self.prp1_mem)
 
         elif self.pages_needed == 2:
+            assert prp1_address != 0, (
+                'Must have a PRP1 address for num_bytes {}'.format(self.num_bytes))
+            self.prp1 = prp1_address
+            self.prp1_mem = MemoryLocation(self.prp1 + iova_base, self.prp1, self.mps,
+                                           'prp.from_address')
+            self.mem_list.append(self.prp1_mem)
+
             assert prp2_address != 0, (
                 'Must have a PRP2 address for num_bytes {}'.format(self.num_bytes))
             self.prp2 = prp2_address
-            self.prp2_mem = MemoryLocation(self.prp2, self.prp2, self.mps, 'prp.from_address')
+            self.prp2_mem = MemoryLocation(self.prp2 + iova_base, self.prp2, self.mps,
+                                           'prp.from_address')
             self.mem_list.append(self.prp2_mem)
 
         else:
             assert prp1_address != 0, (
                 'Must have a PRP1 address for num_bytes {}'.format(self.num_bytes))
             self.prp1 = prp1_address
-            self.prp1_mem = MemoryLocation(self.prp1, self.prp1, self.mps, 'prp.from_address')
+            self.prp1_mem = MemoryLocation(self.prp1 + iova_base, self.prp1, self.mps,
+                                           'prp.from_address')
             self.mem_list.append(self.prp1_mem)
 
             assert prp2_address != 0, (
                 'Must have a PRP2 address for num_bytes {}'.format(self.num_bytes))
             self.prp2 = prp2_address
-            self.prp2_mem = MemoryLocation(self.prp2, self.prp2, self.mps, 'prp.from_address')
+            self.prp2_mem = MemoryLocation(self.prp2 + iova_base, self.prp2, self.mps,
+                                           'prp.from_address')
             self.mem_list.append(self.prp2_mem)
 
             # Make a pointer to the first list element so we can fill it in with pointers
             prp_list_data = (ctypes.c_uint64 * (
                 self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(self.prp2_mem.vaddr)
 
-            # Find all the segments
-            for prp_segment in prp_list_data:
-                if prp_segment:
-                    prp_mem = MemoryLocation(prp_segment, prp_segment, self.mps, 'prp.from_address')
-                    self.mem_list.append(prp_mem)
+            # Find the segments, only as many as are needed after PRP1
+            for prp_segment in prp_list_data[:self.pages_needed - 1]:
+                prp_mem = MemoryLocation(prp_segment + iova_base, prp_segment, self.mps,
+                                         'prp.from_address')
+                self.mem_list.append(prp_mem)
 
         return self
 
@@ -185,25 +236,23 @@ class PRP:
             self.nvme_device.free_and_unmap_iova(mem)
 
     def get_data_segments(self):
-        segments = []
+        # Look pages up by iova instead of searching the memory list for each one
+        pages = {page.iova: page for page in self.mem_list}
 
-        for page_index, page in enumerate(self.mem_list):
+        # Get data from prp1, then from prp2 or the list it points to
+        segments = [pages[self.prp1]]
 
-            # Get data from prp1
-            if self.prp1 == page.iova:
-                segments.append(page)
+        if self.pages_needed == 2:
+            segments.append(pages[self.prp2])
 
-            # Get data from prp2 and lists
-            if self.prp2 == page.iova:
-                prp_list_data = (ctypes.c_uint64 * (
-                    self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(page.vaddr)
+        elif self.pages_needed > 2:
+            prp_list_data = (ctypes.c_uint64 * (
+                self.mps // ctypes.sizeof(ctypes.c_uint64))).from_address(pages[self.prp2].vaddr)
 
-                # If it is a list then get the data at that address
-                for i, d in enumerate(prp_list_data):
-                    if d != 0:
-                        p = [p for p in self.mem_list if p.iova == d]
-                        assert len(p) == 1, 'Something went wrong with this PRP'
-                        segments.append(p[0])
+            # Get the data at each address in the list
+            for d in prp_list_data[:self.pages_needed - 1]:
+                assert d in pages, 'Something went wrong with this PRP'
+                segments.append(pages[d])
 
             # TODO: This currently only handles one list segment
 
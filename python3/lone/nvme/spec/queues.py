@@ -1,6 +1,8 @@
 import ctypes
+import threading
 
 from lone.nvme.spec.structures import CQE, Generic
+from lone.util.trace import mmio_trace, TraceRing
 
 import logging
 logger = logging.getLogger('nvme_queues')
@@ -11,24 +13,61 @@ class NVMeHeadTail:
         self.entries = entries
         self._value = ctypes.c_uint32.from_address(address)
 
+        # Shadow doorbell and EventIdx, only set when using a Doorbell Buffer Config
+        self._shadow = None
+        self._event_idx = None
+
+    def enable_shadow(self, shadow_address, event_idx_address):
+        ''' From now on values are written to the shadow doorbell at shadow_address, and
+            only written to the doorbell register when the EventIdx at event_idx_address
+            says the controller wants to be notified. The caller is responsible for the
+            shadow doorbell holding the current value before enabling it.
+        '''
+        self._shadow = ctypes.c_uint32.from_address(shadow_address)
+        self._event_idx = ctypes.c_uint32.from_address(event_idx_address)
+
+    def disable_shadow(self):
+        self._shadow = None
+        self._event_idx = None
+
     def set(self, value):
-        self._value.value = value
+        if self._shadow is None:
+            self._value.value = value
+            if mmio_trace.enabled:
+                mmio_trace.record(TraceRing.DOORBELL, ctypes.addressof(self._value), value)
+        else:
+            self.set_shadow(value)
+
+    def set_shadow(self, value):
+        old_value = self._shadow.value
+        self._shadow.value = value
+        if mmio_trace.enabled:
+            mmio_trace.record(TraceRing.DOORBELL, ctypes.addressof(self._shadow), value)
+
+        # Only ring the doorbell if we moved past the EventIdx, using the same 16-bit
+        #  wrapping rules as the NVMe spec (and everyone else)
+        if ((value - self._event_idx.value - 1) & 0xFFFF) < ((value - old_value) & 0xFFFF):
+            self._value.value = value
+            if mmio_trace.enabled:
+                mmio_trace.record(TraceRing.DOORBELL, ctypes.addressof(self._value), value)
 
     def add(self, num):
-        new_value = self._value.value + num
+        new_value = self.value + num
         if new_value == self.entries:
             new_value = 0
-        self._value.value = new_value
+        self.set(new_value)
 
     def incr(self, num):
-        new_value = self._value.value + num
+        new_value = self.value + num
         if new_value == self.entries:
             new_value = 0
         return new_value
 
     @property
     def value(self):
-        return self._value.value
+        if self._shadow is None:
+            return self._value.value
+        return self._shadow.value
 
 
 class NVMeQueue:
@@ -121,32 +160,46 @@ class QueueMgr:
         # Dictionary where keys = (sqid, cqid), values = (sq, cq)
         self.nvme_queues = {}
 
+        # Held while queues are added or removed, so another thread can take a consistent
+        #  copy of them with queue_pairs()
+        self.lock = threading.Lock()
+
         self.io_sqids = []
         self.io_sqid_index = 0
 
         self.io_cqids = []
 
     def add(self, sq, cq):
-        self.nvme_queues[sq.qid, cq.qid] = (sq, cq)
+        with self.lock:
+            self.nvme_queues[sq.qid, cq.qid] = (sq, cq)
 
-        self.io_cqids = []
-        for k, v in self.nvme_queues.items():
-            sqid, cqid = k
-            sq, cq = v
-            if sqid != 0 and cqid != 0:
-                self.io_sqids.append(sqid)
-                self.io_cqids.append(cqid)
+            self.io_cqids = []
+            for k, v in self.nvme_queues.items():
+                sqid, cqid = k
+                sq, cq = v
+                if sqid != 0 and cqid != 0:
+                    self.io_sqids.append(sqid)
+                    self.io_cqids.append(cqid)
 
     def remove_cq(self, rem_cqid):
-        for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
-            if cqid == rem_cqid:
-                assert sq is None, "Removing CQ with not None SQ! {}".format(cqid)
-                self.nvme_queues[(sqid, cqid)] = (sq, None)
+        with self.lock:
+            for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
+                if cqid == rem_cqid:
+                    assert sq is None, "Removing CQ with not None SQ! {}".format(cqid)
+                    self.nvme_queues[(sqid, cqid)] = (sq, None)
 
     def remove_sq(self, rem_sqid):
-        for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
-            if sqid == rem_sqid:
-                self.nvme_queues[(sqid, cqid)] = (None, cq)
+        with self.lock:
+            for (sqid, cqid), (sq, cq) in self.nvme_queues.items():
+                if sqid == rem_sqid:
+                    self.nvme_queues[(sqid, cqid)] = (None, cq)
+
+    def queue_pairs(self):
+        ''' Returns a copy of the ((sqid, cqid), (sq, cq)) items, safe to iterate while
+            another thread adds or removes queues
+        '''
+        with self.lock:
+            return list(self.nvme_queues.items())
 
     def get_cqs(self):
         cqs = []
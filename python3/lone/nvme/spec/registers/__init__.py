@@ -1,5 +1,6 @@
 import ctypes
 from lone.util.struct_tools import ComparableStruct
+from lone.util.trace import mmio_trace
 
 
 class RegsStructAccess(ComparableStruct):
@@ -18,6 +19,8 @@ class RegsStructAccess(ComparableStruct):
         #  is just in userspace memory
         if not self._access_.set_func:
             object.__setattr__(self, name, value)
+            if mmio_trace.enabled:
+                mmio_trace.record_field(self, name)
 
         # If we are not accessing it directly, but the user requested
         #   something that is not in the _fields_ attribute, just
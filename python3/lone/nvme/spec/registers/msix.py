@@ -0,0 +1,62 @@
+import ctypes
+
+import logging
+logger = logging.getLogger('msix')
+
+
+class MSIXTableEntry(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ('ADDR_LO', ctypes.c_uint32),
+        ('ADDR_HI', ctypes.c_uint32),
+        ('DATA', ctypes.c_uint32),
+        ('V_CTRL', ctypes.c_uint32),
+    ]
+
+    # Vector Control bit 0 masks the vector
+    MASK_BIT = 0x1
+
+
+class MSIXTable:
+    ''' Access to a device's MSI-X table and Pending Bit Array (PBA) based on its MSI-X
+        capability. bar_address is where the BAR holding them is mapped in memory.
+    '''
+    def __init__(self, msix_cap, bar_address):
+        self.tbir = msix_cap.MTAB.TBIR
+        self.table_offset = msix_cap.MTAB.TO << 3
+        self.pbir = msix_cap.MPBA.PBIR
+        self.pba_offset = msix_cap.MPBA.PBAO << 3
+        self.size = msix_cap.MXC.TS + 1
+
+        assert self.tbir == 0, 'Need something different for vectors NOT in BAR0/1'
+        assert self.pbir == 0, 'Need something different for vectors NOT in BAR0/1'
+
+        # One entry per vector in the table, and one bit per vector in the PBA
+        self.table = (MSIXTableEntry * self.size).from_address(bar_address + self.table_offset)
+        self.pba = (ctypes.c_uint64 * ((self.size + 63) // 64)).from_address(
+            bar_address + self.pba_offset)
+
+    def mask(self, vector):
+        self.table[vector].V_CTRL |= MSIXTableEntry.MASK_BIT
+
+    def unmask(self, vector):
+        self.table[vector].V_CTRL &= ~MSIXTableEntry.MASK_BIT
+
+    def is_masked(self, vector):
+        return (self.table[vector].V_CTRL & MSIXTableEntry.MASK_BIT) != 0
+
+    def pending(self, vector):
+        ''' Returns True if the vector's pending bit is set in the PBA. Interrupts that happen
+            while a vector is masked set this bit and are sent when the vector is unmasked
+        '''
+        return ((self.pba[vector // 64] >> (vector % 64)) & 1) == 1
+
+    def log(self, max_entries=16, printer=logger.debug):
+        printer('MSI-X Table Size: {} Offset: 0x{:x}'.format(self.size, self.table_offset))
+        printer('MSI-X PBA Offset: 0x{:x}'.format(self.pba_offset))
+        for i, table_entry in enumerate(self.table[:max_entries]):
+            printer('Table Entry {:04}: ADDR: 0x{:08x}{:08x} DATA: 0x{:08x}, V_CTRL: 0x{:08x}'
+                    .format(i, table_entry.ADDR_HI, table_entry.ADDR_LO, table_entry.DATA,
+                            table_entry.V_CTRL))
+        for i, pba_entry in enumerate(self.pba):
+            printer('PBA Entry {}: 0x{:016x}'.format(i, pba_entry))
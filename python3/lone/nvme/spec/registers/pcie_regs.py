@@ -6,8 +6,9 @@ from lone.util.struct_tools import StructFieldsIterator
 from lone.nvme.spec.registers import RegsStructAccess
 
 
-#   pci registers in various implementations.
-PCIeAccessData = namedtuple('PCIeAccessData', 'get_func set_func')
+#   pci registers in various implementations. read_func is optional, when set it is
+#   used as read_func(offset, num_bytes) to read config space in bulk
+PCIeAccessData = namedtuple('PCIeAccessData', 'get_func set_func read_func', defaults=[None])
 
 
 def pcie_reg_struct_factory(access_data):
@@ -858,91 +859,108 @@ def pcie_reg_struct_factory(access_data):
             _access_ = access_data
             _base_offset_ = None
 
+        # Capability ID to capability type lookups, built once per registers type.
+        #  IDs not in here are unknown/unsupported capabilities
+        _cap_id_table_ = {c._cap_id_: c for c in [PCICapPowerManagementInterface,
+                                                  PCICapMSI,
+                                                  PCICapExpress,
+                                                  PCICapMSIX]}
+        _cap_ext_id_table_ = {c._cap_id_: c for c in [PCICapExtendedAer,
+                                                      PCICapExtendeDeviceSerialNumber]}
+
     return NVMePCIeRegisters
 
 
 class PCIeRegisters:
 
-    def init_capabilities(self):
-
-        PCIeCapabilityIdTable = [
-            self.PCICapabilityUnknown,
-            self.PCICapPowerManagementInterface,
-            *([self.PCICapabilityUnknown] * 3),
-            self.PCICapMSI,
-            *([self.PCICapabilityUnknown] * 10),
-            self.PCICapExpress,
-            self.PCICapMSIX,
-            *([self.PCICapabilityUnknown] * 238),
-        ]
+    # Capability layouts found by init_capabilities, keyed by the cache_key it was
+    #  called with (the pci slot). Each layout is a list of (offset, cap_id, extended)
+    _capability_layouts = {}
 
-        PCIeCapabilityExtIdTable = [
-            self.PCICapabilityUnknown,
-            self.PCICapExtendedAer,
-            *([self.PCICapabilityUnknown] * 1),
-            self.PCICapExtendeDeviceSerialNumber,
-            *([self.PCICapabilityExtUnknown] * 251),
-        ]
+    @classmethod
+    def invalidate_capabilities(cls, cache_key):
+        ''' Forget the capability layout cached for cache_key, for example after a FLR
+        '''
+        cls._capability_layouts.pop(cache_key, None)
 
-        # Collect capabilities into a list
-        self.capabilities = []
+    def config_space(self):
+        ''' Returns a bytes snapshot of the whole config space, read all at once when possible
+        '''
+        size = ctypes.sizeof(self)
+        if type(self) is PCIeRegistersDirect:
+            return ctypes.string_at(ctypes.addressof(self), size)
+        elif self._access_data_.read_func is not None:
+            return bytes(self._access_data_.read_func(0, size))
+        else:
+            return bytes(RegsStructAccess.read_data(self, self._access_data_.get_func, 0, size))
+
+    def capability_layout(self):
+        ''' Walks the capability lists in a config space snapshot and returns a list of
+            (offset, cap_id, extended) tuples for each capability found
+        '''
+        config = self.config_space()
+        layout = []
 
-        # Get the pointer to the first capability and walk the list saving each in
-        #  the self.capabilities list
-        for next_cap_ptr in [self.CAP.CP, 0x100]:
+        for next_cap_ptr in [config[type(self).CAP.offset], 0x100]:
 
-            while next_cap_ptr:
+            # Stop at the end of config space, and at loops in badly formed lists
+            visited = set()
+            while next_cap_ptr and next_cap_ptr not in visited and next_cap_ptr + 4 <= len(config):
+                visited.add(next_cap_ptr)
 
-                # Different handling for generic vs extended capabilities
+                # Generic capabilities are 1 byte ID, 1 byte next pointer. Extended are 16 bits
+                #  ID, 4 bits version and 12 bits next pointer
                 if next_cap_ptr < 0x100:
+                    cap_id = config[next_cap_ptr]
+                    layout.append((next_cap_ptr, cap_id, False))
+                    next_cap_ptr = config[next_cap_ptr + 1]
+                else:
+                    header = int.from_bytes(config[next_cap_ptr:next_cap_ptr + 4], 'little')
+                    cap_id = header & 0xFFFF
+                    layout.append((next_cap_ptr, cap_id, True))
+                    next_cap_ptr = header >> 20
 
-                    # Make a generic capability first so we can find out what type it is
-                    cap_gen = self.PCICapabilityGen()
-
-                    # Different handling for direct vs indirect registers
-                    if type(self) is PCIeRegistersDirect:
-                        cap_gen = self.PCICapabilityGen.from_address(
-                            ctypes.addressof(self) + next_cap_ptr)
-                    else:
-                        cap_gen._access_ = self._access_data_
-                        cap_gen._base_offset_ = next_cap_ptr
-
-                    # Now we can pull the real type from the table
-                    cap_obj = PCIeCapabilityIdTable[cap_gen.CAP_ID]
+        return layout
 
-                else:
-                    # Make a generic capability first so we can find out what type it is
-                    cap_gen_e = self.PCICapabilityGenExtended()
-
-                    # Different handling for direct vs indirect registers
-                    if type(self) is PCIeRegistersDirect:
-                        cap_gen_e = self.PCICapabilityGenExtended.from_address(
-                            ctypes.addressof(self) + next_cap_ptr)
-                    else:
-                        cap_gen_e._access_ = self._access_data_
-                        cap_gen_e._base_offset_ = next_cap_ptr
-
-                    # Now we can pull the real type from the table
-                    cap_obj = PCIeCapabilityExtIdTable[cap_gen_e.CAP_ID]
-
-                # Only add known types to the capabilities list
-                if type(self) is PCIeRegistersDirect:
-                    capability = cap_obj.from_address(ctypes.addressof(self.ID) + next_cap_ptr)
-                else:
-                    capability = cap_obj()
-                    capability._access_ = self._access_data_
-                    capability._base_offset_ = next_cap_ptr
-                    capability.set_offsets(capability._base_offset_)
-
-                # Only add if cap id is known
-                if type(capability) in [self.PCICapabilityUnknown, self.PCICapabilityExtUnknown]:
-                    logging.info('Found unsupported Capability {}: 0x{:x}'.format(
-                        'gen' if next_cap_ptr < 0x100 else 'ext', capability.CAP_ID))
-                else:
-                    self.capabilities.append(capability)
+    def init_capabilities(self, cache_key=None, refresh=False):
+        ''' Creates self.capabilities with an object for each supported capability. The
+            capability layout is only walked once per object, and once per cache_key
+            (the pci slot) until invalidate_capabilities or refresh=True is used
+        '''
+        if refresh:
+            self._capability_layout = None
+            self.invalidate_capabilities(cache_key)
+
+        # Use a layout we already know about if possible, walk the lists if not
+        layout = getattr(self, '_capability_layout', None)
+        if layout is None:
+            layout = self._capability_layouts.get(cache_key) if cache_key is not None else None
+        if layout is None:
+            layout = self.capability_layout()
+            if cache_key is not None:
+                self._capability_layouts[cache_key] = layout
+        self._capability_layout = layout
 
-                # Advance to the next pointer
-                next_cap_ptr = capability.NEXT_PTR
+        # Collect capabilities into a list
+        self.capabilities = []
+        for offset, cap_id, extended in layout:
+
+            # Only add known types to the capabilities list
+            cap_obj = (self._cap_ext_id_table_ if extended else self._cap_id_table_).get(cap_id)
+            if cap_obj is None:
+                logging.info('Found unsupported Capability {}: 0x{:x}'.format(
+                    'ext' if extended else 'gen', cap_id))
+                continue
+
+            # Different handling for direct vs indirect registers
+            if type(self) is PCIeRegistersDirect:
+                capability = cap_obj.from_address(ctypes.addressof(self) + offset)
+            else:
+                capability = cap_obj()
+                capability._access_ = self._access_data_
+                capability._base_offset_ = offset
+                capability.set_offsets(capability._base_offset_)
+            self.capabilities.append(capability)
 
     def log(self):
         log = logging.getLogger('pcie_regs')
@@ -13,6 +13,7 @@ from lone.nvme.spec.registers.pcie_regs import (PCIeRegisters,
                                                 PCIeAccessData,
                                                 pcie_reg_struct_factory)
 from lone.nvme.spec.registers.nvme_regs import NVMeRegistersDirect
+from lone.util.trace import mmio_trace, TraceRing
 
 import logging
 logger = logging.getLogger('vfio')
@@ -325,15 +326,21 @@ class SysVfioIfc(SysPciUserspaceDevice):
         data = os.pread(self.device_fd, 1, self.pci_region['offset'] + offset)
         return int.from_bytes(data, 'little')
 
+    def pcie_read(self, offset, num_bytes):
+        return os.pread(self.device_fd, num_bytes, self.pci_region['offset'] + offset)
+
     def pcie_set(self, offset, value):
         assert os.pwrite(self.device_fd,
                          value.to_bytes(1, 'little'),
                          self.pci_region['offset'] + offset)
+        if mmio_trace.enabled:
+            mmio_trace.record(TraceRing.PCIE_CONFIG, offset, value)
 
     def pci_regs(self):
 
         class PCIeRegistersVFIO(pcie_reg_struct_factory(PCIeAccessData(self.pcie_get,
-                                                                       self.pcie_set)),
+                                                                       self.pcie_set,
+                                                                       self.pcie_read)),
                                 PCIeRegisters):
             pass
 
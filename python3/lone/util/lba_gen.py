@@ -1,6 +1,10 @@
+import array
+import random
+
 # https://datacipy.cz/lfsr_table.pdf
 # https://blog.xojo.com/2021/10/01/random-numbers-with-lfsr-linear-feedback-shift-register/
 
+
 class LBARandGenLFSR:
     ''' Implementation of LFSR to be used for sending random commands to an LBA range
         USAGE:
@@ -9,24 +13,27 @@ class LBARandGenLFSR:
             num_blocks_per_io = 4 # 16K ios in the example above
             rand_lbas = LBARandGenLFSR(max_lba, num_blocks_per_io, init_state=1)
             slba = lbas.next() # call until slba == lbas.initial_state
+            slbas = lbas.next_batch(1024) # or get them in bulk, as an array('Q')
 
         NOTES:
-            Since 0 is never returned by an LFSR but is a valid LBA, it is
-            always returned as the last value in the sequece
+            Since 0 is never returned by an LFSR but is a valid state, start_lba
+            (the LBA for state 0) is always returned as the last value in the sequece
     '''
-    def __init__(self, max_lba, num_blocks_per_io, initial_state=237):
+    def __init__(self, max_lba, num_blocks_per_io, initial_state=237, start_lba=0):
         ''' max_lba: largest LBA to return
             num_blocks_per_io: how many blocks per lba to be used
             initial_state: seed for the LFSR
+            start_lba: smallest LBA to return, LBAs are start_lba + n * num_blocks_per_io
         '''
         self.max_lba = max_lba - num_blocks_per_io
         self.num_blocks_per_io = num_blocks_per_io
+        self.start_lba = start_lba
 
         # Make sure the initial value is a valid lba
         self.initial_state = initial_state
 
-        # Max value
-        self.max_value = self.max_lba // num_blocks_per_io
+        # Max value, one state per IO that fits between start_lba and max_lba
+        self.max_value = ((max_lba - start_lba) // num_blocks_per_io) - 1
 
         # Initial state
         assert self.initial_state < self.max_value, (
@@ -59,12 +66,66 @@ class LBARandGenLFSR:
 
         if self.state == self.initial_state and self.period > 0:
             self.complete = True
-            ret = 0
+            ret = self.start_lba
         else:
             ret = self.next()
 
         return ret
 
+    def next_batch(self, n):
+        ''' Returns the next n LBAs as an array('Q'), the same ones n calls to next() on
+            the iterator would. Returns fewer once the sequence is complete.
+
+            Each feedback bit only depends on state bits at or above its position, so the
+            next (num_bits - p3) feedback bits are computed at once and the states in
+            between are windows of state with them on top. Picking the LBAs out of the
+            windows is still a Python loop step per state, but without next()'s call and
+            attribute lookups, which makes it about 2-3 times faster. The polynomials are
+            maximal length, so the sequence is back at initial_state after exactly
+            2^num_bits - 1 steps
+        '''
+        lbas = array.array('Q')
+        if self.complete:
+            return lbas
+
+        state = self.state
+        period = self.period
+        max_value = self.max_value
+        num_blocks_per_io = self.num_blocks_per_io
+        start_lba = self.start_lba
+        num_bits = self.num_bits
+        p1, p2, p3 = self.taps
+        mask = (1 << num_bits) - 1
+        full_period = (1 << num_bits) - 1
+        append = lbas.append
+
+        while len(lbas) < n:
+            if period == full_period:
+                self.complete = True
+                append(start_lba)
+                break
+
+            # Feedback bits for the next steps, on top of the current state
+            steps = min(num_bits - p3, full_period - period)
+            bits = (state ^ (state >> p1) ^ (state >> p2) ^ (state >> p3)) & ((1 << steps) - 1)
+            window = state | (bits << num_bits)
+
+            # Skip over states larger than max_value, like next() does
+            for step in range(1, steps + 1):
+                value = (window >> step) & mask
+                if value <= max_value:
+                    append(start_lba + (value * num_blocks_per_io))
+                    if len(lbas) == n:
+                        steps = step
+                        break
+
+            state = (window >> steps) & mask
+            period += steps
+
+        self.state = state
+        self.period = period
+        return lbas
+
     def get_lfsr_func(self):
         # Polynomials from here: https://datacipy.cz/lfsr_table.pdf
 
@@ -113,18 +174,123 @@ class LBARandGenLFSR:
 
         num_bits = self.num_bits
         p0, p1, p2, p3 = polys[num_bits]
+        self.taps = (p1, p2, p3)
 
         def f():
-            state = self.state
-            bit = (state ^ (state >> p1) ^ (state >> p2) ^ (state >> p3)) & 1
-            self.state = (state >> 1) | (bit << (num_bits - 1))
-            self.period += 1
-
             # If we are using a series that can have > max_value in it, then
-            #  if we get a number that is too large just drop it and run it again
-            if self.state > self.max_value:
-                return f()
+            #  if we get a number that is too large just drop it and step again
+            state = self.state
+            while True:
+                bit = (state ^ (state >> p1) ^ (state >> p2) ^ (state >> p3)) & 1
+                state = (state >> 1) | (bit << (num_bits - 1))
+                self.period += 1
+                if state <= self.max_value:
+                    break
+            self.state = state
 
-            return self.state * self.num_blocks_per_io
+            return self.start_lba + (self.state * self.num_blocks_per_io)
 
         return f
+
+
+class LBARandGenFeistel:
+    ''' Random order over every IO in an LBA range, from a Feistel network keyed by seed.
+        Every LBA start_lba + n * num_blocks_per_io that fits by max_lba is returned once,
+        in O(1) memory, for any number of them. Any position in the sequence can be
+        computed directly, so a fill can be checkpointed (index), resumed (seek) or split
+        across workers that each seek to their own part of it.
+        USAGE:
+            block_size = 4096
+            max_lba = int((128 * (1024 **4) // block_size) - 1)
+            num_blocks_per_io = 4 # 16K ios in the example above
+            rand_lbas = LBARandGenFeistel(max_lba, num_blocks_per_io, seed=237)
+            for slba in rand_lbas:
+                ...
+            rand_lbas.seek(rand_lbas.num_ios // 2) # pick up from the middle
+
+        NOTES:
+            The network permutes numbers of an even number of bits, at most 4 times the
+            number of IOs. Values past the last IO are run through it again (cycle
+            walking) until they land on one, which keeps it a permutation of the IOs
+    '''
+    def __init__(self, max_lba, num_blocks_per_io, seed=237, start_lba=0, rounds=4):
+        ''' max_lba: largest LBA to return
+            num_blocks_per_io: how many blocks per lba to be used
+            seed: picks the order, the same seed always gives the same one
+            start_lba: smallest LBA to return
+            rounds: Feistel rounds
+        '''
+        self.num_blocks_per_io = num_blocks_per_io
+        self.start_lba = start_lba
+        self.seed = seed
+
+        # One value per IO that fits between start_lba and max_lba
+        self.num_ios = (max_lba - start_lba) // num_blocks_per_io
+        assert self.num_ios > 0, 'No IOs of {} blocks fit between LBAs {} and {}'.format(
+            num_blocks_per_io, start_lba, max_lba)
+
+        # Each half of the network is half of the bits needed for num_ios
+        num_bits = max(2, (self.num_ios - 1).bit_length())
+        self.half_bits = (num_bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+
+        # Round keys
+        keys_random = random.Random(seed)
+        self.keys = [keys_random.getrandbits(64) for i in range(rounds)]
+
+        # Position of the next LBA in the sequence
+        self.index = 0
+
+    @property
+    def complete(self):
+        return self.index >= self.num_ios
+
+    def reset(self):
+        self.index = 0
+
+    def seek(self, index):
+        ''' Makes the index-th LBA of the sequence the next one returned
+        '''
+        assert 0 <= index <= self.num_ios, 'Invalid index {}, there are {} IOs'.format(
+            index, self.num_ios)
+        self.index = index
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.complete:
+            raise StopIteration()
+
+        lba = self.lba(self.index)
+        self.index += 1
+        return lba
+
+    def next_batch(self, n):
+        ''' Returns the next n LBAs as an array('Q'), fewer once the sequence is complete
+        '''
+        end = min(self.index + n, self.num_ios)
+        lbas = array.array('Q', map(self.lba, range(self.index, end)))
+        self.index = end
+        return lbas
+
+    def permute(self, value):
+        ''' One pass of the Feistel network, a permutation of [0, 2^(2 * half_bits))
+        '''
+        half_bits = self.half_bits
+        half_mask = self.half_mask
+        left = value >> half_bits
+        right = value & half_mask
+        for key in self.keys:
+            # Round function, a multiplicative hash of the right half and the round key
+            mixed = ((right ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            left, right = right, left ^ ((mixed ^ (mixed >> 29)) & half_mask)
+        return (left << half_bits) | right
+
+    def lba(self, index):
+        ''' Returns the index-th LBA of the sequence
+        '''
+        value = self.permute(index)
+        while value >= self.num_ios:
+            value = self.permute(value)
+        return self.start_lba + (value * self.num_blocks_per_io)
@@ -0,0 +1,92 @@
+''' Opt-in binary trace of register and doorbell writes. Records go into a preallocated
+    ring of fixed size records so tracing does not log or allocate in the hot path. Users
+    check mmio_trace.enabled before recording, so a disabled trace is only a bool check.
+'''
+import ctypes
+import struct
+import time
+
+import logging
+logger = logging.getLogger('trace')
+
+
+class TraceRing:
+
+    # Kinds of records
+    DOORBELL = 0
+    REGISTER = 1
+    PCIE_CONFIG = 2
+    kind_names = ['doorbell', 'register', 'pcie_config']
+
+    # Each record is: timestamp (ns), address/offset, value, kind
+    record_struct = struct.Struct('<QQQI4x')
+
+    def __init__(self):
+        self.enabled = False
+        self.cfs_path = None
+        self.num_records = 0
+        self.buffer = bytearray()
+        self.count = 0
+
+    def enable(self, num_records=65536, cfs_path=None):
+        ''' Start tracing into a new ring of num_records records. If cfs_path is set the
+            ring is dumped to it when CSTS.CFS is seen
+        '''
+        self.num_records = num_records
+        self.buffer = bytearray(num_records * self.record_struct.size)
+        self.count = 0
+        self.cfs_path = cfs_path
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def record(self, kind, offset, value):
+        self.record_struct.pack_into(self.buffer,
+                                     (self.count % self.num_records) * self.record_struct.size,
+                                     time.perf_counter_ns(),
+                                     offset,
+                                     value & 0xFFFFFFFFFFFFFFFF,
+                                     kind)
+        self.count += 1
+
+    def record_field(self, struct_obj, name):
+        ''' Records the value of a field in a ctypes structure in memory, after it was written
+        '''
+        for field in struct_obj._fields_:
+            if field[0] == name:
+                address = ctypes.addressof(struct_obj) + getattr(type(struct_obj), name).offset
+                size = min(ctypes.sizeof(field[1]), 8)
+                value = int.from_bytes(ctypes.string_at(address, size), 'little')
+                self.record(TraceRing.REGISTER, address, value)
+                break
+
+    def records(self):
+        ''' Yields (timestamp_ns, kind, offset, value) for each record, oldest first
+        '''
+        if self.count <= self.num_records:
+            slots = range(self.count)
+        else:
+            start = self.count % self.num_records
+            slots = [(start + i) % self.num_records for i in range(self.num_records)]
+
+        for slot in slots:
+            timestamp, offset, value, kind = self.record_struct.unpack_from(
+                self.buffer, slot * self.record_struct.size)
+            yield timestamp, kind, offset, value
+
+    def dump(self, path):
+        with open(path, 'w') as fh:
+            for timestamp, kind, offset, value in self.records():
+                fh.write('{} {:12} 0x{:016x} 0x{:x}\n'.format(
+                    timestamp, self.kind_names[kind], offset, value))
+        logger.info('Dumped {} trace records to {}'.format(
+            min(self.count, self.num_records), path))
+
+    def dump_on_cfs(self):
+        if self.enabled and self.cfs_path is not None:
+            self.dump(self.cfs_path)
+
+
+# Trace shared by everything that writes registers or doorbells
+mmio_trace = TraceRing()
@@ -1,49 +1,83 @@
-import time
 import ctypes
 import threading
+import multiprocessing
 
 from types import SimpleNamespace
 
-from lone.nvme.device import NVMeDeviceCommon
+from lone.nvme.device import NVMeDeviceCommon, NVMeDeviceIntType
+from lone.injection import Injection
 from lone.system import Memory, MemoryLocation
 from lone.nvme.spec.registers.pcie_regs import PCIeRegistersDirect
 from lone.nvme.spec.registers.nvme_regs import NVMeRegistersDirect
 from nvsim.state import NVSimState
+from nvsim.state.subsystem import NVSimSubsystem
 from nvsim.reg_handlers.pcie import PCIeRegChangeHandler
 from nvsim.reg_handlers.nvme import NVMeRegChangeHandler
+from nvsim.shm import NVSimSharedMemory, NVSimSharedMemMgr
+from nvsim.interrupts import NVSimInterrupts
+from nvsim.arbitration import NVSimArbiter
+from nvsim.backoff import NVSimBackoff
+from lone.util.trace import mmio_trace
 
 import logging
 logger = logging.getLogger('nvsim_thread')
 
 
 class NVSimThread(threading.Thread):
-    def __init__(self, nvme_device, pcie_regs, nvme_regs):
+    def __init__(self, nvme_device, pcie_regs, nvme_regs, num_workers=0, storage='file',
+                 timing=None, iova_base=0, interrupts=None, arbiter=None, namespaces=None,
+                 storage_dir=None, backoff=None, cntlid=0, subsystem=None):
         threading.Thread.__init__(self)
         self.stop_event = threading.Event()
         self.exception = None
 
+        # Polls as fast as it can while busy, and backs off while idle
+        self.backoff = backoff if backoff is not None else NVSimBackoff()
+
         self.nvme_device = nvme_device
         self.pcie_regs = pcie_regs
         self.nvme_regs = nvme_regs
 
-        self.nvsim_state = NVSimState(pcie_regs, nvme_regs, nvme_device.injectors)
+        self.nvsim_state = NVSimState(pcie_regs, nvme_regs, nvme_device.injectors, storage,
+                                      timing, iova_base, interrupts, namespaces, storage_dir,
+                                      cntlid, subsystem)
         self.pcie_handler = PCIeRegChangeHandler(self.nvsim_state)
-        self.nvme_handler = NVMeRegChangeHandler(self.nvsim_state)
+        self.nvme_handler = NVMeRegChangeHandler(self.nvsim_state, num_workers, arbiter)
 
     def stop(self):
         self.stop_event.set()
+        self.backoff.wake()
+
+    def poll(self):
+        ''' Checks for changes to registers once and acts on them. Returns True if there was
+            anything to do
+        '''
+        self.pcie_handler()
+        return self.nvme_handler()
+
+    def failed(self, exception):
+        ''' Called from the except block when poll raises, the simulator stops after it
+        '''
+        logger.exception('NVSimThread EXCEPTION!')
+        self.exception = exception
+        self.nvme_regs.CSTS.CFS = 1
+        mmio_trace.dump_on_cfs()
+
+    def cleanup(self):
+        self.nvme_handler.stop_workers()
+        if self.nvsim_state.subsystem is not None:
+            self.nvsim_state.subsystem.detach(self.nvsim_state.cntlid)
+        del self.nvsim_state
+        del self.pcie_handler
+        del self.nvme_handler
 
     def run(self):
 
         while True:
             try:
-                # Check for changes to pcie registers and act on them
-                self.pcie_handler()
-                self.nvme_handler()
+                busy = self.poll()
             except Exception as e:
-                logger.exception('NVSimThread EXCEPTION!')
-                self.exception = e
-                self.nvme_regs.CSTS.CFS = 1
+                self.failed(e)
                 break
 
             # Exit if the main thread is not alive anymore
@@ -54,12 +88,149 @@ class NVSimThread(threading.Thread):
             if self.stop_event.is_set():
                 break
 
-            # Briefly yield so other tasks can run
-            time.sleep(1 / 1000000)
+            # Yield so other tasks can run, for longer the longer we have been idle
+            self.backoff.wait(busy)
 
-        del self.nvsim_state
-        del self.pcie_handler
-        del self.nvme_handler
+        self.cleanup()
+
+
+class NVSimController(NVSimThread):
+    ''' Simulator for the controller of a nvsim:N slot. It does not have a thread of its
+        own, NVSimSharedThread polls it along with every other nvsim:N controller. start,
+        stop, join and is_alive work as they do for a NVSimThread
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = False
+        self.done_event = threading.Event()
+
+    def start(self):
+        self.started = True
+        NVSimSharedThread.add(self)
+
+    def join(self, timeout=None):
+        self.done_event.wait(timeout)
+
+    def is_alive(self):
+        return self.started and not self.done_event.is_set()
+
+
+class NVSimSharedThread(threading.Thread):
+    ''' Polls every nvsim:N controller from one thread, in turn, so simulating many
+        controllers doesn't take a thread (and a share of the GIL) each. It runs while
+        there are controllers to simulate, adding one after that starts a new thread.
+        All of them sleep on the same NVSimBackoff while idle
+    '''
+    lock = threading.Lock()
+    thread = None
+    backoff = None
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='nvsim_shared', daemon=True)
+        self.controllers = []
+
+    @classmethod
+    def get_backoff(cls, max_sleep_us=1000):
+        ''' Returns the backoff nvsim:N controllers share, max_sleep_us only applies if
+            this creates it
+        '''
+        with cls.lock:
+            if cls.backoff is None:
+                cls.backoff = NVSimBackoff(max_sleep_us)
+            return cls.backoff
+
+    @classmethod
+    def add(cls, controller):
+        with cls.lock:
+            if cls.thread is None:
+                cls.thread = NVSimSharedThread()
+                cls.thread.start()
+            cls.thread.controllers.append(controller)
+
+    def remove(self, controller):
+        with NVSimSharedThread.lock:
+            self.controllers.remove(controller)
+        controller.cleanup()
+        controller.done_event.set()
+
+    def run(self):
+
+        while threading.main_thread().is_alive():
+            busy = False
+            for controller in list(self.controllers):
+                if controller.stop_event.is_set():
+                    self.remove(controller)
+                    continue
+
+                # A controller failing does not stop the others
+                try:
+                    busy |= controller.poll()
+                except Exception as e:
+                    controller.failed(e)
+                    self.remove(controller)
+
+            with NVSimSharedThread.lock:
+                if len(self.controllers) == 0:
+                    NVSimSharedThread.thread = None
+                    break
+
+            NVSimSharedThread.backoff.wait(busy)
+
+
+class NVSimProcessInjection(Injection):
+    ''' Injection for a simulator in a child process. The child has its own copy of the
+        injectors, so it would never see the ones registered by the host, and the host
+        would never see the child ack them. Registering one is an error instead
+    '''
+    def register(self, injector):
+        assert False, 'Injectors are not supported with process=True'
+
+
+class NVSimProcess:
+    ''' Runs the simulator in a child process so it does not compete with the host for the
+        GIL. The child is forked after the shared memory is mapped, so both processes see
+        the registers and host memory in shm. Injectors are not supported, see
+        NVSimProcessInjection
+    '''
+    def __init__(self, nvme_device, shm, num_workers=0, storage='file', timing=None,
+                 namespaces=None, storage_dir=None):
+        context = multiprocessing.get_context('fork')
+        self.stop_event = context.Event()
+        self.ready_event = context.Event()
+        self.nvme_device = nvme_device
+        self.process = context.Process(target=self.run,
+                                       args=(nvme_device, shm, num_workers, storage, timing,
+                                             namespaces, storage_dir),
+                                       name='nvsim',
+                                       daemon=True)
+
+    def start(self, timeout_s=10):
+        self.process.start()
+
+        # The child only notices register changes made after it looked at the registers
+        #  for the first time, so the host has to wait for it before touching them
+        assert self.ready_event.wait(timeout_s), (
+            'nvsim process did not start in {}s'.format(timeout_s))
+
+    def stop(self):
+        self.stop_event.set()
+        self.nvme_device.backoff.wake()
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def run(self, nvme_device, shm, num_workers, storage, timing, namespaces, storage_dir):
+        # Runs in the child process, as the simulator thread would
+        sim_thread = NVSimThread(nvme_device, shm.pcie_regs, shm.nvme_regs, num_workers,
+                                 storage, timing, shm.address, nvme_device.interrupts,
+                                 nvme_device.arbiter, namespaces, storage_dir,
+                                 nvme_device.backoff)
+        sim_thread.stop_event = self.stop_event
+        self.ready_event.set()
+        sim_thread.run()
 
 
 class NVMeSimulator(NVMeDeviceCommon):
@@ -79,10 +250,12 @@ class NVMeSimulator(NVMeDeviceCommon):
             self.iova_mgr = SimpleNamespace(reset=lambda: True)
 
         def malloc(self, size, client=None):
-            memory_obj = (ctypes.c_uint8 * size)()
+            # Start at a page boundary like real device memory does, PRP entries are
+            #  found by their offset into a page
+            memory_obj = (ctypes.c_uint8 * (size + self.page_size - 1))()
 
             # Append to our list so it stays allocated until we choose to free it
-            vaddr = ctypes.addressof(memory_obj)
+            vaddr = (ctypes.addressof(memory_obj) + self.page_size - 1) & ~(self.page_size - 1)
 
             # Create the memory location object from the allocated memory above
             mem = MemoryLocation(vaddr, vaddr, size, client)
@@ -127,6 +300,8 @@ class NVMeSimulator(NVMeDeviceCommon):
                   self.pcie_regs.PCICapabilityUnknown]:
             c = t.from_address(next_addr)
             c.CAP_ID = type(c)._cap_id_
+            if type(c) is self.pcie_regs.PCICapMSIX:
+                c.MXC.TS = NVMeSimulator.msix_table_size - 1
             next_ptr += ctypes.sizeof(c)
             next_addr += ctypes.sizeof(c)
             if type(c) is self.pcie_regs.PCICapabilityUnknown:
@@ -150,31 +325,107 @@ class NVMeSimulator(NVMeDeviceCommon):
             else:
                 c.NEXT_PTR = next_ptr
 
-    def __init__(self, pci_slot):
-        assert pci_slot == 'nvsim', (
+    # Number of MSI-X vectors the simulated device supports
+    msix_table_size = 32
+
+    def __init__(self, pci_slot, num_workers=0, storage='file', timing=None, process=False,
+                 shm_size=256 * 1024 * 1024, coalesce_threshold=1, coalesce_time_us=0,
+                 arbitration_burst=None, wrr_weights=(1, 1, 1), namespaces=None,
+                 storage_dir=None, idle_max_sleep_us=1000, subsystem=None):
+        ''' num_workers > 0 processes commands with an admin worker thread plus num_workers
+            IO worker threads, each owning a subset of the IO queue pairs. namespaces is a
+            list of dictionaries of NVSimNamespace arguments, one per namespace in nsid
+            order, for example [{'num_blocks': 0x1000, 'block_size': 4096}]. storage
+            ('file' or 'sparse') and storage_dir are the backend and directory for the
+            namespaces that don't set their own (see NVSimNamespace). timing is a
+            NVSimTimingModel, or a profile dictionary for one, that delays IO completions.
+            process=True runs the simulator in a child process, with registers and
+            shm_size bytes of host memory shared with it (see NVSimProcess).
+            coalesce_threshold and coalesce_time_us configure MSI-X interrupt coalescing
+            for IO queues (see NVSimInterrupts). arbitration_burst and wrr_weights configure
+            command arbitration (see NVSimArbiter). Workers process the queues they own in
+            turn without an arbiter, so they can't be used with num_workers.
+            idle_max_sleep_us is the longest the simulator sleeps between polls while idle
+            (see NVSimBackoff).
+
+            pci_slot 'nvsim:N' creates controller N (CNTLID N) of a multi-controller setup.
+            All nvsim:N controllers are simulated by a single thread (see NVSimSharedThread)
+            and share its idle backoff. Controllers given the same subsystem name are in the
+            same NVM subsystem and share namespaces (see NVSimSubsystem)
+        '''
+        assert pci_slot == 'nvsim' or pci_slot.startswith('nvsim:'), (
             'Trying to instantiate simulator with {} for pci_slot'.format(pci_slot))
         self.sim_thread_started = False
         self.pci_slot = pci_slot
 
+        # nvsim:N controllers, None for a plain nvsim controller
+        self.controller_index = None
+        if pci_slot != 'nvsim':
+            self.controller_index = int(pci_slot.split(':')[1])
+            assert not process, 'nvsim:N controllers are not supported out of process'
+        if subsystem is not None:
+            assert self.controller_index is not None, 'Only nvsim:N controllers have subsystems'
+        assert not num_workers or (arbitration_burst is None and wrr_weights == (1, 1, 1)), (
+            'Arbitration is not supported with num_workers')
+
+        # Out of process, registers and host memory live in shared memory. The child
+        #  needs the interrupt eventfds before it is forked, so create them now
+        self.shm = None
+        self.interrupts = NVSimInterrupts(NVMeSimulator.msix_table_size,
+                                          coalesce_threshold,
+                                          coalesce_time_us)
+        self.arbiter = NVSimArbiter(arbitration_burst, wrr_weights)
+        if self.controller_index is None:
+            self.backoff = NVSimBackoff(idle_max_sleep_us)
+        else:
+            self.backoff = NVSimSharedThread.get_backoff(idle_max_sleep_us)
+        if process:
+            self.shm = NVSimSharedMemory(PCIeRegistersDirect, NVMeRegistersDirect, shm_size)
+            self.interrupts.open()
+
         # Create the object to access PCIe registers, and init cababilities
-        self.pcie_regs = PCIeRegistersDirect()
+        self.pcie_regs = PCIeRegistersDirect() if self.shm is None else self.shm.pcie_regs
         self.initialize_pcie_caps()
         self.pcie_regs.init_capabilities()
 
         # Create the object to access NVMe registers
-        self.nvme_regs = NVMeRegistersDirect()
+        self.nvme_regs = NVMeRegistersDirect() if self.shm is None else self.shm.nvme_regs
 
         # Initialize common
         super().__init__()
+        if self.shm is not None:
+            self.injectors = NVSimProcessInjection()
 
         # Create our memory manager
-        self.mem_mgr = NVMeSimulator.SimMemMgr(self.mps)
+        if self.shm is None:
+            self.mem_mgr = NVMeSimulator.SimMemMgr(self.mps)
+        else:
+            self.mem_mgr = NVSimSharedMemMgr(self.shm, self.mps)
         self.queue_mem = []
 
-        # Start the simulator thread
-        self.sim_thread = NVSimThread(self, self.pcie_regs, self.nvme_regs)
-        self.sim_thread.daemon = True
+        # Start the simulator thread (or process), or add the controller to the shared thread
+        if self.controller_index is not None:
+            if subsystem is not None:
+                subsystem = NVSimSubsystem.get(subsystem)
+            else:
+                subsystem = NVSimSubsystem(pci_slot)
+            self.sim_thread = NVSimController(self, self.pcie_regs, self.nvme_regs, num_workers,
+                                              storage, timing, interrupts=self.interrupts,
+                                              arbiter=self.arbiter, namespaces=namespaces,
+                                              storage_dir=storage_dir, backoff=self.backoff,
+                                              cntlid=self.controller_index,
+                                              subsystem=subsystem)
+        elif self.shm is None:
+            self.sim_thread = NVSimThread(self, self.pcie_regs, self.nvme_regs, num_workers,
+                                          storage, timing, interrupts=self.interrupts,
+                                          arbiter=self.arbiter, namespaces=namespaces,
+                                          storage_dir=storage_dir, backoff=self.backoff)
+            self.sim_thread.daemon = True
+        else:
+            self.sim_thread = NVSimProcess(self, self.shm, num_workers, storage, timing,
+                                           namespaces, storage_dir)
         self.sim_thread.start()
+        self.sim_thread_started = True
         logger.info('NVSimThread started')
 
     def malloc_and_map_iova(self, num_bytes, direction, client='malloc_and_map_iova'):
@@ -191,9 +442,39 @@ class NVMeSimulator(NVMeDeviceCommon):
         # Free memory
         self.mem_mgr.free(memory)
 
+    def init_msix_interrupts(self, num_vectors, start=0):
+        assert start + num_vectors <= self.interrupts.num_vectors, (
+            'nvsim only supports {} MSI-X vectors'.format(self.interrupts.num_vectors))
+        self.num_msix_vectors = start + num_vectors
+        self.interrupts.open()
+        self.int_type = NVMeDeviceIntType.MSIX
+        self.get_completions = self.get_msix_completions
+
+    def post_command(self, command):
+        super().post_command(command)
+
+        # Don't wait for the simulator to poll the doorbell we just rang
+        self.backoff.wake()
+
+    def get_msix_vector_pending_count(self, vector):
+        return self.interrupts.pending_count(vector)
+
     def __del__(self):
         # Stop and join the thread when the nvsim object goes out of scope (and eventually
         #   gets gc'd because at that point it should stop accessing any memory!
         if self.sim_thread_started:
             self.sim_thread.stop()
             self.sim_thread.join()
+
+        # Nothing can signal the interrupt eventfds once the simulator is done
+        if hasattr(self, 'sim_thread') and not self.sim_thread.is_alive():
+            self.interrupts.close()
+            if self.backoff is not NVSimSharedThread.backoff:
+                self.backoff.close()
+
+            # Same for the shared memory the child process used, once nothing points into it
+            if self.shm is not None:
+                for regs in ['pcie_regs', 'nvme_regs']:
+                    if hasattr(self, regs):
+                        delattr(self, regs)
+                self.shm.close()
@@ -0,0 +1,78 @@
+''' Command arbitration for nvsim. The admin SQ is always served first, then IO SQs are
+    served with the arbitration mechanism the host selected in CC.AMS.
+'''
+import logging
+logger = logging.getLogger('nvsim_arbitration')
+
+
+class NVSimArbiter:
+    ''' Decides, for each round, which SQs nvsim fetches commands from and how many.
+
+        Round Robin (CC.AMS = 0): every busy IO SQ gets up to burst commands per round, and
+            the SQ served first rotates every round.
+        Weighted Round Robin with Urgent Priority Class (CC.AMS = 1): urgent SQs (QPRIO 0)
+            get up to burst commands each, and the weighted classes are only served in
+            rounds without urgent commands. High, medium and low priority SQs (QPRIO 1-3)
+            then share their class' weight in commands, up to burst at a time each.
+
+        burst is the Arbitration Burst in commands, None for no limit. weights are the
+        number of commands for the high, medium and low priority classes in a round.
+    '''
+    AMS_RR = 0
+    AMS_WRR = 1
+
+    QPRIO_URGENT = 0
+    QPRIO_HIGH = 1
+    QPRIO_MEDIUM = 2
+    QPRIO_LOW = 3
+
+    def __init__(self, burst=None, weights=(1, 1, 1)):
+        self.burst = burst
+        self.weights = weights
+
+        # Position of the next SQ to serve first in each class
+        self.rr_next = {}
+
+    def rotate(self, key, queues):
+        if len(queues) == 0:
+            return queues
+        start = self.rr_next.get(key, 0) % len(queues)
+        self.rr_next[key] = start + 1
+        return queues[start:] + queues[:start]
+
+    def weighted(self, queues, weight):
+        ''' Splits weight commands between queues, up to burst at a time each
+        '''
+        schedule = []
+        for sq, cq in queues:
+            if weight <= 0:
+                break
+            num_commands = min(sq.num_entries(), weight)
+            if self.burst is not None:
+                num_commands = min(num_commands, self.burst)
+            schedule.append((sq, cq, num_commands))
+            weight -= num_commands
+        return schedule
+
+    def schedule(self, busy_queues, ams):
+        ''' Returns the (sq, cq, max_commands) to process this round, in order. max_commands
+            is None for no limit
+        '''
+        schedule = [(sq, cq, None) for sq, cq in busy_queues if sq.qid == 0]
+        io_queues = [(sq, cq) for sq, cq in busy_queues if sq.qid != 0]
+
+        if ams == NVSimArbiter.AMS_WRR:
+            urgent = [(sq, cq) for sq, cq in io_queues if sq.qprio == NVSimArbiter.QPRIO_URGENT]
+            schedule += [(sq, cq, self.burst) for sq, cq in self.rotate('urgent', urgent)]
+
+            # Urgent commands have strict priority over the weighted classes
+            if len(urgent) == 0:
+                for qprio, weight in zip([NVSimArbiter.QPRIO_HIGH,
+                                          NVSimArbiter.QPRIO_MEDIUM,
+                                          NVSimArbiter.QPRIO_LOW], self.weights):
+                    queues = [(sq, cq) for sq, cq in io_queues if sq.qprio == qprio]
+                    schedule += self.weighted(self.rotate(qprio, queues), weight)
+        else:
+            schedule += [(sq, cq, self.burst) for sq, cq in self.rotate('rr', io_queues)]
+
+        return schedule
@@ -0,0 +1,45 @@
+import os
+import select
+import time
+
+import logging
+logger = logging.getLogger('nvsim_backoff')
+
+
+class NVSimBackoff:
+    ''' Adaptive polling for the simulator loop. While there is work to do the loop spins,
+        only yielding to other threads. Once idle, it sleeps for twice as long every time
+        it finds nothing to do, up to max_sleep_us.
+
+        The host wakes it up right away with wake(), for example when it rings a doorbell.
+        That writes to an eventfd the simulator sleeps on, so it works across processes
+    '''
+    def __init__(self, max_sleep_us=1000, min_sleep_us=1):
+        self.max_sleep_us = max_sleep_us
+        self.min_sleep_us = min_sleep_us
+        self.sleep_us = 0
+        self.eventfd = os.eventfd(0, flags=os.EFD_NONBLOCK)
+
+    def wake(self):
+        # Nothing to wake once closed, the simulator is gone by then
+        if self.eventfd is not None:
+            os.eventfd_write(self.eventfd, 1)
+
+    def wait(self, busy):
+        ''' Called once per simulator loop, busy is True if the loop did any work
+        '''
+        if busy:
+            self.sleep_us = 0
+            time.sleep(0)
+            return
+
+        self.sleep_us = min(self.max_sleep_us, max(self.min_sleep_us, self.sleep_us * 2))
+        readable, _, _ = select.select([self.eventfd], [], [], self.sleep_us / 1000000)
+        if readable:
+            os.eventfd_read(self.eventfd)
+            self.sleep_us = 0
+
+    def close(self):
+        if self.eventfd is not None:
+            os.close(self.eventfd)
+            self.eventfd = None
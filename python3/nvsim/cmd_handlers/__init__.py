@@ -1,5 +1,4 @@
 from lone.nvme.spec.structures import CQE
-from lone.nvme.spec.structures import Generic
 
 import logging
 logger = logging.getLogger('nvsim_cmd_h')
@@ -18,16 +17,26 @@ class NvsimCommandHandlers:
 
 class NvsimCommandHandler:
 
-    def complete(self, command, sq, cq, status_code):
-        # Complete the command
+    def complete(self, command, sq, cq, status_code, result=0, delay_us=0):
+        # Complete the command. result is the command specific result in DW0, and DW1
+        #  for the upper 32 bits of a 64 bit one. delay_us holds the completion back
+        #  for that much longer
         cqe = CQE()
+        cqe.CMD_SPEC = result & 0xFFFFFFFF
+        cqe.RSVD_0 = result >> 32
         cqe.CID = command.CID
-        if status_code.cmd_type != Generic:
-            cqe.SF.SCT = 1
+        cqe.SF.SCT = status_code.sct
         cqe.SF.SC = int(status_code)
         cqe.SQID = sq.qid
         cqe.SQHD = sq.head.value
-        cq.post_completion(cqe)
+
+        # With a timing model or an injected delay the completion is posted once it is due
+        if cq.scheduler is None or (cq.scheduler.timing_model is None and delay_us == 0):
+            cq.post_completion(cqe)
+        else:
+            cq.scheduler.schedule(command, cqe, sq, cq, delay_us)
 
         if status_code.failure:
+            if cq.health is not None:
+                cq.health.error(command, sq, status_code)
             logger.info('Command OPC 0x{:x} resulted in "{}"'.format(command.OPC, status_code))
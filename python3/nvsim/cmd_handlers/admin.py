@@ -6,21 +6,28 @@ from lone.nvme.spec.prp import PRP
 from lone.nvme.spec.commands.status_codes import status_codes
 from lone.system import MemoryLocation
 from lone.nvme.device import NVMeDeviceCommon
-from lone.nvme.spec.queues import NVMeSubmissionQueue, NVMeCompletionQueue
+from lone.nvme.spec.queues import NVMeHeadTail, NVMeSubmissionQueue
+from nvsim.queues import NVSimCompletionQueue
 
 from lone.nvme.spec.commands.admin.identify import (Identify,
                                                     IdentifyData,
                                                     IdentifyController,
                                                     IdentifyNamespace,
                                                     IdentifyNamespaceList,
-                                                    IdentifyUUIDList)
+                                                    IdentifyUUIDList,
+                                                    IdentifyNamespaceZoned,
+                                                    IdentifyControllerZoned,
+                                                    IdentifyIoCmdSet)
 from lone.nvme.spec.commands.admin.create_io_completion_q import CreateIOCompletionQueue
 from lone.nvme.spec.commands.admin.create_io_submission_q import CreateIOSubmissionQueue
 from lone.nvme.spec.commands.admin.delete_io_completion_q import DeleteIOCompletionQueue
 from lone.nvme.spec.commands.admin.delete_io_submission_q import DeleteIOSubmissionQueue
 from lone.nvme.spec.commands.admin.get_log_page import GetLogPage
 from lone.nvme.spec.commands.admin.get_log_page import GetLogPageSupportedLogPages
+from lone.nvme.spec.commands.admin.get_log_page import GetLogPageErrorInformation
+from lone.nvme.spec.commands.admin.get_log_page import GetLogPageSMART
 from lone.nvme.spec.commands.admin.format_nvm import FormatNVM
+from lone.nvme.spec.commands.admin.doorbell_buffer_config import DoorbellBufferConfig
 
 import logging
 logger = logging.getLogger('nvsim_admin')
@@ -37,7 +44,8 @@ class NVSimIdentify:
             self.__class__.__name__, id_cmd.CNS))
 
         # Create the PRP at the location from the command
-        prp = PRP(IdentifyData.size, nvsim_state.mps).from_address(id_cmd.DPTR.PRP.PRP1)
+        prp = PRP(IdentifyData.size, nvsim_state.mps).from_address(
+            id_cmd.DPTR.PRP.PRP1, iova_base=nvsim_state.iova_base)
 
         # Based on CNS, we have to simulate different structures for responses
         if id_cmd.CNS == IdentifyController().CNS:
@@ -59,6 +67,27 @@ class NVSimIdentify:
             prp.set_data_buffer(bytearray(nvsim_state.identify_uuid_list_data()))
             status_code = status_codes['Successful Completion']
 
+        elif (id_cmd.CNS == IdentifyNamespaceZoned().CNS and
+              id_cmd.CSI == IdentifyNamespaceZoned().CSI):
+            try:
+                id_ns_zoned_data = nvsim_state.identify_namespace_zoned_data(id_cmd.NSID)
+                if id_ns_zoned_data is None:
+                    status_code = status_codes['Invalid Field in Command']
+                else:
+                    prp.set_data_buffer(bytearray(id_ns_zoned_data))
+                    status_code = status_codes['Successful Completion']
+            except IndexError:
+                status_code = status_codes['Invalid Namespace or Format']
+
+        elif (id_cmd.CNS == IdentifyControllerZoned().CNS and
+              id_cmd.CSI == IdentifyControllerZoned().CSI):
+            prp.set_data_buffer(bytearray(nvsim_state.identify_controller_zoned_data()))
+            status_code = status_codes['Successful Completion']
+
+        elif id_cmd.CNS == IdentifyIoCmdSet().CNS:
+            prp.set_data_buffer(bytearray(nvsim_state.identify_io_cmd_set_data()))
+            status_code = status_codes['Successful Completion']
+
         else:
             # Return invalid field in command in SF.SC
             logger.info('Identify command with CNS: 0x{:x} not supported'.format(id_cmd.CNS))
@@ -80,8 +109,13 @@ class NVSimCreateIOCompletionQueue:
             self.complete(command, sq, cq, status_codes['Invalid Field in Command'])
             return
 
+        if ccq_cmd.IEN and ccq_cmd.IV >= nvsim_state.num_msix_vectors():
+            self.complete(command, sq, cq, status_codes['Invalid Interrupt Vector',
+                                                        CreateIOCompletionQueue])
+            return
+
         # Create the memory object for the queue location
-        q_mem = MemoryLocation(ccq_cmd.DPTR.PRP.PRP1,
+        q_mem = MemoryLocation(nvsim_state.vaddr(ccq_cmd.DPTR.PRP.PRP1),
                                ccq_cmd.DPTR.PRP.PRP1,
                                (ccq_cmd.QSIZE + 1) * NVMeDeviceCommon.cq_entry_size,
                                'nvsim_iocq')
@@ -90,13 +124,15 @@ class NVSimCreateIOCompletionQueue:
         nvsim_state.check_mem_access(q_mem)
 
         # Add IO queue to nvsim_state's queue mgr
-        new_cq = NVMeCompletionQueue(q_mem,
-                                     ccq_cmd.QSIZE + 1,
-                                     NVMeDeviceCommon.cq_entry_size,
-                                     ccq_cmd.QID,
-                                     (ctypes.addressof(
-                                         nvsim_state.nvme_regs.SQNDBS[0]) +
-                                         ((ccq_cmd.QID * 8) + 4)))
+        new_cq = NVSimCompletionQueue(q_mem,
+                                      ccq_cmd.QSIZE + 1,
+                                      NVMeDeviceCommon.cq_entry_size,
+                                      ccq_cmd.QID,
+                                      nvsim_state.cq_head_doorbell(ccq_cmd.QID),
+                                      nvsim_state.scheduler,
+                                      ccq_cmd.IV if ccq_cmd.IEN else None,
+                                      nvsim_state.interrupts,
+                                      nvsim_state.health)
 
         # Keep it in our state tracker until it can be used with a SQ
         nvsim_state.completion_queues.append(new_cq)
@@ -112,7 +148,7 @@ class NVSimCreateIOSubmissionQueue:
         csq_cmd = CreateIOSubmissionQueue.from_buffer(command)
 
         # Create the memory object for the queue location
-        q_mem = MemoryLocation(csq_cmd.DPTR.PRP.PRP1,
+        q_mem = MemoryLocation(nvsim_state.vaddr(csq_cmd.DPTR.PRP.PRP1),
                                csq_cmd.DPTR.PRP.PRP1,
                                (csq_cmd.QSIZE + 1) * NVMeDeviceCommon.sq_entry_size,
                                'nvsim_iosq')
@@ -125,9 +161,9 @@ class NVSimCreateIOSubmissionQueue:
                                      csq_cmd.QSIZE + 1,
                                      NVMeDeviceCommon.sq_entry_size,
                                      csq_cmd.QID,
-                                     (ctypes.addressof(
-                                         nvsim_state.nvme_regs.SQNDBS[0]) +
-                                         ((csq_cmd.QID * 8))))
+                                     nvsim_state.sq_tail_doorbell(csq_cmd.QID))
+        new_sq.qprio = csq_cmd.QPRIO
+
         # Find the associated CQ
         cqs = [c for c in nvsim_state.completion_queues if c.qid == csq_cmd.CQID]
         if len(cqs) == 0:
@@ -174,57 +210,98 @@ class NVSimDeleteIOSubmissionQueue:
 class NVSimGetLogPage:
     OPC = GetLogPage().OPC
 
-    def __call__(self, nvsim_state, command, sq, cq):
-        glp_cmd = GetLogPage.from_buffer(command)
+    # Log pages we support
+    supported_lids = [GetLogPageSupportedLogPages().LID,
+                      GetLogPageErrorInformation().LID,
+                      GetLogPageSMART().LID]
 
-        # Whick log id are we servicing?
-        if glp_cmd.LID == 0:
+    def log_page_data(self, nvsim_state, lid):
+        if lid == GetLogPageSupportedLogPages().LID:
+            data = GetLogPageSupportedLogPages.data_in_type()
+            for supported_lid in self.supported_lids:
+                data.LIDS[supported_lid].LSUPP = 1
+            return data
 
-            # Get the Supported Log Pages command
-            glp_cmd = GetLogPageSupportedLogPages.from_buffer(command)
+        elif lid == GetLogPageErrorInformation().LID:
+            return nvsim_state.health.error_information_data()
 
-            # Figure out how many bytes are we transferring
-            num_bytes = (((glp_cmd.NUMDU << 16) | glp_cmd.NUMDL) + 1) * 4
+        else:
+            return nvsim_state.health.smart_data()
 
-            # Claim support for all pages, index offset supported
-            data_out = glp_cmd.data_in_type()
-            for lid in range(256):
-                data_out.LIDS[lid].LSUPP = 1
-                data_out.LIDS[lid].IOS = 1
-            data_out = bytearray(data_out)
+    def __call__(self, nvsim_state, command, sq, cq):
+        glp_cmd = GetLogPage.from_buffer(command)
 
-            # Offset
-            offset = (glp_cmd.LPOU << 32) | (glp_cmd.LPOL & 0xFFFFFFFF)
+        # Whick log id are we servicing?
+        if glp_cmd.LID not in self.supported_lids:
+            return self.complete(command, sq, cq, status_codes['Invalid Log Page', GetLogPage])
+        log_data = bytearray(self.log_page_data(nvsim_state, glp_cmd.LID))
+
+        # Figure out how many bytes are we transferring, and from what byte offset
+        num_bytes = (((glp_cmd.NUMDU << 16) | glp_cmd.NUMDL) + 1) * 4
+        offset = (glp_cmd.LPOU << 32) | (glp_cmd.LPOL & 0xFFFFFFFF)
+
+        # Offsets are in bytes, dword aligned and inside the log. Index offsets (OT = 1)
+        #  are not supported
+        if glp_cmd.OT == 1 or offset % 4 or offset >= len(log_data):
+            return self.complete(command, sq, cq, status_codes['Invalid Field in Command'])
+
+        # Anything past the end of the log reads as zeros
+        data_out = log_data[offset:offset + num_bytes]
+        data_out += bytes(num_bytes - len(data_out))
+
+        # Copy data to the host's PRP
+        prp = PRP(num_bytes, nvsim_state.mps).from_address(glp_cmd.DPTR.PRP.PRP1,
+                                                           glp_cmd.DPTR.PRP.PRP2,
+                                                           nvsim_state.iova_base)
+        prp.set_data_buffer(data_out)
+
+        # Complete command
+        self.complete(command, sq, cq, status_codes['Successful Completion'])
 
-            # Did the host ask for a byte offset or an index offset?
-            if glp_cmd.OT == 0:
-                # Offset in bytes
-                data_out = data_out[offset:]
-            else:
-                # Offset in structure index
-                logger.error('OT = 1 not yet implemented!')
-                return self.complete(command, sq, cq, status_codes['Invalid Field in Command'])
 
-            # Copy data to the host's PRP
-            prp = PRP(num_bytes, nvsim_state.mps).from_address(glp_cmd.DPTR.PRP.PRP1,
-                                                               glp_cmd.DPTR.PRP.PRP2)
-            prp.set_data_buffer(data_out)
+class NVSimFormat:
+    OPC = FormatNVM().OPC
 
-            # Complete command
-            self.complete(command, sq, cq, status_codes['Successful Completion'])
+    def __call__(self, nvsim_state, command, sq, cq):
+        fmt_cmd = FormatNVM.from_buffer(command)
 
-        else:
-            self.complete(command, sq, cq, status_codes['Invalid Log Page', GetLogPage])
+        # All user data is gone after a format
+        nvsim_state.namespaces[fmt_cmd.NSID].format()
 
+        self.complete(command, sq, cq, status_codes['Successful Completion'])
 
-class NVSimFormat:
-    OPC = FormatNVM().OPC
+
+class NVSimDoorbellBufferConfig:
+    OPC = DoorbellBufferConfig().OPC
 
     def __call__(self, nvsim_state, command, sq, cq):
-        fmt_cmd = FormatNVM.from_buffer(command)
+        dbbc_cmd = DoorbellBufferConfig.from_buffer(command)
 
-        # Re-initialize our backend storage
-        nvsim_state.namespaces[fmt_cmd.NSID].init_storage()
+        # Both buffers are required
+        if dbbc_cmd.DPTR.PRP.PRP1 == 0 or dbbc_cmd.DPTR.PRP.PRP2 == 0:
+            self.complete(command, sq, cq, status_codes['Invalid Field in Command'])
+            return
+        shadow_addr = nvsim_state.vaddr(dbbc_cmd.DPTR.PRP.PRP1)
+        eventidx_addr = nvsim_state.vaddr(dbbc_cmd.DPTR.PRP.PRP2)
+
+        # Make sure we can access the buffers before using them. The shadow buffer already
+        #  holds the host's doorbell values, so only read it instead of using check_mem_access
+        ctypes.string_at(shadow_addr, nvsim_state.mps)
+        nvsim_state.check_mem_access(MemoryLocation(eventidx_addr,
+                                                    eventidx_addr,
+                                                    nvsim_state.mps,
+                                                    'nvsim_dbbuf_eventidx'))
+        ctypes.memset(eventidx_addr, 0, nvsim_state.mps)
+
+        nvsim_state.dbbuf_shadow = shadow_addr
+        nvsim_state.dbbuf_eventidx = eventidx_addr
+
+        # From now on IO queues read their doorbells from the shadow buffer
+        for (sqid, cqid), (io_sq, io_cq) in nvsim_state.queue_mgr.queue_pairs():
+            if sqid != 0 and io_sq is not None:
+                io_sq.tail = NVMeHeadTail(io_sq.entries, nvsim_state.sq_tail_doorbell(sqid))
+        for io_cq in nvsim_state.completion_queues:
+            io_cq.head = NVMeHeadTail(io_cq.entries, nvsim_state.cq_head_doorbell(io_cq.qid))
 
         self.complete(command, sq, cq, status_codes['Successful Completion'])
 
@@ -239,5 +316,6 @@ for handler in [
     NVSimDeleteIOSubmissionQueue,
     NVSimGetLogPage,
     NVSimFormat,
+    NVSimDoorbellBufferConfig,
 ]:
     admin_handlers.register(handler)
@@ -1,8 +1,20 @@
+import ctypes
+
 from nvsim.cmd_handlers import NvsimCommandHandlers
 from lone.nvme.spec.commands.status_codes import status_codes
-from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.prp import walk_prp
 from lone.nvme.spec.commands.nvm.read import Read
 from lone.nvme.spec.commands.nvm.write import Write
+from lone.nvme.spec.commands.nvm.flush import Flush
+from lone.nvme.spec.commands.nvm.compare import Compare
+from lone.nvme.spec.commands.nvm.write_zeroes import WriteZeroes
+from lone.nvme.spec.commands.nvm.dataset_management import (DatasetManagement,
+                                                            DatasetManagementRange)
+from lone.nvme.spec.commands.zns.zone_management_send import ZoneManagementSend
+from lone.nvme.spec.commands.zns.zone_management_receive import (ZoneManagementReceive,
+                                                                 ZoneDescriptor,
+                                                                 ZoneReportData)
+from lone.nvme.spec.commands.zns.zone_append import ZoneAppend
 
 import logging
 logger = logging.getLogger('nvsim_nvm')
@@ -11,7 +23,7 @@ logger = logging.getLogger('nvsim_nvm')
 class NVSimWrite:
     OPC = Write().OPC
 
-    def __call__(self, nvsim_state, command, sq, cq):
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
         wr_cmd = Write.from_buffer(command)
         ns = nvsim_state.namespaces[wr_cmd.NSID]
 
@@ -23,24 +35,31 @@ class NVSimWrite:
             status_code = status_codes['LBA Out of Range']
 
         else:
-            # Make a PRP object from the command's information
-            prp = PRP((wr_cmd.NLB + 1) * ns.block_size, nvsim_state.mps).from_address(
-                wr_cmd.DPTR.PRP.PRP1,
-                wr_cmd.DPTR.PRP.PRP2)
+            # Zoned namespaces only take writes at a zone's write pointer
+            zone_status, _ = ns.zone_write(wr_cmd.SLBA, wr_cmd.NLB + 1)
+            if zone_status is not None:
+                status_code = status_codes[zone_status, Write]
 
-            # Write data to nvsim's storage
-            ns.write(wr_cmd.SLBA, wr_cmd.NLB + 1, prp)
+            else:
+                # Get the (address, length) of each data segment from the command's PRPs
+                segments = walk_prp(wr_cmd.DPTR.PRP.PRP1, wr_cmd.DPTR.PRP.PRP2,
+                                    (wr_cmd.NLB + 1) * ns.block_size, nvsim_state.mps,
+                                    nvsim_state.iova_base)
 
-            status_code = status_codes['Successful Completion']
+                # Write data to nvsim's storage, straight from each PRP segment
+                ns.write(wr_cmd.SLBA, wr_cmd.NLB + 1, segments)
+                nvsim_state.health.host_write((wr_cmd.NLB + 1) * ns.block_size)
+
+                status_code = status_codes['Successful Completion']
 
         # Complete the command
-        self.complete(command, sq, cq, status_code)
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
 
 
 class NVSimRead:
     OPC = Read().OPC
 
-    def __call__(self, nvsim_state, command, sq, cq):
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
         rd_cmd = Read.from_buffer(command)
         ns = nvsim_state.namespaces[rd_cmd.NSID]
 
@@ -53,18 +72,290 @@ class NVSimRead:
 
         else:
 
-            # Make a PRP object from the command's information
-            prp = PRP((rd_cmd.NLB + 1) * ns.block_size, nvsim_state.mps).from_address(
-                rd_cmd.DPTR.PRP.PRP1,
-                rd_cmd.DPTR.PRP.PRP2)
+            # Get the (address, length) of each data segment from the command's PRPs
+            segments = walk_prp(rd_cmd.DPTR.PRP.PRP1, rd_cmd.DPTR.PRP.PRP2,
+                                (rd_cmd.NLB + 1) * ns.block_size, nvsim_state.mps,
+                                nvsim_state.iova_base)
+
+            # Read data from nvsim's storage, straight into each PRP segment
+            ns.read(rd_cmd.SLBA, rd_cmd.NLB + 1, segments)
+            nvsim_state.health.host_read((rd_cmd.NLB + 1) * ns.block_size)
+
+            status_code = status_codes['Successful Completion']
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimFlush:
+    OPC = Flush().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        logger.debug('Flush NSID: 0x{:x}'.format(command.NSID))
+
+        # NSID 0xFFFFFFFF flushes all namespaces
+        if command.NSID == 0xFFFFFFFF:
+            for ns in nvsim_state.namespaces[1:]:
+                ns.flush()
+            status_code = status_codes['Successful Completion']
+
+        elif 0 < command.NSID < len(nvsim_state.namespaces):
+            nvsim_state.namespaces[command.NSID].flush()
+            status_code = status_codes['Successful Completion']
+
+        else:
+            status_code = status_codes['Invalid Namespace or Format']
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimCompare:
+    OPC = Compare().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        cmp_cmd = Compare.from_buffer(command)
+        ns = nvsim_state.namespaces[cmp_cmd.NSID]
+
+        logger.debug('Compare SLBA: 0x{:x} NLB: {} NSID: {}'.format(
+            cmp_cmd.SLBA, cmp_cmd.NLB, cmp_cmd.NSID))
+
+        # Is this in range for the ns's LBA?
+        if (cmp_cmd.SLBA + cmp_cmd.NLB + 1) > ns.num_lbas:
+            status_code = status_codes['LBA Out of Range']
+
+        else:
+            # Get the (address, length) of each data segment from the command's PRPs
+            segments = walk_prp(cmp_cmd.DPTR.PRP.PRP1, cmp_cmd.DPTR.PRP.PRP2,
+                                (cmp_cmd.NLB + 1) * ns.block_size, nvsim_state.mps,
+                                nvsim_state.iova_base)
+
+            # Compare nvsim's storage against each PRP segment, without copying either
+            nvsim_state.health.host_read((cmp_cmd.NLB + 1) * ns.block_size)
+            if ns.compare(cmp_cmd.SLBA, cmp_cmd.NLB + 1, segments):
+                status_code = status_codes['Successful Completion']
+            else:
+                status_code = status_codes['Compare Failure', Compare]
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimWriteZeroes:
+    OPC = WriteZeroes().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        wz_cmd = WriteZeroes.from_buffer(command)
+        ns = nvsim_state.namespaces[wz_cmd.NSID]
+
+        logger.debug('Write Zeroes SLBA: 0x{:x} NLB: {} NSID: {} DEAC: {}'.format(
+            wz_cmd.SLBA, wz_cmd.NLB, wz_cmd.NSID, wz_cmd.DEAC))
+
+        # Is this in range for the ns's LBA?
+        if (wz_cmd.SLBA + wz_cmd.NLB + 1) > ns.num_lbas:
+            status_code = status_codes['LBA Out of Range']
+
+        else:
+            # Zoned namespaces only take writes at a zone's write pointer
+            zone_status, _ = ns.zone_write(wz_cmd.SLBA, wz_cmd.NLB + 1)
+            if zone_status is not None:
+                status_code = status_codes[zone_status, WriteZeroes]
+
+            else:
+                # Only the zeroed range is recorded, unless the host also asked for it
+                #  to be deallocated
+                if wz_cmd.DEAC:
+                    ns.deallocate(wz_cmd.SLBA, wz_cmd.NLB + 1)
+                else:
+                    ns.write_zeroes(wz_cmd.SLBA, wz_cmd.NLB + 1)
+
+                # Write Zeroes counts as a host write, but transfers no data
+                nvsim_state.health.host_write(0)
+
+                status_code = status_codes['Successful Completion']
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimDatasetManagement:
+    OPC = DatasetManagement().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        dsm_cmd = DatasetManagement.from_buffer(command)
+        ns = nvsim_state.namespaces[dsm_cmd.NSID]
+
+        logger.debug('Dataset Management NR: {} AD: {} NSID: {}'.format(
+            dsm_cmd.NR, dsm_cmd.AD, dsm_cmd.NSID))
+
+        # Gather the ranges from the command's PRPs, they may cross into the page at PRP2
+        ranges = (DatasetManagementRange * (dsm_cmd.NR + 1))()
+        offset = 0
+        for address, length in walk_prp(dsm_cmd.DPTR.PRP.PRP1, dsm_cmd.DPTR.PRP.PRP2,
+                                        ctypes.sizeof(ranges), nvsim_state.mps,
+                                        nvsim_state.iova_base):
+            ctypes.memmove(ctypes.addressof(ranges) + offset, address, length)
+            offset += length
+
+        # Check all ranges before deallocating any of them
+        if any((r.SLBA + r.NLB) > ns.num_lbas for r in ranges):
+            status_code = status_codes['LBA Out of Range']
+
+        else:
+            # Integral Dataset for Read/Write are only hints, nothing to do for them
+            if dsm_cmd.AD:
+                for r in ranges:
+                    ns.deallocate(r.SLBA, r.NLB)
+
+            status_code = status_codes['Successful Completion']
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimZoneManagementSend:
+    OPC = ZoneManagementSend().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        zms_cmd = ZoneManagementSend.from_buffer(command)
+        ns = nvsim_state.namespaces[zms_cmd.NSID]
+
+        logger.debug('Zone Management Send SLBA: 0x{:x} ZSA: 0x{:x} SEL: {} NSID: {}'.format(
+            zms_cmd.SLBA, zms_cmd.ZSA, zms_cmd.SEL, zms_cmd.NSID))
+
+        if not ns.zoned:
+            status_code = status_codes['Invalid Command Opcode']
+
+        # Zone descriptor extensions are not supported
+        elif zms_cmd.ZSA not in ns.SELECT_ALL:
+            status_code = status_codes['Invalid Field in Command']
+
+        # SLBA is ignored with Select All, otherwise it has to be a zone's first LBA
+        elif not zms_cmd.SEL and zms_cmd.SLBA >= ns.num_lbas:
+            status_code = status_codes['LBA Out of Range']
+
+        elif not zms_cmd.SEL and zms_cmd.SLBA % ns.zone_size:
+            status_code = status_codes['Invalid Field in Command']
+
+        else:
+            zone_status = ns.zone_management(zms_cmd.SLBA // ns.zone_size, zms_cmd.ZSA,
+                                             zms_cmd.SEL)
+            if zone_status is not None:
+                status_code = status_codes[zone_status, ZoneManagementSend]
+            else:
+                status_code = status_codes['Successful Completion']
+
+        # Complete the command
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+
+class NVSimZoneManagementReceive:
+    OPC = ZoneManagementReceive().OPC
+
+    # A report starts with the number of zones, zone descriptors start after this many bytes
+    report_header_size = ZoneReportData.ZDS.offset
 
-            # Read data from nvsim's storage
-            ns.read(rd_cmd.SLBA, rd_cmd.NLB + 1, prp)
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        zmr_cmd = ZoneManagementReceive.from_buffer(command)
+        ns = nvsim_state.namespaces[zmr_cmd.NSID]
+        num_bytes = (zmr_cmd.NUMD + 1) * 4
+
+        logger.debug('Zone Management Receive SLBA: 0x{:x} ZRA: 0x{:x} ZRASF: 0x{:x} '
+                     'NSID: {}'.format(zmr_cmd.SLBA, zmr_cmd.ZRA, zmr_cmd.ZRASF, zmr_cmd.NSID))
+
+        if not ns.zoned:
+            status_code = status_codes['Invalid Command Opcode']
+
+        elif zmr_cmd.SLBA >= ns.num_lbas:
+            status_code = status_codes['LBA Out of Range']
+
+        # Only Report Zones, into a buffer with room for at least the report's header
+        elif (zmr_cmd.ZRA != ZoneManagementReceive.REPORT_ZONES or
+              zmr_cmd.ZRASF > ZoneManagementReceive.LIST_OFFLINE or
+              num_bytes < self.report_header_size):
+            status_code = status_codes['Invalid Field in Command']
+
+        else:
+            # The report is a header with the number of zones, then as many zone descriptors
+            #  as fit, built in place
+            report = bytearray(num_bytes)
+            num_descriptors = (num_bytes - self.report_header_size) // ctypes.sizeof(ZoneDescriptor)
+            descriptors = (ZoneDescriptor * num_descriptors).from_buffer(report,
+                                                                         self.report_header_size)
+            num_reported, num_zones = ns.report_zones(
+                zmr_cmd.SLBA // ns.zone_size, self.zone_states[zmr_cmd.ZRASF], descriptors)
+
+            # With Partial Report the number of zones is only the ones in the report
+            ctypes.c_uint64.from_buffer(report).value = (
+                num_reported if zmr_cmd.PR else num_zones)
+
+            # Copy it to the host, one PRP segment at a time, straight from the report
+            report_data = (ctypes.c_char * num_bytes).from_buffer(report)
+            offset = 0
+            for address, length in walk_prp(zmr_cmd.DPTR.PRP.PRP1, zmr_cmd.DPTR.PRP.PRP2,
+                                            num_bytes, nvsim_state.mps, nvsim_state.iova_base):
+                ctypes.memmove(address, ctypes.addressof(report_data) + offset, length)
+                offset += length
 
             status_code = status_codes['Successful Completion']
 
         # Complete the command
-        self.complete(command, sq, cq, status_code)
+        self.complete(command, sq, cq, status_code, delay_us=delay_us)
+
+    # Zone state listed by each Report Zones ZRASF value, None lists them all
+    zone_states = {
+        ZoneManagementReceive.LIST_ALL: None,
+        ZoneManagementReceive.LIST_EMPTY: ZoneDescriptor.ZS_EMPTY,
+        ZoneManagementReceive.LIST_IMPLICITLY_OPENED: ZoneDescriptor.ZS_IMPLICITLY_OPENED,
+        ZoneManagementReceive.LIST_EXPLICITLY_OPENED: ZoneDescriptor.ZS_EXPLICITLY_OPENED,
+        ZoneManagementReceive.LIST_CLOSED: ZoneDescriptor.ZS_CLOSED,
+        ZoneManagementReceive.LIST_FULL: ZoneDescriptor.ZS_FULL,
+        ZoneManagementReceive.LIST_READ_ONLY: ZoneDescriptor.ZS_READ_ONLY,
+        ZoneManagementReceive.LIST_OFFLINE: ZoneDescriptor.ZS_OFFLINE,
+    }
+
+
+class NVSimZoneAppend:
+    OPC = ZoneAppend().OPC
+
+    def __call__(self, nvsim_state, command, sq, cq, delay_us=0):
+        za_cmd = ZoneAppend.from_buffer(command)
+        ns = nvsim_state.namespaces[za_cmd.NSID]
+        lba = 0
+
+        logger.debug('Zone Append ZSLBA: 0x{:x} NLB: {} NSID: {}'.format(
+            za_cmd.ZSLBA, za_cmd.NLB, za_cmd.NSID))
+
+        if not ns.zoned:
+            status_code = status_codes['Invalid Command Opcode']
+
+        elif (za_cmd.ZSLBA + za_cmd.NLB + 1) > ns.num_lbas:
+            status_code = status_codes['LBA Out of Range']
+
+        # ZSLBA is the zone's first LBA, the controller picks where in it the data goes
+        elif za_cmd.ZSLBA % ns.zone_size:
+            status_code = status_codes['Invalid Field in Command']
+
+        else:
+            zone_status, lba = ns.zone_write(za_cmd.ZSLBA, za_cmd.NLB + 1, append=True)
+            if zone_status is not None:
+                status_code = status_codes[zone_status, ZoneAppend]
+
+            else:
+                # Get the (address, length) of each data segment from the command's PRPs
+                segments = walk_prp(za_cmd.DPTR.PRP.PRP1, za_cmd.DPTR.PRP.PRP2,
+                                    (za_cmd.NLB + 1) * ns.block_size, nvsim_state.mps,
+                                    nvsim_state.iova_base)
+
+                # Write data to nvsim's storage at the LBA the append was given
+                ns.write(lba, za_cmd.NLB + 1, segments)
+                nvsim_state.health.host_write((za_cmd.NLB + 1) * ns.block_size)
+
+                status_code = status_codes['Successful Completion']
+
+        # Complete the command, with the LBA the data was written to
+        self.complete(command, sq, cq, status_code, result=lba if status_code.success else 0,
+                      delay_us=delay_us)
 
 
 # Create our admin command handlers object. Can you do this with introspection??
@@ -72,5 +363,12 @@ nvm_handlers = NvsimCommandHandlers()
 for handler in [
     NVSimWrite,
     NVSimRead,
+    NVSimFlush,
+    NVSimCompare,
+    NVSimWriteZeroes,
+    NVSimDatasetManagement,
+    NVSimZoneManagementSend,
+    NVSimZoneManagementReceive,
+    NVSimZoneAppend,
 ]:
     nvm_handlers.register(handler)
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger('nvsim_interrupts')
+
+
+class NVSimInterrupts:
+    ''' MSI-X interrupts for nvsim, one eventfd per vector. Posting a completion to a CQ
+        with interrupts enabled writes to its vector's eventfd, and the host reads the
+        eventfd to find out how many interrupts it got, like it does with vfio.
+
+        IO completions can be coalesced: the vector is only signaled once coalesce_threshold
+        completions are pending on it, or coalesce_time_us after the first one was posted.
+        Admin completions are never coalesced.
+    '''
+    def __init__(self, num_vectors, coalesce_threshold=1, coalesce_time_us=0):
+        self.num_vectors = num_vectors
+        self.coalesce_threshold = coalesce_threshold
+        self.coalesce_time_us = coalesce_time_us
+        self.eventfds = []
+
+        # Completions posted on each vector that were not signaled yet, and the time the
+        #  first one of them was posted
+        self.pending = [0] * num_vectors
+        self.pending_since = [0.0] * num_vectors
+        self.lock = threading.Lock()
+
+    def open(self):
+        ''' Creates the eventfds, nothing is signaled before this is called
+        '''
+        if not self.eventfds:
+            self.eventfds = [os.eventfd(0, flags=os.EFD_NONBLOCK) for
+                             vector in range(self.num_vectors)]
+
+    def close(self):
+        for eventfd in self.eventfds:
+            os.close(eventfd)
+        self.eventfds = []
+
+    def signal(self, vector):
+        self.pending[vector] = 0
+        os.eventfd_write(self.eventfds[vector], 1)
+
+    def completion_posted(self, vector, coalesce=True):
+        if not self.eventfds:
+            return
+
+        with self.lock:
+            if not coalesce or self.coalesce_threshold <= 1:
+                self.signal(vector)
+                return
+
+            if self.pending[vector] == 0:
+                self.pending_since[vector] = time.perf_counter()
+            self.pending[vector] += 1
+            if self.pending[vector] >= self.coalesce_threshold:
+                self.signal(vector)
+
+    def check_coalesce_time(self):
+        ''' Signals vectors that had completions pending for longer than coalesce_time_us
+        '''
+        if not self.eventfds or self.coalesce_threshold <= 1:
+            return
+
+        expired = time.perf_counter() - (self.coalesce_time_us / 1000000)
+        with self.lock:
+            for vector, pending in enumerate(self.pending):
+                if pending and self.pending_since[vector] <= expired:
+                    self.signal(vector)
+
+    def pending_count(self, vector):
+        ''' Host side: returns the number of interrupts on vector since the last call
+        '''
+        try:
+            return os.eventfd_read(self.eventfds[vector])
+        except BlockingIOError:
+            return 0
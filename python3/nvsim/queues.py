@@ -0,0 +1,28 @@
+from lone.nvme.spec.queues import NVMeCompletionQueue
+
+
+class NVSimCompletionQueue(NVMeCompletionQueue):
+    ''' Completion queue nvsim posts completions to. With a scheduler, timed or delayed
+        completions are handed to it and posted when they are due instead of right away.
+        With interrupts, posting a completion interrupts the host on int_vector (None if IEN
+        is not set). With health, failed commands completed to it go in the Error
+        Information log
+    '''
+    def __init__(self, base_address, entries, entry_size, qid, dbh_addr, scheduler=None,
+                 int_vector=None, interrupts=None, health=None):
+        super().__init__(base_address, entries, entry_size, qid, dbh_addr, int_vector)
+        self.scheduler = scheduler
+        self.interrupts = interrupts
+        self.health = health
+
+    def has_room(self):
+        ''' Returns True if there is room for one more completion, counting the ones the
+            scheduler holds back to post later
+        '''
+        held = 0 if self.scheduler is None else self.scheduler.num_held(self)
+        return self.num_entries() + held < self.entries - 1
+
+    def post_completion(self, cqe):
+        super().post_completion(cqe)
+        if self.interrupts is not None and self.int_vector is not None:
+            self.interrupts.completion_posted(self.int_vector, coalesce=self.qid != 0)
@@ -0,0 +1,18 @@
+def changed_offsets(old_data, new_data, stride=1):
+    ''' Compares two equally sized bytes objects and returns the set of indexes of the
+        stride sized elements that are different. Equal data is a single memcmp, and
+        different data is compared as one big integer instead of byte by byte
+    '''
+    if old_data == new_data:
+        return set()
+
+    diff = int.from_bytes(old_data, 'little') ^ int.from_bytes(new_data, 'little')
+    stride_bits = stride * 8
+    changed = set()
+    while diff:
+        # Lowest different bit, then skip the rest of its element
+        index = ((diff & -diff).bit_length() - 1) // stride_bits
+        changed.add(index)
+        diff >>= (index + 1) * stride_bits
+        diff <<= (index + 1) * stride_bits
+    return changed
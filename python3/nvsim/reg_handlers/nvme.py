@@ -1,34 +1,86 @@
-import copy
 import ctypes
+import threading
 import time
 
-from lone.nvme.spec.queues import QueueMgr, NVMeSubmissionQueue, NVMeCompletionQueue
+from lone.nvme.spec.queues import QueueMgr, NVMeSubmissionQueue
 from lone.nvme.device import NVMeDeviceCommon
 from lone.system import MemoryLocation
 from nvsim.cmd_handlers.admin import admin_handlers
 from nvsim.cmd_handlers.nvm import nvm_handlers
 from nvsim.cmd_handlers import NvsimCommandHandler
+from nvsim.reg_handlers import changed_offsets
+from nvsim.workers import NVSimWorker
+from nvsim.queues import NVSimCompletionQueue
+from nvsim.arbitration import NVSimArbiter
 
 import logging
 logger = logging.getLogger('nvsim_nvme')
 
 
+class NVMeRegSnapshot:
+    ''' Raw copy of the registers nvsim acts on (CC through ACQ), taken with a single memmove
+    '''
+    def __init__(self, nvme_regs):
+        regs_type = type(nvme_regs)
+        start = regs_type.CC.offset
+        self.size = regs_type.ACQ.offset + regs_type.ACQ.size - start
+        self.address = ctypes.addressof(nvme_regs) + start
+        self.data = (ctypes.c_uint8 * self.size)()
+
+        # Register views into the copy
+        self.CC = type(nvme_regs.CC).from_buffer(self.data, regs_type.CC.offset - start)
+        self.AQA = type(nvme_regs.AQA).from_buffer(self.data, regs_type.AQA.offset - start)
+        self.ASQ = type(nvme_regs.ASQ).from_buffer(self.data, regs_type.ASQ.offset - start)
+        self.ACQ = type(nvme_regs.ACQ).from_buffer(self.data, regs_type.ACQ.offset - start)
+
+    def update(self):
+        ctypes.memmove(self.data, self.address, self.size)
+
+
 class NVMeRegChangeHandler:
 
-    def __init__(self, nvsim_state):
+    def __init__(self, nvsim_state, num_workers=0, arbiter=None):
         self.nvsim_state = nvsim_state
-        self.last_nvme_regs = copy.deepcopy(self.nvsim_state.nvme_regs)
+        self.arbiter = arbiter if arbiter is not None else NVSimArbiter()
+
+        # With num_workers, commands are processed by worker threads instead of inline
+        self.admin_worker = None
+        self.io_workers = []
+        if num_workers:
+            post_func = self.nvsim_state.scheduler.post_due
+            self.admin_worker = NVSimWorker(self.process_sq, post_func, 'nvsim_admin_worker')
+            self.io_workers = [NVSimWorker(self.process_sq, post_func,
+                                           'nvsim_io_worker_{}'.format(i))
+                               for i in range(num_workers)]
+            for worker in self.all_workers():
+                worker.start()
+        self.regs_snapshot = NVMeRegSnapshot(self.nvsim_state.nvme_regs)
+        self.regs_snapshot.update()
+        self.last_cc_en = self.regs_snapshot.CC.EN
+
+        # Raw copies of the doorbells (registers and shadow) from the last time we looked,
+        #  and queues that still had commands after we last processed them
+        self.doorbells_addr = ctypes.addressof(self.nvsim_state.nvme_regs.SQNDBS)
+        self.last_doorbells = b''
+        self.last_shadow_doorbells = b''
+        self.leftover_sqids = set()
 
         self.ignore_changes = False
         self.ignore_changes_end_time = None
 
-        self.fail_next_command = False
+        # Status code to fail the next command with. Workers consume it under fail_lock so
+        #  only one command fails
         self.fail_next_command_sc = None
+        self.fail_lock = threading.Lock()
 
         self.set_cfs = False
 
     def check_injectors(self):
 
+        # Nothing to look for, which is almost always the case
+        if not self.nvsim_state.injectors.injectors:
+            return
+
         # Check if we are supposed to ignore changes for a certain time
         injector = self.nvsim_state.injectors.get('IgnoreNVMeRegChanges')
         if injector:
@@ -40,8 +92,8 @@ class NVMeRegChangeHandler:
         injector = self.nvsim_state.injectors.get('FailCommand')
         if injector:
             injector.ack = True
-            self.fail_next_command = True
-            self.fail_next_command_sc = injector.kwargs['sc']
+            with self.fail_lock:
+                self.fail_next_command_sc = injector.kwargs['sc']
 
         # Check if we are supposed to set the CFS bit
         injector = self.nvsim_state.injectors.get('SetCFS')
@@ -49,10 +101,244 @@ class NVMeRegChangeHandler:
             injector.ack = True
             self.set_cfs = True
 
+    def apply_rules(self, command, sq, cq):
+        ''' Applies the injection rule that triggers on IO command, if any. Returns None if
+            the rule failed (and completed) the command, otherwise how long the command's
+            completion is delayed
+        '''
+        rule = self.nvsim_state.injectors.match(command)
+        if rule is None:
+            return 0
+        if rule.sc is not None:
+            NvsimCommandHandler.complete(None, command, sq, cq, rule.sc)
+            return None
+        return rule.delay_us
+
+    def take_fail_sc(self):
+        ''' Returns the status code to fail this command with, or None. Only the first
+            command to ask after a FailCommand injector gets it
+        '''
+        if self.fail_next_command_sc is None:
+            return None
+        with self.fail_lock:
+            sc, self.fail_next_command_sc = self.fail_next_command_sc, None
+        return sc
+
+    def changed_doorbells(self, address, last_data, num_qids):
+        ''' Returns the qids with doorbells (SQ tail or CQ head) that changed since last_data,
+            and the new raw doorbell data
+        '''
+        data = ctypes.string_at(address, num_qids * 8)
+        if len(data) != len(last_data):
+            return set(range(num_qids)), data
+        return changed_offsets(last_data, data, 8), data
+
+    def busy_queues(self):
+        ''' Returns the (sq, cq) pairs with commands to process. Only queues with doorbells
+            that changed, or that had commands left over, are checked. A CQ head doorbell
+            change means the host made room in the CQ, so it wakes the SQs that use it
+        '''
+        # Admin commands on a worker may create or delete queues while we look
+        queue_pairs = self.nvsim_state.queue_mgr.queue_pairs()
+        num_qids = max(sqid for (sqid, cqid), queues in queue_pairs) + 1
+
+        busy_qids, self.last_doorbells = self.changed_doorbells(
+            self.doorbells_addr, self.last_doorbells, num_qids)
+        if self.nvsim_state.dbbuf_shadow is not None:
+            shadow_qids, self.last_shadow_doorbells = self.changed_doorbells(
+                self.nvsim_state.dbbuf_shadow, self.last_shadow_doorbells, num_qids)
+            busy_qids |= shadow_qids
+        busy_qids |= self.leftover_sqids
+
+        return [(sq, cq) for (sqid, cqid), (sq, cq) in queue_pairs if
+                (sqid in busy_qids or cqid in busy_qids) and
+                sq is not None and sq.num_entries() > 0]
+
+    def process_sq(self, sq, cq, max_commands=None):
+        ''' Processes the commands in sq (up to max_commands of them), completing them in cq.
+            Returns how many commands it processed
+        '''
+        num_commands = sq.num_entries()
+        if max_commands is not None:
+            num_commands = min(num_commands, max_commands)
+        start_ns = time.perf_counter_ns()
+
+        processed = 0
+        for sq_index in range(num_commands):
+
+            # No point in starting a new command if the cq has no room for its completion,
+            #  the rest are left for when the host consumes some
+            if not cq.has_room():
+                break
+            processed += 1
+
+            # Get the command
+            command = sq.get_command()
+
+            # Were we asked to fail the next command we got?
+            fail_sc = self.take_fail_sc()
+            if fail_sc is not None:
+                NvsimCommandHandler.complete(None, command, sq, cq, fail_sc)
+
+            # Pick either the ADMIN or NVM handler and execute the command
+            elif sq.qid == 0:
+                admin_handlers.handlers[command.OPC](self.nvsim_state, command, sq, cq)
+            else:
+                # Injection rules may fail IO commands, or delay their completions
+                delay_us = self.apply_rules(command, sq, cq)
+                if delay_us is not None:
+                    nvm_handlers.handlers[command.OPC](self.nvsim_state, command, sq, cq,
+                                                       delay_us)
+
+        # Let the host know when it needs to ring the doorbell again
+        self.nvsim_state.update_sq_eventidx(sq)
+
+        # The controller is busy while it works on IO commands
+        if sq.qid != 0:
+            self.nvsim_state.health.busy(time.perf_counter_ns() - start_ns)
+        return processed
+
+    def worker_for(self, cq):
+        ''' The admin queue has its own worker, IO queues are spread across the IO workers by
+            CQ so only one worker ever posts to each CQ
+        '''
+        if cq.qid == 0:
+            return self.admin_worker
+        return self.io_workers[cq.qid % len(self.io_workers)]
+
+    def all_workers(self):
+        return [self.admin_worker] + self.io_workers if self.io_workers else []
+
+    def stop_workers(self):
+        for worker in self.all_workers():
+            worker.stop()
+
+    def controller_enable(self, nvme_regs):
+        logger.info('CC.EN 0 -> 1')
+
+        # Log Admin queues addresses and sizes
+        logger.debug('ASQS   {}'.format(nvme_regs.AQA.ASQS))
+        logger.debug('ASQB 0x{:08x}'.format(nvme_regs.ASQ.ASQB))
+        logger.debug('ACQS   {}'.format(nvme_regs.AQA.ACQS))
+        logger.debug('ACQB 0x{:08x}'.format(nvme_regs.ACQ.ACQB))
+
+        # Create and check queue memory address
+        asq_mem = MemoryLocation(self.nvsim_state.vaddr(nvme_regs.ASQ.ASQB),
+                                 nvme_regs.ASQ.ASQB,
+                                 (nvme_regs.AQA.ASQS + 1) * NVMeDeviceCommon.sq_entry_size,
+                                 'nvsim_asq')
+        self.nvsim_state.check_mem_access(asq_mem)
+
+        acq_mem = MemoryLocation(self.nvsim_state.vaddr(nvme_regs.ACQ.ACQB),
+                                 nvme_regs.ACQ.ACQB,
+                                 (nvme_regs.AQA.ACQS + 1) * NVMeDeviceCommon.cq_entry_size,
+                                 'nvsim_acq')
+        self.nvsim_state.check_mem_access(acq_mem)
+
+        # Add ADMIN queue to nvsim_state
+        self.nvsim_state.queue_mgr.add(
+            NVMeSubmissionQueue(
+                asq_mem,
+                nvme_regs.AQA.ASQS + 1,
+                NVMeDeviceCommon.sq_entry_size,
+                0,
+                ctypes.addressof(self.nvsim_state.nvme_regs.SQNDBS[0])),
+            NVSimCompletionQueue(
+                acq_mem,
+                nvme_regs.AQA.ACQS + 1,
+                NVMeDeviceCommon.cq_entry_size,
+                0,
+                ctypes.addressof(self.nvsim_state.nvme_regs.SQNDBS[0]) + 4,
+                int_vector=0,
+                interrupts=self.nvsim_state.interrupts,
+                health=self.nvsim_state.health))
+
+        # Ok, looks like the addresses add up, setting ourselves to ready!
+        self.nvsim_state.nvme_regs.CSTS.RDY = 1
+        self.nvsim_state.ready = True
+        logger.info('NVSim ready (CSTS.RDY = 1)')
+
+    def controller_disable(self):
+        logger.info('CC.EN 1 -> 0')
+
+        # Let workers finish what they are doing before the queues go away
+        for worker in self.all_workers():
+            worker.quiesce()
+
+        # Remove all queues from nvsim_state on disable
+        self.nvsim_state.queue_mgr = QueueMgr()
+        self.nvsim_state.completion_queues = []
+
+        # Completions not posted yet are lost, like on a real drive
+        self.nvsim_state.scheduler.clear()
+
+        # The doorbell buffer config does not survive a disable either
+        self.nvsim_state.dbbuf_shadow = None
+        self.nvsim_state.dbbuf_eventidx = None
+        self.last_shadow_doorbells = b''
+        self.leftover_sqids = set()
+
+        self.nvsim_state.nvme_regs.CSTS.RDY = 0
+        logger.info('NVSim no longer ready (CSTS.RDY = 0)')
+
+    def process_queues(self):
+        ''' Returns True if there was work to do, or there is work waiting on time
+        '''
+        busy = False
+
+        # Post completions the timing model (or injected delays) say are due. With workers,
+        #  the worker that owns the CQ posts them
+        if self.io_workers:
+            for cq in self.nvsim_state.scheduler.due_cqs():
+                self.worker_for(cq).submit_due(cq)
+        else:
+            self.nvsim_state.scheduler.post_due()
+        busy = self.nvsim_state.scheduler.next_due() is not None
+
+        # Interrupt for coalesced completions that waited long enough
+        if self.nvsim_state.interrupts is not None:
+            self.nvsim_state.interrupts.check_coalesce_time()
+            busy = busy or any(self.nvsim_state.interrupts.pending)
+
+        # Find all the queues we should look at for commands
+        busy_sqs = self.busy_queues()
+
+        if self.io_workers:
+            # Hand them to the workers, they keep going on leftover commands themselves
+            for sq, cq in busy_sqs:
+                self.worker_for(cq).submit(sq, cq)
+            busy = busy or len(busy_sqs) > 0
+        else:
+            # Admin queue first, then IO queues as the arbitration mechanism says
+            stalled_sqids = set()
+            for sq, cq, max_commands in self.arbiter.schedule(busy_sqs,
+                                                              self.regs_snapshot.CC.AMS):
+                if self.process_sq(sq, cq, max_commands) > 0:
+                    busy = True
+                else:
+                    stalled_sqids.add(sq.qid)
+
+            # Remember queues that still have commands. Ones that made no progress have a
+            #  full CQ, they wait for the host to ring its head doorbell instead of spinning
+            self.leftover_sqids = set(sq.qid for sq, cq in busy_sqs if
+                                      sq.qid not in stalled_sqids and sq.num_entries() > 0)
+            busy = busy or len(self.leftover_sqids) > 0
+
+        return busy
+
     def __call__(self):
+        ''' Returns True if there was anything to do
+        '''
+        busy = False
+
+        # Fail the controller if a worker ran into trouble
+        for worker in self.all_workers():
+            if worker.exception is not None:
+                raise worker.exception
 
         # Make a copy right away to minimize things moving under us
-        nvme_regs = copy.deepcopy(self.nvsim_state.nvme_regs)
+        self.regs_snapshot.update()
+        nvme_regs = self.regs_snapshot
 
         # Check if our behavior should change based on injectors
         self.check_injectors()
@@ -60,107 +346,29 @@ class NVMeRegChangeHandler:
         # Have we been asked to ignore changes?
         if self.ignore_changes:
             if time.time() < self.ignore_changes_end_time:
-                return
+                return busy
             else:
                 self.ignore_changes = False
 
         # Have we been asked to set the CFS bit?
         if self.set_cfs:
-            self.nvme_regs.CSTS.CFS = 1
+            self.nvsim_state.nvme_regs.CSTS.CFS = 1
             self.set_cfs = False
 
         # Did we just transition from not enabled to enabled?
-        if (self.last_nvme_regs.CC.EN == 0 and nvme_regs.CC.EN == 1):
-            logger.info('CC.EN 0 -> 1')
-
-            # Log Admin queues addresses and sizes
-            logger.debug('ASQS   {}'.format(nvme_regs.AQA.ASQS))
-            logger.debug('ASQB 0x{:08x}'.format(nvme_regs.ASQ.ASQB))
-            logger.debug('ACQS   {}'.format(nvme_regs.AQA.ACQS))
-            logger.debug('ACQB 0x{:08x}'.format(nvme_regs.ACQ.ACQB))
-
-            # Create and check queue memory address
-            asq_mem = MemoryLocation(nvme_regs.ASQ.ASQB,
-                                     nvme_regs.ASQ.ASQB,
-                                     (nvme_regs.AQA.ASQS + 1) * NVMeDeviceCommon.sq_entry_size,
-                                     'nvsim_asq')
-            self.nvsim_state.check_mem_access(asq_mem)
-
-            acq_mem = MemoryLocation(nvme_regs.ACQ.ACQB,
-                                     nvme_regs.ACQ.ACQB,
-                                     (nvme_regs.AQA.ACQS + 1) * NVMeDeviceCommon.cq_entry_size,
-                                     'nvsim_acq')
-            self.nvsim_state.check_mem_access(acq_mem)
-
-            # Add ADMIN queue to nvsim_state
-            self.nvsim_state.queue_mgr.add(
-                NVMeSubmissionQueue(
-                    asq_mem,
-                    nvme_regs.AQA.ASQS + 1,
-                    NVMeDeviceCommon.sq_entry_size,
-                    0,
-                    ctypes.addressof(self.nvsim_state.nvme_regs.SQNDBS[0])),
-                NVMeCompletionQueue(
-                    acq_mem,
-                    nvme_regs.AQA.ACQS + 1,
-                    NVMeDeviceCommon.cq_entry_size,
-                    0,
-                    ctypes.addressof(self.nvsim_state.nvme_regs.SQNDBS[0]) + 4))
-
-            # Ok, looks like the addresses add up, setting ourselves to ready!
-            self.nvsim_state.nvme_regs.CSTS.RDY = 1
-            self.nvsim_state.ready = True
-            logger.info('NVSim ready (CSTS.RDY = 1)')
+        if (self.last_cc_en == 0 and nvme_regs.CC.EN == 1):
+            self.controller_enable(nvme_regs)
+            busy = True
 
         # Did we just transition from enabled to not enabled?
-        if (self.last_nvme_regs.CC.EN == 1 and
+        if (self.last_cc_en == 1 and
                 nvme_regs.CC.EN == 0):
-            logger.info('CC.EN 1 -> 0')
-
-            # Remove all queues from nvsim_state on disable
-            self.queue_mgr = QueueMgr()
-
-            self.nvsim_state.nvme_regs.CSTS.RDY = 0
-            logger.info('NVSim no longer ready (CSTS.RDY = 0)')
+            self.controller_disable()
+            busy = True
 
         if self.nvsim_state.nvme_regs.CSTS.RDY == 1:
-
-            # Find all the queues we should look at for commands
-            busy_sqs = [(sq, cq) for k, (sq, cq) in
-                        self.nvsim_state.queue_mgr.nvme_queues.items() if
-                        sq is not None and sq.num_entries() > 0]
-
-            # Go through all of them round robin style
-            # TODO: Change this around so we drain the ADMIN queue first
-            for sq, cq in busy_sqs:
-                for sq_index in range(sq.num_entries()):
-
-                    # No point in starting a new command if the cq for it is full
-                    #  This may end up asserting in a legitimate case, but if that happens
-                    #  we should take a look to see if we can avoid it
-                    assert cq.is_full() is False, (
-                        'CQ id: {} is full, asserting to debug'.format(cq.qid))
-
-                    # Get the command
-                    command = sq.get_command()
-
-                    # Were we asked to fail the next command we got?
-                    if self.fail_next_command:
-                        NvsimCommandHandler.complete(None,
-                                                     command,
-                                                     sq,
-                                                     cq,
-                                                     self.fail_next_command_sc)
-                        self.fail_next_command = False
-                    else:
-                        # Pick either the ADMIN or NVM handler
-                        if sq.qid == 0:
-                            handler = admin_handlers.handlers[command.OPC]
-                        else:
-                            handler = nvm_handlers.handlers[command.OPC]
-
-                        # Execute the command
-                        handler(self.nvsim_state, command, sq, cq)
+            busy = self.process_queues() or busy
 
         # Save off the last time we checked
-        self.last_nvme_regs = nvme_regs
+        self.last_cc_en = nvme_regs.CC.EN
+        return busy
@@ -1,3 +1,7 @@
+import ctypes
+
+from nvsim.reg_handlers import changed_offsets
+
 import logging
 logger = logging.getLogger('nvsim_pci')
 
@@ -6,18 +10,17 @@ class PCIeRegChangeHandler:
 
     def __init__(self, nvsim_state):
         self.nvsim_state = nvsim_state
-        self.pcie_regs_data = bytearray(self.nvsim_state.pcie_regs)
+        self.pcie_regs_addr = ctypes.addressof(self.nvsim_state.pcie_regs)
+        self.pcie_regs_size = ctypes.sizeof(self.nvsim_state.pcie_regs)
+        self.pcie_regs_data = ctypes.string_at(self.pcie_regs_addr, self.pcie_regs_size)
 
     def __call__(self):
         # Make a copy right away to minimize things moving under us
-        pcie_regs_data_old = self.pcie_regs_data
-        pcie_regs_data_new = bytearray(self.nvsim_state.pcie_regs)
-
-        # If old != new go check if we need to do anything
-        if pcie_regs_data_old != pcie_regs_data_new:
-            for i in range(len(pcie_regs_data_new)):
-                if pcie_regs_data_old[i] != pcie_regs_data_new[i]:
-                    logging.info('PCIE changed at offset 0x{:x}'.format(i))
+        pcie_regs_data_new = ctypes.string_at(self.pcie_regs_addr, self.pcie_regs_size)
+
+        # Log anything that changed
+        for offset in sorted(changed_offsets(self.pcie_regs_data, pcie_regs_data_new)):
+            logging.info('PCIE changed at offset 0x{:x}'.format(offset))
 
         # Save off the last time we checked
         self.pcie_regs_data = pcie_regs_data_new
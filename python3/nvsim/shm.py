@@ -0,0 +1,119 @@
+''' Shared memory used to run nvsim in its own process. The registers and all the memory
+    the host gives the simulator live in one memfd backed region that both processes map,
+    and iovas are offsets into that region.
+'''
+import ctypes
+import mmap
+import os
+from types import SimpleNamespace
+
+from lone.system import Memory, MemoryLocation
+
+import logging
+logger = logging.getLogger('nvsim_shm')
+
+
+class NVSimSharedMemory:
+    ''' memfd backed region laid out as: PCIe registers, NVMe registers, host memory. Each
+        part starts on a page boundary
+    '''
+    def __init__(self, pcie_regs_type, nvme_regs_type, mem_size, page_size=4096):
+        self.page_size = page_size
+
+        def page_align(size):
+            return (size + page_size - 1) & ~(page_size - 1)
+
+        self.pcie_regs_offset = 0
+        self.nvme_regs_offset = page_align(ctypes.sizeof(pcie_regs_type))
+        self.mem_offset = self.nvme_regs_offset + page_align(ctypes.sizeof(nvme_regs_type))
+        self.mem_size = page_align(mem_size)
+        self.size = self.mem_offset + self.mem_size
+
+        # The memfd is sparse, only pages that are touched use memory
+        self.fd = os.memfd_create('nvsim', 0)
+        os.ftruncate(self.fd, self.size)
+        self.mm = mmap.mmap(self.fd, self.size)
+        self.data = (ctypes.c_uint8 * self.size).from_buffer(self.mm)
+        self.address = ctypes.addressof(self.data)
+
+        self.pcie_regs = pcie_regs_type.from_buffer(self.data, self.pcie_regs_offset)
+        self.nvme_regs = nvme_regs_type.from_buffer(self.data, self.nvme_regs_offset)
+
+    def close(self):
+        # Nothing can point into the mmap when closing it
+        del self.pcie_regs
+        del self.nvme_regs
+        del self.data
+        self.mm.close()
+        os.close(self.fd)
+
+
+class NVSimSharedMemMgr(Memory):
+    ''' Memory manager that hands out page aligned memory from a NVSimSharedMemory region
+        with iova = offset in the region
+    '''
+    def __init__(self, shm, page_size):
+        self.shm = shm
+        self.page_size = page_size
+        self._allocated_mem_list = []
+
+        # Free (offset, size) blocks in the region, sorted by offset
+        self.free_blocks = [(shm.mem_offset, shm.mem_size)]
+
+        # Nothing to reset, iovas come from where memory is in the region
+        self.iova_mgr = SimpleNamespace(reset=lambda: True)
+
+    def malloc(self, size, client=None):
+        alloc_size = (size + self.page_size - 1) & ~(self.page_size - 1)
+
+        # First block that fits
+        for i, (offset, block_size) in enumerate(self.free_blocks):
+            if block_size >= alloc_size:
+                break
+        else:
+            assert False, 'Out of nvsim shared memory allocating {} bytes'.format(size)
+
+        if block_size == alloc_size:
+            del self.free_blocks[i]
+        else:
+            self.free_blocks[i] = (offset + alloc_size, block_size - alloc_size)
+
+        # Memory is reused, and PRP lists rely on unused entries being 0
+        ctypes.memset(self.shm.address + offset, 0, alloc_size)
+
+        mem = MemoryLocation(self.shm.address + offset, offset, size, client)
+        mem.alloc_size = alloc_size
+        self._allocated_mem_list.append(mem)
+        return mem
+
+    def malloc_pages(self, num_pages, client=None):
+        return [self.malloc(self.page_size, client) for page_idx in range(num_pages)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+    def free(self, memory):
+        if memory not in self._allocated_mem_list:
+            return
+        self._allocated_mem_list.remove(memory)
+
+        # Put the block back, merging it with its neighbors
+        self.free_blocks.append((memory.iova, memory.alloc_size))
+        self.free_blocks.sort()
+        merged = []
+        for offset, block_size in self.free_blocks:
+            if merged and merged[-1][0] + merged[-1][1] == offset:
+                merged[-1] = (merged[-1][0], merged[-1][1] + block_size)
+            else:
+                merged.append((offset, block_size))
+        self.free_blocks = merged
+
+    def free_all(self):
+        for memory in list(self._allocated_mem_list):
+            self.free(memory)
+
+    def allocated_mem_list(self):
+        return self._allocated_mem_list
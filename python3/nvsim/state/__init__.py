@@ -1,40 +1,82 @@
+import array
 import ctypes
-import mmap
+import itertools
+import threading
 
 from lone.nvme.spec.queues import QueueMgr
+from nvsim.state.storage import NVSimFileStorage, NVSimSparseStorage, is_zeroed
+from nvsim.state.intervals import NVSimIntervalMap
+from nvsim.state.health import NVSimHealth
+from nvsim.timing import NVSimTimingModel, NVSimCompletionScheduler
 from lone.nvme.spec.commands.admin.identify import (IdentifyNamespaceData,
                                                     IdentifyControllerData,
                                                     IdentifyNamespaceListData,
-                                                    IdentifyUUIDListData)
+                                                    IdentifyUUIDListData,
+                                                    IdentifyNamespaceZonedData,
+                                                    IdentifyControllerZonedData,
+                                                    IdentifyIoCmdSetData)
+from lone.nvme.spec.commands.zns.zone_management_send import ZoneManagementSend
+from lone.nvme.spec.commands.zns.zone_management_receive import ZoneDescriptor
 import logging
 logger = logging.getLogger('nvsim_state')
 
 
 class NVSimNamespace:
-
-    def __init__(self, num_gbs, block_size, path='/tmp/nvsim.dat'):
+    # Conventional namespace, LBAs can be written in any order
+    zoned = False
+
+    def __init__(self, num_gbs=None, block_size=512, storage='file', directory=None,
+                 num_blocks=None):
+        ''' The namespace is num_blocks of block_size bytes, or num_gbs GBs by the IDEMA
+            calculation. storage is 'file' to keep data in a mmaped file in directory (the
+            system's temporary directory if None), or 'sparse' to keep only the data written
+            in memory. Storage is only created the first time it is used
+        '''
         self.num_gbs = num_gbs
         self.block_size = block_size
-        self.path = path
-
-        if self.block_size == 512:
-            self.num_lbas = int(97696368 + (1953504 * (int(num_gbs) - 50.0)))
-        elif self.block_size == 4096:
-            self.num_lbas = int(12212046 + (244188 * (int(num_gbs) - 50.0)))
+        self.directory = directory
+        self.storage_type = storage
+        self._storage = None
+
+        # Byte ranges that were deallocated or written with zeroes. They read back as
+        #  zeros without looking at storage, so zeroing a range never touches its data
+        self.deallocated = NVSimIntervalMap()
+
+        # Snapshots of storage and deallocated ranges, by snapshot id
+        self.snapshots = {}
+        self.snapshot_ids = itertools.count()
+
+        assert self.block_size in [512, 4096], '{} block size not supported'.format(
+            self.block_size)
+        assert self.storage_type in ['file', 'sparse'], '{} storage not supported'.format(
+            self.storage_type)
+
+        if num_blocks is not None:
+            self.num_lbas = num_blocks
+        elif self.block_size == 512:
+            self.num_lbas = self.idema_size_512(num_gbs)
         else:
-            assert False, '{} block size not supported'.format(self.block_size)
+            self.num_lbas = self.idema_size_4096(num_gbs)
 
-        self.init_storage()
+    @property
+    def storage(self):
+        if self._storage is None:
+            self.init_storage()
+        return self._storage
 
     def init_storage(self):
-        # Create the file
-        self.fh = open(self.path, 'w+b')
-        self.fh.seek((self.num_lbas * self.block_size) - 1)
-        self.fh.write(b'\0')
-        self.fh.flush()
+        self.close_storage()
 
-        # Mmap so we can easily access
-        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        size = self.num_lbas * self.block_size
+        if self.storage_type == 'file':
+            self._storage = NVSimFileStorage(size, self.directory)
+        else:
+            self._storage = NVSimSparseStorage(size)
+
+    def close_storage(self):
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
 
     def idema_size_512(self, num_gbs):
         return int(97696368 + (1953504 * (int(num_gbs) - 50.0)))
@@ -42,30 +84,401 @@ class NVSimNamespace:
     def idema_size_4096(self, num_gbs):
         return int(12212046 + (244188 * (int(num_gbs) - 50.0)))
 
-    def read(self, lba, num_blocks, prp):
-        start_byte = (lba * self.block_size)
-        end_byte = start_byte + (num_blocks * self.block_size)
-        prp.set_data_buffer(self.mm[start_byte:end_byte])
+    def read(self, lba, num_blocks, segments):
+        ''' Copies num_blocks at lba into host memory, segments are (address, length)
+            pairs of where to put the data
+        '''
+        for offset, address, length in self.transfer(lba, num_blocks, segments):
+            if len(self.deallocated) == 0:
+                self.storage.read_into(offset, address, length)
+                continue
+
+            for start, end, deallocated in self.deallocated.split(offset, offset + length):
+                if deallocated:
+                    ctypes.memset(address + start - offset, 0, end - start)
+                else:
+                    self.storage.read_into(start, address + start - offset, end - start)
+
+    def write(self, lba, num_blocks, segments):
+        ''' Copies num_blocks at lba from host memory, segments are (address, length)
+            pairs of where to get the data from
+        '''
+        self.deallocated.remove(lba * self.block_size, (lba + num_blocks) * self.block_size)
+        for offset, address, length in self.transfer(lba, num_blocks, segments):
+            self.storage.write_from(offset, address, length)
+
+    def compare(self, lba, num_blocks, segments):
+        ''' Returns True if num_blocks at lba match host memory, compared in place
+        '''
+        for offset, address, length in self.transfer(lba, num_blocks, segments):
+            for start, end, deallocated in self.deallocated.split(offset, offset + length):
+                if deallocated:
+                    equal = is_zeroed(address + start - offset, end - start)
+                else:
+                    equal = self.storage.compare(start, address + start - offset, end - start)
+                if not equal:
+                    return False
+        return True
+
+    def zone_write(self, lba, num_blocks, append=False):
+        ''' Conventional namespaces have no zones, the data goes where the host says.
+            Returns (status, lba) like NVSimZonedNamespace.zone_write
+        '''
+        return None, lba
+
+    def write_zeroes(self, lba, num_blocks):
+        ''' Zeroed blocks are only recorded, their data is left alone
+        '''
+        self.deallocated.add(lba * self.block_size, (lba + num_blocks) * self.block_size)
 
-    def write(self, lba, num_blocks, prp):
-        start_byte = (lba * self.block_size)
-        end_byte = start_byte + (num_blocks * self.block_size)
-        self.mm[start_byte:end_byte] = prp.get_data_buffer()[:(self.block_size * num_blocks)]
+    def deallocate(self, lba, num_blocks):
+        ''' Deallocated blocks read back as zeros, and their storage is given back
+        '''
+        self.write_zeroes(lba, num_blocks)
+        if self._storage is not None:
+            self._storage.deallocate(lba * self.block_size, num_blocks * self.block_size)
+
+    def format(self):
+        ''' Deallocates every block in the namespace, without recreating the storage
+        '''
+        self.deallocated.clear()
+        if self._storage is not None:
+            self._storage.format()
+
+    def flush(self):
+        if self._storage is not None:
+            self._storage.flush()
+
+    def snapshot(self):
+        ''' Takes a copy on write snapshot of the namespace's data, and returns its id.
+            Only sparse storage supports snapshots
+        '''
+        assert self.storage_type == 'sparse', 'Snapshots need sparse storage'
+        snapshot_id = next(self.snapshot_ids)
+
+        # Storage that was never used has no data to keep, don't create it just for this
+        storage_snapshot = None if self._storage is None else self._storage.snapshot()
+
+        self.snapshots[snapshot_id] = (storage_snapshot, self.deallocated.copy())
+        return snapshot_id
+
+    def restore(self, snapshot_id):
+        ''' Goes back to the data the namespace had when snapshot_id was taken, in time
+            proportional to the chunks written since
+        '''
+        storage_snapshot, deallocated_ranges = self.snapshots[snapshot_id]
+        if storage_snapshot is None:
+            self.close_storage()
+        else:
+            self.storage.restore(storage_snapshot)
+        self.deallocated.restore(deallocated_ranges)
+
+    def delete_snapshot(self, snapshot_id):
+        del self.snapshots[snapshot_id]
+
+    def transfer(self, lba, num_blocks, segments):
+        ''' Splits num_blocks at lba into (offset, address, length) pieces, one per segment
+        '''
+        offset = lba * self.block_size
+        remaining = num_blocks * self.block_size
+        for address, length in segments:
+            length = min(length, remaining)
+            yield offset, address, length
+            offset += length
+            remaining -= length
+            if remaining == 0:
+                break
 
     def __del__(self):
-        self.mm.close()
-        self.fh.close()
+        self.close_storage()
+
+
+class NVSimZonedNamespace(NVSimNamespace):
+    ''' Zoned namespace. Its LBAs are split into zones of zone_size blocks, and each zone
+        is written in order, from its write pointer up to zone_capacity blocks (zone_size
+        if None). At most max_open zones can be open, and max_active zones open or closed,
+        at the same time (None for no limit).
+
+        Zone states are kept in a bytearray and write pointers in an array, both indexed
+        by zone, so a namespace with a lot of zones is cheap to keep and to scan
+    '''
+    zoned = True
+
+    # Zone states that hold open and active resources
+    OPEN = (ZoneDescriptor.ZS_IMPLICITLY_OPENED, ZoneDescriptor.ZS_EXPLICITLY_OPENED)
+    ACTIVE = OPEN + (ZoneDescriptor.ZS_CLOSED,)
+
+    # Zones each Zone Management Send action works on when Select All is set
+    SELECT_ALL = {
+        ZoneManagementSend.OPEN: (ZoneDescriptor.ZS_CLOSED,),
+        ZoneManagementSend.CLOSE: OPEN,
+        ZoneManagementSend.FINISH: ACTIVE,
+        ZoneManagementSend.RESET: ACTIVE + (ZoneDescriptor.ZS_FULL,),
+        ZoneManagementSend.OFFLINE: (ZoneDescriptor.ZS_READ_ONLY,),
+    }
+
+    def __init__(self, zone_size=0x1000, zone_capacity=None, max_open=None, max_active=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.zone_size = zone_size
+        self.zone_capacity = zone_capacity if zone_capacity is not None else zone_size
+        self.max_open = max_open
+        self.max_active = max_active
+
+        # The namespace is made of whole zones only
+        self.num_zones = self.num_lbas // self.zone_size
+        self.num_lbas = self.num_zones * self.zone_size
+        assert self.num_zones > 0, 'Namespace smaller than a zone'
+        assert self.zone_capacity <= self.zone_size, 'Zone capacity larger than zone size'
+
+        # Zone state as of each snapshot, by snapshot id
+        self.zone_snapshots = {}
+
+        # Worker threads write to zones at the same time
+        self.zone_lock = threading.Lock()
+        self.reset_zones()
+
+    def reset_zones(self, zone_states=None, write_pointers=None):
+        ''' Sets every zone's state and write pointer, by default to an empty zone
+        '''
+        if zone_states is None:
+            zone_states = bytes([ZoneDescriptor.ZS_EMPTY]) * self.num_zones
+            write_pointers = range(0, self.num_lbas, self.zone_size)
+        self.zone_states = bytearray(zone_states)
+        self.write_pointers = array.array('Q', write_pointers)
+
+        # Implicitly opened zones, the one opened first first, so the controller knows
+        #  which one to close when it needs to open another
+        self.implicitly_opened = dict.fromkeys(
+            self.zones_in((ZoneDescriptor.ZS_IMPLICITLY_OPENED,)))
+        self.num_open = sum(self.zone_states.count(state) for state in self.OPEN)
+        self.num_active = sum(self.zone_states.count(state) for state in self.ACTIVE)
+
+    def zones_in(self, states, zone=0):
+        ''' Yields the zones from zone on that are in one of states, in order. The zone
+            states are scanned by bytearray methods, not a zone at a time
+        '''
+        selected = self.zone_states.translate(bytes(s in states for s in range(256)))
+        zone = selected.find(1, zone)
+        while zone != -1:
+            yield zone
+            zone = selected.find(1, zone + 1)
+
+    def zone_start(self, zone):
+        return zone * self.zone_size
+
+    def zone_end(self, zone):
+        ''' LBA after the last one that can be written in zone
+        '''
+        return zone * self.zone_size + self.zone_capacity
+
+    def set_zone_state(self, zone, state):
+        ''' Moves zone to state, keeping count of open and active zones
+        '''
+        old_state = self.zone_states[zone]
+        self.num_open += (state in self.OPEN) - (old_state in self.OPEN)
+        self.num_active += (state in self.ACTIVE) - (old_state in self.ACTIVE)
+        if old_state == ZoneDescriptor.ZS_IMPLICITLY_OPENED:
+            del self.implicitly_opened[zone]
+        if state == ZoneDescriptor.ZS_IMPLICITLY_OPENED:
+            self.implicitly_opened[zone] = None
+        self.zone_states[zone] = state
+
+    def make_open(self, zone):
+        ''' Gets the resources to open zone, closing an implicitly opened zone if all the
+            open ones are taken. Returns None or the status name of why it can't be opened
+        '''
+        state = self.zone_states[zone]
+        if state in self.OPEN:
+            return None
+        if (state == ZoneDescriptor.ZS_EMPTY and self.max_active is not None and
+                self.num_active >= self.max_active):
+            return 'Too Many Active Zones'
+        if self.max_open is not None and self.num_open >= self.max_open:
+            if len(self.implicitly_opened) == 0:
+                return 'Too Many Open Zones'
+            self.close_zone(next(iter(self.implicitly_opened)))
+        return None
+
+    def close_zone(self, zone):
+        # Nothing was written to it, so it is empty again
+        if self.write_pointers[zone] == self.zone_start(zone):
+            self.set_zone_state(zone, ZoneDescriptor.ZS_EMPTY)
+        else:
+            self.set_zone_state(zone, ZoneDescriptor.ZS_CLOSED)
+
+    def zone_write(self, lba, num_blocks, append=False):
+        ''' Checks a write of num_blocks at lba against its zone, and moves the zone's
+            write pointer past it. An append is given the zone's first LBA and goes at its
+            write pointer. Returns (status, lba), where status is None or the status name
+            of why it failed, and lba is where the data goes
+        '''
+        zone = lba // self.zone_size
+        with self.zone_lock:
+            state = self.zone_states[zone]
+            if state == ZoneDescriptor.ZS_FULL:
+                return 'Zone Is Full', lba
+            elif state == ZoneDescriptor.ZS_READ_ONLY:
+                return 'Zone Is Read Only', lba
+            elif state == ZoneDescriptor.ZS_OFFLINE:
+                return 'Zone Is Offline', lba
+
+            if append:
+                lba = self.write_pointers[zone]
+            elif lba != self.write_pointers[zone]:
+                return 'Zone Invalid Write', lba
+
+            if lba + num_blocks > self.zone_end(zone):
+                return 'Zone Boundary Error', lba
+
+            status = self.make_open(zone)
+            if status is not None:
+                return status, lba
+            if state not in self.OPEN:
+                self.set_zone_state(zone, ZoneDescriptor.ZS_IMPLICITLY_OPENED)
+
+            self.write_pointers[zone] = lba + num_blocks
+            if self.write_pointers[zone] == self.zone_end(zone):
+                self.set_zone_state(zone, ZoneDescriptor.ZS_FULL)
+            return None, lba
+
+    def zone_action(self, zone, action):
+        ''' Does a Zone Management Send action (one of SELECT_ALL's keys) on zone. Returns
+            None or the status name of why it failed
+        '''
+        state = self.zone_states[zone]
+        if state == ZoneDescriptor.ZS_OFFLINE and action != ZoneManagementSend.OFFLINE:
+            return 'Zone Is Offline'
+        elif state == ZoneDescriptor.ZS_READ_ONLY and action != ZoneManagementSend.OFFLINE:
+            return 'Zone Is Read Only'
+
+        if action == ZoneManagementSend.OPEN:
+            if state == ZoneDescriptor.ZS_FULL:
+                return 'Invalid Zone State Transition'
+            status = self.make_open(zone)
+            if status is None:
+                self.set_zone_state(zone, ZoneDescriptor.ZS_EXPLICITLY_OPENED)
+            return status
+
+        elif action == ZoneManagementSend.CLOSE:
+            if state in (ZoneDescriptor.ZS_EMPTY, ZoneDescriptor.ZS_FULL):
+                return 'Invalid Zone State Transition'
+            self.close_zone(zone)
+
+        elif action == ZoneManagementSend.FINISH:
+            if (state == ZoneDescriptor.ZS_EMPTY and self.max_active is not None and
+                    self.num_active >= self.max_active):
+                return 'Too Many Active Zones'
+            self.write_pointers[zone] = self.zone_end(zone)
+            self.set_zone_state(zone, ZoneDescriptor.ZS_FULL)
+
+        elif action == ZoneManagementSend.RESET:
+            if state != ZoneDescriptor.ZS_EMPTY:
+                self.deallocate(self.zone_start(zone), self.zone_size)
+            self.write_pointers[zone] = self.zone_start(zone)
+            self.set_zone_state(zone, ZoneDescriptor.ZS_EMPTY)
+
+        else:
+            if state not in (ZoneDescriptor.ZS_READ_ONLY, ZoneDescriptor.ZS_OFFLINE):
+                return 'Invalid Zone State Transition'
+            self.set_zone_state(zone, ZoneDescriptor.ZS_OFFLINE)
+
+        return None
+
+    def zone_management(self, zone, action, select_all=False):
+        ''' Does action on zone, or with select_all on every zone the action applies to.
+            Returns None or the status name of why it failed, stopping at the first zone
+            that fails
+        '''
+        with self.zone_lock:
+            if not select_all:
+                return self.zone_action(zone, action)
+
+            for zone in list(self.zones_in(self.SELECT_ALL[action])):
+                status = self.zone_action(zone, action)
+                if status is not None:
+                    return status
+            return None
+
+    def report_zones(self, zone, state, descriptors):
+        ''' Fills in descriptors (ZoneDescriptors) for the zones from zone on, only the ones
+            in state unless it is None. Returns how many were filled in, and how many
+            zones there are to report in total
+        '''
+        with self.zone_lock:
+            if state is None:
+                zones = range(zone, self.num_zones)
+                num_zones = len(zones)
+            else:
+                zones = self.zones_in((state,), zone)
+                num_zones = self.zone_states.count(state, zone)
+
+            num_reported = 0
+            for descriptor, zone in zip(descriptors, zones):
+                descriptor.ZT = ZoneDescriptor.ZT_SEQUENTIAL_WRITE_REQUIRED
+                descriptor.ZS = self.zone_states[zone]
+                descriptor.ZCAP = self.zone_capacity
+                descriptor.ZSLBA = self.zone_start(zone)
+                descriptor.WP = self.write_pointers[zone]
+                num_reported += 1
+
+            return num_reported, num_zones
+
+    def format(self):
+        super().format()
+        with self.zone_lock:
+            self.reset_zones()
+
+    def snapshot(self):
+        ''' Snapshots the zones' states and write pointers with the data
+        '''
+        snapshot_id = super().snapshot()
+        with self.zone_lock:
+            self.zone_snapshots[snapshot_id] = (bytes(self.zone_states),
+                                                array.array('Q', self.write_pointers))
+        return snapshot_id
+
+    def restore(self, snapshot_id):
+        super().restore(snapshot_id)
+        with self.zone_lock:
+            self.reset_zones(*self.zone_snapshots[snapshot_id])
+
+    def delete_snapshot(self, snapshot_id):
+        super().delete_snapshot(snapshot_id)
+        del self.zone_snapshots[snapshot_id]
 
 
 class NVSimState:
 
-    def __init__(self, pcie_regs, nvme_regs, injectors):
+    # Namespaces created when we are not given any, in nsid order
+    default_namespaces = [
+        {'num_gbs': 1, 'block_size': 512},
+        {'num_gbs': 2, 'block_size': 4096},
+        {'num_gbs': 3, 'block_size': 4096},
+        {'num_gbs': 4, 'block_size': 4096},
+    ]
+
+    def __init__(self, pcie_regs, nvme_regs, injectors, storage='file', timing=None,
+                 iova_base=0, interrupts=None, namespaces=None, storage_dir=None, cntlid=0,
+                 subsystem=None):
         self.mps = 4096
 
+        # Controller ID, and the NVSimSubsystem the controller is in (None for a plain nvsim
+        #  controller, in a subsystem of its own)
+        self.cntlid = cntlid
+        self.subsystem = subsystem
+
+        # Host memory for an iova is at iova_base + iova. Running in the host's process
+        #  iovas are the host's vaddrs, so it is 0
+        self.iova_base = iova_base
+
         self.pcie_regs = pcie_regs
         self.nvme_regs = nvme_regs
         self.injectors = injectors
 
+        # MSI-X interrupts (NVSimInterrupts), None if we can't interrupt the host
+        self.interrupts = interrupts
+
         self.queue_mgr = QueueMgr()
 
         # Stores completion queues from CreateIOCompletionQueue commands that
@@ -73,16 +486,67 @@ class NVSimState:
         #    go into the queue manager and be used
         self.completion_queues = []
 
+        # Shadow doorbell and EventIdx buffer addresses from a Doorbell Buffer Config
+        #  command, None means IO queues use the doorbell registers
+        self.dbbuf_shadow = None
+        self.dbbuf_eventidx = None
+
+        # Optional timing model (a NVSimTimingModel or a profile dictionary for one),
+        #  without one IO commands complete right away unless an injection rule delays them
+        if isinstance(timing, dict):
+            timing = NVSimTimingModel.from_profile(timing)
+        self.scheduler = NVSimCompletionScheduler(timing, self)
+
+        # SMART / Health counters and error log, they survive controller resets
+        self.health = NVSimHealth()
+
+        # Snapshot ids of each namespace, by snapshot id
+        self.snapshots = {}
+        self.snapshot_ids = itertools.count()
+
         # Initalize stuff
         self.init_pcie_regs()
         self.init_nvme_regs()
 
-        # Create a list of namespaces where the index is the nsid
-        self.namespaces = [None]  # NSID 0 is not valid
-        self.namespaces.append(NVSimNamespace(1, 512, '/tmp/ns_1.dat'))
-        self.namespaces.append(NVSimNamespace(2, 4096, '/tmp/ns_2.dat'))
-        self.namespaces.append(NVSimNamespace(3, 4096, '/tmp/ns_3.dat'))
-        self.namespaces.append(NVSimNamespace(4, 4096, '/tmp/ns_4.dat'))
+        # Create a list of namespaces where the index is the nsid. Each one is described
+        #  by a dictionary of NVSimNamespace arguments, storage and storage_dir are used
+        #  for the ones that don't say. 'zoned': True makes it a NVSimZonedNamespace. In a
+        #  subsystem, the first controller creates them and the rest share them
+        def create_namespaces():
+            nvsim_namespaces = [None]  # NSID 0 is not valid
+            for ns_spec in (namespaces if namespaces is not None else self.default_namespaces):
+                ns_spec = dict({'storage': storage, 'directory': storage_dir}, **ns_spec)
+                ns_type = NVSimZonedNamespace if ns_spec.pop('zoned', False) else NVSimNamespace
+                nvsim_namespaces.append(ns_type(**ns_spec))
+            return nvsim_namespaces
+
+        if subsystem is not None:
+            self.namespaces = subsystem.attach(cntlid, create_namespaces)
+        else:
+            self.namespaces = create_namespaces()
+
+    def snapshot(self):
+        ''' Snapshots every namespace (see NVSimNamespace.snapshot), returns the id of the
+            snapshot
+        '''
+        file_nsids = [nsid for nsid, ns in enumerate(self.namespaces[1:], 1) if
+                      ns.storage_type == 'file']
+        assert len(file_nsids) == 0, (
+            'Snapshots need sparse storage, namespaces {} use file storage'.format(file_nsids))
+
+        snapshot_id = next(self.snapshot_ids)
+        self.snapshots[snapshot_id] = [ns.snapshot() for ns in self.namespaces[1:]]
+        return snapshot_id
+
+    def restore(self, snapshot_id):
+        ''' Takes every namespace back to snapshot_id. The host should not be doing IO
+        '''
+        for ns, ns_snapshot_id in zip(self.namespaces[1:], self.snapshots[snapshot_id]):
+            ns.restore(ns_snapshot_id)
+
+    def delete_snapshot(self, snapshot_id):
+        for ns, ns_snapshot_id in zip(self.namespaces[1:], self.snapshots.pop(snapshot_id)):
+            ns.delete_snapshot(ns_snapshot_id)
 
     def init_pcie_regs(self):
         self.pcie_regs.ID.VID = 0xEDDA
@@ -90,6 +554,9 @@ class NVSimState:
 
     def init_nvme_regs(self):
         self.nvme_regs.CAP.CSS = 0x40
+
+        # Weighted Round Robin with Urgent Priority Class supported
+        self.nvme_regs.CAP.AMS = 0x1
         self.nvme_regs.VS.MJR = 0x02
         self.nvme_regs.VS.MNR = 0x01
 
@@ -109,10 +576,14 @@ class NVSimState:
         id_ns_data.MC = 0
         id_ns_data.DPC = 0
         id_ns_data.DPS = 0
-        id_ns_data.NMIC = 0
+
+        # Other controllers in a shared subsystem may have the namespace attached too
+        id_ns_data.NMIC = 1 if self.subsystem is not None and self.subsystem.shared else 0
         id_ns_data.RESCAP = 0
         id_ns_data.FPI = 0
-        id_ns_data.DLFEAT = 0
+
+        # Deallocated blocks read as zeros, and Write Zeroes can deallocate
+        id_ns_data.DLFEAT = 0x9
         id_ns_data.NAWUN = 0
 
         # 2 supported
@@ -132,9 +603,64 @@ class NVSimState:
         id_ctrl_data.MN = b'nvsim_0.1'
         id_ctrl_data.SN = b'EDDAE771'
         id_ctrl_data.FR = b'0.001'
+        id_ctrl_data.CNTLID = self.cntlid
+
+        # Controllers in a subsystem report its serial number and NQN. A shared subsystem
+        #  may have more than one controller
+        if self.subsystem is not None:
+            id_ctrl_data.SN = self.subsystem.serial
+            id_ctrl_data.SUBNQN = self.subsystem.nqn
+            id_ctrl_data.CMIC = (1 << 1) if self.subsystem.shared else 0
+
+        # Doorbell Buffer Config supported
+        id_ctrl_data.OACS = 1 << 8
+
+        # Error Information log entries, 0's based
+        id_ctrl_data.ELPE = NVSimHealth.num_error_entries - 1
+
+        # Compare, Dataset Management and Write Zeroes supported
+        id_ctrl_data.ONCS = (1 << 0) | (1 << 2) | (1 << 3)
 
         return id_ctrl_data
 
+    def identify_namespace_zoned_data(self, nsid):
+        ''' Zoned Namespace Command Set specific Identify Namespace data, None if the
+            namespace is not zoned
+        '''
+        nvsim_ns = self.namespaces[nsid]
+        if not nvsim_ns.zoned:
+            return None
+
+        id_ns_zoned_data = IdentifyNamespaceZonedData()
+
+        # Maximum active and open resources, 0's based. All 1s means no limit
+        no_limit = 0xFFFFFFFF
+        id_ns_zoned_data.MAR = no_limit if nvsim_ns.max_active is None else nvsim_ns.max_active - 1
+        id_ns_zoned_data.MOR = no_limit if nvsim_ns.max_open is None else nvsim_ns.max_open - 1
+
+        # Same zone size for both LBA formats
+        id_ns_zoned_data.LBAFE_TBL[0].ZSZE = nvsim_ns.zone_size
+        id_ns_zoned_data.LBAFE_TBL[1].ZSZE = nvsim_ns.zone_size
+
+        return id_ns_zoned_data
+
+    def identify_controller_zoned_data(self):
+        id_ctrl_zoned_data = IdentifyControllerZonedData()
+
+        # Zone Append size limited by MDTS only
+        id_ctrl_zoned_data.ZASL = 0
+
+        return id_ctrl_zoned_data
+
+    def identify_io_cmd_set_data(self):
+        id_io_cmd_set_data = IdentifyIoCmdSetData()
+
+        # Only one combination, NVM and Zoned Namespace command sets
+        id_io_cmd_set_data.IoCmdSetVectors[0].NVMCmdSet = 1
+        id_io_cmd_set_data.IoCmdSetVectors[0].ZonedNamespaceCmdSet = 1
+
+        return id_io_cmd_set_data
+
     def identify_namespace_list_data(self):
         id_ns_list_data = IdentifyNamespaceListData()
 
@@ -167,6 +693,33 @@ class NVSimState:
 
         return id_uuid_list_data
 
+    def num_msix_vectors(self):
+        return self.interrupts.num_vectors if self.interrupts is not None else 0
+
+    def vaddr(self, iova):
+        return self.iova_base + iova
+
+    def sq_tail_doorbell(self, qid):
+        ''' Address the host writes a submission queue's tail to
+        '''
+        if qid != 0 and self.dbbuf_shadow is not None:
+            return self.dbbuf_shadow + (qid * 8)
+        return ctypes.addressof(self.nvme_regs.SQNDBS[0]) + (qid * 8)
+
+    def cq_head_doorbell(self, qid):
+        ''' Address the host writes a completion queue's head to
+        '''
+        if qid != 0 and self.dbbuf_shadow is not None:
+            return self.dbbuf_shadow + (qid * 8) + 4
+        return ctypes.addressof(self.nvme_regs.SQNDBS[0]) + (qid * 8) + 4
+
+    def update_sq_eventidx(self, sq):
+        ''' Once a shadowed submission queue is drained, ask the host to ring the
+            doorbell register on its next submission
+        '''
+        if sq.qid != 0 and self.dbbuf_eventidx is not None and sq.num_entries() == 0:
+            ctypes.c_uint32.from_address(self.dbbuf_eventidx + (sq.qid * 8)).value = sq.tail.value
+
     def check_mem_access(self, mem):
         ''' Tries to access mem. If this is not successful, then you will see a segfault
         '''
@@ -0,0 +1,95 @@
+import collections
+import threading
+import time
+
+from lone.nvme.spec.commands.admin.get_log_page import (GetLogPageSMARTData,
+                                                        GetLogPageErrorInformationData)
+
+import logging
+logger = logging.getLogger('nvsim_health')
+
+
+class NVSimHealth:
+    ''' SMART / Health counters and the Error Information log. Handlers only bump counters,
+        the log pages are built when the host asks for them
+    '''
+    num_error_entries = 256
+
+    def __init__(self):
+        self.power_on_time = time.monotonic()
+
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.host_read_commands = 0
+        self.host_write_commands = 0
+
+        # Time spent processing IO commands
+        self.busy_time_ns = 0
+
+        # Most recent errors last, and how many there ever were
+        self.errors = collections.deque(maxlen=self.num_error_entries)
+        self.error_count = 0
+
+        # Worker threads update the counters at the same time
+        self.lock = threading.Lock()
+
+    def host_read(self, num_bytes):
+        with self.lock:
+            self.host_read_commands += 1
+            self.bytes_read += num_bytes
+
+    def host_write(self, num_bytes):
+        with self.lock:
+            self.host_write_commands += 1
+            self.bytes_written += num_bytes
+
+    def busy(self, time_ns):
+        with self.lock:
+            self.busy_time_ns += time_ns
+
+    def error(self, command, sq, status_code):
+        entry = GetLogPageErrorInformationData.ErrorInformationEntry()
+        entry.SQID = sq.qid
+        entry.CID = command.CID
+        entry.SF = (status_code.sct << 8) | int(status_code)
+        entry.NS = command.NSID
+
+        with self.lock:
+            self.error_count += 1
+            entry.ErrorCount = self.error_count
+            self.errors.append(entry)
+
+    @staticmethod
+    def data_units(num_bytes):
+        # Thousands of 512 byte units, rounded up
+        return (num_bytes + 511999) // 512000
+
+    def smart_data(self):
+        smart_data = GetLogPageSMARTData()
+
+        smart_data.CompositeTemperature = 313
+        smart_data.AvailableSpare = 100
+        smart_data.AvailableSpareThreshold = 10
+
+        with self.lock:
+            smart_data.DataUnitsReadLo = self.data_units(self.bytes_read)
+            smart_data.DataUnitsWrittenLo = self.data_units(self.bytes_written)
+            smart_data.HostReadCommandsLo = self.host_read_commands
+            smart_data.HostWriteCommandsLo = self.host_write_commands
+            smart_data.ControllerBusyTimeLo = self.busy_time_ns // (60 * 1000000000)
+            smart_data.NumberofErrorInformationLogEntriesLo = self.error_count
+
+        smart_data.PowerCyclesLo = 1
+        smart_data.PowerOnHoursLo = int(time.monotonic() - self.power_on_time) // 3600
+
+        return smart_data
+
+    def error_information_data(self):
+        error_data = GetLogPageErrorInformationData()
+
+        # Newest entry first
+        with self.lock:
+            for i, entry in enumerate(reversed(self.errors)):
+                error_data.ERRORS[i] = entry
+
+        return error_data
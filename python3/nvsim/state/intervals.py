@@ -0,0 +1,102 @@
+import bisect
+import threading
+
+
+class NVSimIntervalMap:
+    ''' Set of [start, end) ranges kept as sorted, non overlapping, non adjacent ranges,
+        so adding, removing and looking up a range is O(log n) plus the ranges it touches.
+
+        starts and ends are changed in place with slice assignments. Changes and lookups
+        are serialized by lock, so other threads always see starts and ends that go
+        together
+    '''
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def covered(self):
+        ''' Returns how many units all ranges cover
+        '''
+        with self.lock:
+            return sum(self.ends) - sum(self.starts)
+
+    def clear(self):
+        with self.lock:
+            self.starts.clear()
+            self.ends.clear()
+
+    def copy(self):
+        ''' Returns a (starts, ends) copy of the ranges, to go back to with restore
+        '''
+        with self.lock:
+            return list(self.starts), list(self.ends)
+
+    def restore(self, ranges):
+        with self.lock:
+            self.starts[:] = ranges[0]
+            self.ends[:] = ranges[1]
+
+    def add(self, start, end):
+        if start >= end:
+            return
+
+        with self.lock:
+            starts, ends = self.starts, self.ends
+
+            # First range that ends at or after start, and first range that starts after end.
+            #  Everything in between overlaps or touches [start, end) and is merged into it
+            first = bisect.bisect_left(ends, start)
+            last = bisect.bisect_right(starts, end)
+            if first < last:
+                start = min(start, starts[first])
+                end = max(end, ends[last - 1])
+            starts[first:last] = [start]
+            ends[first:last] = [end]
+
+    def remove(self, start, end):
+        if start >= end:
+            return
+
+        with self.lock:
+            starts, ends = self.starts, self.ends
+
+            # Ranges that overlap [start, end), keeping the parts of them outside of it
+            first = bisect.bisect_right(ends, start)
+            last = bisect.bisect_left(starts, end)
+            if first >= last:
+                return
+
+            kept_starts = []
+            kept_ends = []
+            if starts[first] < start:
+                kept_starts.append(starts[first])
+                kept_ends.append(start)
+            if ends[last - 1] > end:
+                kept_starts.append(end)
+                kept_ends.append(ends[last - 1])
+            starts[first:last] = kept_starts
+            ends[first:last] = kept_ends
+
+    def split(self, start, end):
+        ''' Splits [start, end) into a list of (start, end, in_map) pieces, in order
+        '''
+        pieces = []
+        with self.lock:
+            starts, ends = self.starts, self.ends
+            first = bisect.bisect_right(ends, start)
+            for i in range(first, len(starts)):
+                if starts[i] >= end:
+                    break
+                if starts[i] > start:
+                    pieces.append((start, starts[i], False))
+                    start = starts[i]
+                piece_end = min(end, ends[i])
+                pieces.append((start, piece_end, True))
+                start = piece_end
+        if start < end:
+            pieces.append((start, end, False))
+        return pieces
@@ -0,0 +1,249 @@
+import ctypes
+import ctypes.util
+import mmap
+import os
+import tempfile
+import threading
+
+import logging
+logger = logging.getLogger('nvsim_storage')
+
+
+# fallocate modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+libc.memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+
+# Compared against to check memory is all zeros
+zeros = (ctypes.c_uint8 * (64 * 1024))()
+
+
+def is_zeroed(address, size):
+    while size > 0:
+        length = min(size, len(zeros))
+        if libc.memcmp(address, zeros, length) != 0:
+            return False
+        address += length
+        size -= length
+    return True
+
+
+class NVSimFileStorage:
+    ''' Storage backed by a file in directory (the system's temporary directory if None)
+        mmaped into memory. The file is sparse, so its footprint on disk grows as data is
+        written. It has no name, so it goes away once it is closed, even if the process
+        never gets to close it
+    '''
+    def __init__(self, size, directory=None):
+        self.size = size
+
+        # Create the file, every storage gets its own so simulators running at the same
+        #  time don't share data
+        self.fh = tempfile.TemporaryFile(prefix='nvsim_ns_', suffix='.dat', dir=directory)
+        self.fh.seek(self.size - 1)
+        self.fh.write(b'\0')
+        self.fh.flush()
+
+        # Mmap so we can easily access, and get its address so data can be memmoved
+        #  straight between it and host memory
+        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        self.mm_data = (ctypes.c_uint8 * self.size).from_buffer(self.mm)
+        self.address = ctypes.addressof(self.mm_data)
+
+    def read_into(self, offset, address, size):
+        assert offset + size <= self.size, 'Read past the end of storage'
+        ctypes.memmove(address, self.address + offset, size)
+
+    def write_from(self, offset, address, size):
+        assert offset + size <= self.size, 'Write past the end of storage'
+        ctypes.memmove(self.address + offset, address, size)
+
+    def compare(self, offset, address, size):
+        assert offset + size <= self.size, 'Compare past the end of storage'
+        return libc.memcmp(self.address + offset, address, size) == 0
+
+    def flush(self):
+        self.mm.flush()
+
+    def deallocate(self, offset, size):
+        ''' Punches a hole in the file so the range reads back as zeros and gives its
+            blocks back to the filesystem. The cost does not depend on size. Falls back
+            to writing zeros on filesystems that can't punch holes
+        '''
+        assert offset + size <= self.size, 'Deallocate past the end of storage'
+        if libc.fallocate(self.fh.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                          offset, size) != 0:
+            logger.debug('fallocate failed: {}, zeroing instead'.format(
+                os.strerror(ctypes.get_errno())))
+            ctypes.memset(self.address + offset, 0, size)
+
+    def format(self):
+        self.deallocate(0, self.size)
+
+    def close(self):
+        # The mmap cannot be closed while mm_data points into it
+        del self.mm_data
+        self.mm.close()
+        self.fh.close()
+
+
+class NVSimSparseStorage:
+    ''' Storage kept in memory as fixed size chunks, allocated the first time they are
+        written to. Chunks never written read back as zeros, so a namespace can be
+        as large as we want and only use memory for the data written to it.
+
+        Snapshots are copy on write: they share chunks with the storage, and a shared
+        chunk is only copied the first time it is written after the snapshot
+    '''
+    chunk_size = 1024 * 1024
+
+    def __init__(self, size):
+        self.size = size
+
+        # Allocated chunks, keyed by chunk index
+        self.chunks = {}
+
+        # Chunk map of the last snapshot taken or restored (None if there never was one),
+        #  and the chunks that changed since. Only changed chunks are not shared
+        self.base = None
+        self.changed = set()
+
+        # IO workers write from more than one thread, allocating and copying chunks
+        #  happens under the lock
+        self.lock = threading.Lock()
+
+    def chunk_ranges(self, offset, size):
+        ''' Splits size bytes at offset into (chunk_index, chunk_offset, length) pieces
+        '''
+        while size > 0:
+            chunk_index, chunk_offset = divmod(offset, self.chunk_size)
+            length = min(size, self.chunk_size - chunk_offset)
+            yield chunk_index, chunk_offset, length
+            offset += length
+            size -= length
+
+    def read_into(self, offset, address, size):
+        for chunk_index, chunk_offset, length in self.chunk_ranges(offset, size):
+            chunk = self.chunks.get(chunk_index)
+            if chunk is None:
+                ctypes.memset(address, 0, length)
+            else:
+                ctypes.memmove(address, ctypes.addressof(chunk) + chunk_offset, length)
+            address += length
+
+    def writable_chunk(self, chunk_index):
+        ''' Returns the chunk at chunk_index, ready to be written to
+        '''
+        # Chunks that are allocated and not shared with a snapshot don't need the lock.
+        #  A chunk is only marked changed once its copy is in place, so check that first
+        if self.base is None or chunk_index in self.changed:
+            chunk = self.chunks.get(chunk_index)
+            if chunk is not None:
+                return chunk
+
+        with self.lock:
+            chunk = self.chunks.get(chunk_index)
+
+            # Snapshots may share the chunk, write to a copy of it
+            if self.base is not None and chunk_index not in self.changed:
+                if chunk is not None:
+                    chunk = self.chunks[chunk_index] = (
+                        ctypes.c_uint8 * self.chunk_size).from_buffer_copy(chunk)
+                self.changed.add(chunk_index)
+
+            if chunk is None:
+                # ctypes arrays start out zeroed
+                chunk = self.chunks[chunk_index] = (ctypes.c_uint8 * self.chunk_size)()
+            return chunk
+
+    def write_from(self, offset, address, size):
+        for chunk_index, chunk_offset, length in self.chunk_ranges(offset, size):
+            chunk = self.writable_chunk(chunk_index)
+            ctypes.memmove(ctypes.addressof(chunk) + chunk_offset, address, length)
+            address += length
+
+    def compare(self, offset, address, size):
+        for chunk_index, chunk_offset, length in self.chunk_ranges(offset, size):
+            chunk = self.chunks.get(chunk_index)
+            if chunk is None:
+                if not is_zeroed(address, length):
+                    return False
+            elif libc.memcmp(ctypes.addressof(chunk) + chunk_offset, address, length) != 0:
+                return False
+            address += length
+        return True
+
+    def flush(self):
+        # Nothing to do, data only lives in memory
+        pass
+
+    def deallocate(self, offset, size):
+        ''' Frees the chunks fully inside the range, and zeros the parts of the ones
+            at its edges. Only the allocated chunks are looked at when there are fewer of
+            them than chunks in the range, so deallocating a huge range is cheap
+        '''
+        end = offset + size
+        full_start = -(-offset // self.chunk_size)
+        full_end = end // self.chunk_size
+
+        # Parts of chunks at the edges of the range
+        if full_start > full_end:
+            edges = [(offset, end)]
+        else:
+            edges = [(offset, full_start * self.chunk_size), (full_end * self.chunk_size, end)]
+        for start, stop in edges:
+            chunk_index, chunk_offset = divmod(start, self.chunk_size)
+            if stop > start and chunk_index in self.chunks:
+                ctypes.memset(ctypes.addressof(self.writable_chunk(chunk_index)) + chunk_offset,
+                              0, stop - start)
+
+        # Chunks fully inside the range
+        if full_end - full_start > len(self.chunks):
+            full_chunks = [i for i in self.chunks if full_start <= i < full_end]
+        else:
+            full_chunks = range(full_start, full_end)
+        for chunk_index in full_chunks:
+            if self.chunks.pop(chunk_index, None) is not None and self.base is not None:
+                self.changed.add(chunk_index)
+
+    def format(self):
+        if self.base is not None:
+            self.changed |= set(self.chunks)
+        self.chunks = {}
+
+    def snapshot(self):
+        ''' Returns a snapshot of the data. Only the chunk map is copied
+        '''
+        self.base = dict(self.chunks)
+        self.changed = set()
+        return self.base
+
+    def restore(self, snapshot):
+        ''' Goes back to the data in snapshot. Going back to the last snapshot taken or
+            restored only looks at the chunks changed since, any other one compares the
+            whole chunk maps
+        '''
+        if snapshot is self.base:
+            changed = self.changed
+        else:
+            changed = set(self.chunks) | set(snapshot)
+
+        for chunk_index in changed:
+            chunk = snapshot.get(chunk_index)
+            if chunk is None:
+                self.chunks.pop(chunk_index, None)
+            else:
+                self.chunks[chunk_index] = chunk
+
+        self.base = snapshot
+        self.changed = set()
+
+    @property
+    def allocated_bytes(self):
+        return len(self.chunks) * self.chunk_size
+
+    def close(self):
+        self.chunks = {}
@@ -0,0 +1,59 @@
+import threading
+import weakref
+
+import logging
+logger = logging.getLogger('nvsim_subsystem')
+
+
+class NVSimSubsystem:
+    ''' NVM subsystem the controller of a nvsim:N slot belongs to. Controllers created with
+        the same subsystem name are in the same subsystem, and see the same namespaces
+        like the paths to a multi-path device would. The namespaces are created by the
+        first controller in the subsystem, from its arguments.
+
+        A controller created without a subsystem name is in a subsystem of its own
+    '''
+    # Subsystems shared by name, they go away with their last controller
+    subsystems = weakref.WeakValueDictionary()
+    subsystems_lock = threading.Lock()
+
+    def __init__(self, name, shared=False):
+        self.name = name
+        self.shared = shared
+
+        self.nqn = 'nqn.2014-08.io.nvsim:{}'.format(name).encode()
+        self.serial = name.encode()[:20]
+
+        # NVSimNamespace list (index is nsid) once the first controller creates them, and
+        #  the CNTLIDs of the controllers in the subsystem, which have to be unique in it
+        self.namespaces = None
+        self.cntlids = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name):
+        ''' Returns the shared subsystem called name, creating it if there isn't one
+        '''
+        with cls.subsystems_lock:
+            subsystem = cls.subsystems.get(name)
+            if subsystem is None:
+                subsystem = cls.subsystems[name] = NVSimSubsystem(name, shared=True)
+            return subsystem
+
+    def attach(self, cntlid, create_namespaces):
+        ''' Returns the subsystem's namespaces for a new controller with cntlid, calling
+            create_namespaces() for them if it is the first one
+        '''
+        with self.lock:
+            assert cntlid not in self.cntlids, 'CNTLID {} already in subsystem {}'.format(
+                cntlid, self.name)
+            if self.namespaces is None:
+                self.namespaces = create_namespaces()
+            self.cntlids.add(cntlid)
+            return self.namespaces
+
+    def detach(self, cntlid):
+        ''' Called when the controller with cntlid goes away, so another one can use it
+        '''
+        with self.lock:
+            self.cntlids.discard(cntlid)
@@ -0,0 +1,206 @@
+''' Timing model for nvsim. Without one, commands complete as soon as nvsim processes them.
+    With one, completions are held back until the time the model says they are due, so
+    hosts see latencies, queue depth effects and throughput limits close to a real drive's.
+'''
+import heapq
+import math
+import random
+import threading
+import time
+import weakref
+
+from lone.nvme.spec.commands.nvm.read import Read
+from lone.nvme.spec.commands.nvm.write import Write
+from lone.nvme.spec.commands.nvm.compare import Compare
+from lone.nvme.spec.commands.zns.zone_append import ZoneAppend
+
+import logging
+logger = logging.getLogger('nvsim_timing')
+
+
+class NVSimLatency:
+    ''' Latency distribution, in microseconds. dist is one of:
+            fixed:     always mean_us
+            normal:    normal distribution with mean_us and stddev_us, never below 0
+            lognormal: lognormal distribution with mean_us and stddev_us
+    '''
+    dists = ['fixed', 'normal', 'lognormal']
+
+    def __init__(self, dist='fixed', mean_us=0, stddev_us=0, seed=None):
+        assert dist in self.dists, '{} latency distribution not supported'.format(dist)
+        self.dist = dist
+        self.mean_us = mean_us
+        self.stddev_us = stddev_us
+        self.random = random.Random(seed)
+
+        # Parameters of the normal distribution behind the lognormal one
+        if self.dist == 'lognormal':
+            assert self.mean_us > 0, 'lognormal latency needs mean_us > 0'
+            self.sigma = math.sqrt(math.log(1 + (self.stddev_us / self.mean_us) ** 2))
+            self.mu = math.log(self.mean_us) - (self.sigma ** 2) / 2
+
+    def sample_us(self):
+        if self.dist == 'fixed':
+            return self.mean_us
+        elif self.dist == 'normal':
+            return max(0, self.random.gauss(self.mean_us, self.stddev_us))
+        else:
+            return self.random.lognormvariate(self.mu, self.sigma)
+
+
+class NVSimTimingModel:
+    ''' Decides when each IO command completes.
+
+        latencies:     dictionary of NVM opcode to NVSimLatency, opcodes not in it use
+                       default_latency
+        bandwidth_mbps: media bandwidth shared by all data transfers, None for no limit
+        iops:          maximum commands started per second, None for no limit
+        parallelism:   number of commands the media works on at the same time
+    '''
+    def __init__(self, latencies=None, default_latency=None, bandwidth_mbps=None, iops=None,
+                 parallelism=1):
+        self.latencies = latencies if latencies is not None else {}
+        self.default_latency = default_latency if default_latency is not None else NVSimLatency()
+        self.bandwidth_mbps = bandwidth_mbps
+        self.iops = iops
+        self.parallelism = parallelism
+        self.reset()
+
+    @classmethod
+    def from_profile(cls, profile):
+        ''' Creates a model from a drive profile dictionary (for example from a yml file):
+                latencies:  {opc: {dist: ..., mean_us: ..., stddev_us: ...}, ...}
+                default_latency: {dist: ..., mean_us: ..., stddev_us: ...}
+                bandwidth_mbps, iops, parallelism: as in NVSimTimingModel
+        '''
+        latencies = {int(opc): NVSimLatency(**lat) for
+                     opc, lat in profile.get('latencies', {}).items()}
+        default_latency = NVSimLatency(**profile.get('default_latency', {}))
+        return cls(latencies,
+                   default_latency,
+                   profile.get('bandwidth_mbps'),
+                   profile.get('iops'),
+                   profile.get('parallelism', 1))
+
+    def reset(self):
+        # Times each of the parallel units is free again, and the time the media bus
+        #  and the next IOPS slot are free
+        self.units = [0.0] * self.parallelism
+        self.bus_free = 0.0
+        self.next_iops_slot = 0.0
+
+    def due_time(self, opc, num_bytes, now):
+        ''' Returns the time (in time.perf_counter() seconds) a command that started at now
+            with num_bytes of data completes
+        '''
+        start = max(now, heapq.heappop(self.units))
+
+        if self.iops:
+            start = max(start, self.next_iops_slot)
+            self.next_iops_slot = start + (1 / self.iops)
+
+        end = start
+        if self.bandwidth_mbps and num_bytes:
+            end = max(start, self.bus_free) + (num_bytes / (self.bandwidth_mbps * 1000000))
+            self.bus_free = end
+
+        latency = self.latencies.get(opc, self.default_latency)
+        due = end + (latency.sample_us() / 1000000)
+
+        # The unit is busy with this command until it is done
+        heapq.heappush(self.units, due)
+        return due
+
+
+class NVSimCompletionScheduler:
+    ''' Holds IO completions in a priority queue per completion queue, ordered by due time,
+        and posts them to their completion queues once they are due. Without a timing model
+        completions are only held back by delays injected into them
+    '''
+    def __init__(self, timing_model, nvsim_state):
+        self.timing_model = timing_model
+
+        # nvsim_state owns the scheduler, a proxy keeps it from holding on to it
+        self.nvsim_state = weakref.proxy(nvsim_state)
+
+        # Dictionary of cq to its entries, (due_time, sequence, cqe, sq). sequence keeps
+        #  completions due at the same time in the order they were scheduled. A full cq
+        #  only holds back its own completions
+        self.pending = {}
+        self.sequence = 0
+
+        # Worker threads schedule completions, the simulator thread (or the worker that owns
+        #  the CQ) posts them
+        self.lock = threading.Lock()
+
+    def transfer_bytes(self, command):
+        if command.OPC in [Read().OPC, Write().OPC, Compare().OPC, ZoneAppend().OPC]:
+            ns = self.nvsim_state.namespaces[command.NSID]
+            return ((command.DW12 & 0xFFFF) + 1) * ns.block_size
+        return 0
+
+    def schedule(self, command, cqe, sq, cq, delay_us=0):
+        now = time.perf_counter()
+        with self.lock:
+            due = now
+            if self.timing_model is not None:
+                due = self.timing_model.due_time(command.OPC, self.transfer_bytes(command), now)
+            due += delay_us / 1000000
+            heapq.heappush(self.pending.setdefault(cq, []), (due, self.sequence, cqe, sq))
+            self.sequence += 1
+
+    def num_held(self, cq):
+        ''' Returns how many completions for cq are scheduled but not posted yet
+        '''
+        return len(self.pending.get(cq, ()))
+
+    def due_cqs(self):
+        ''' Returns the CQs with completions that are due
+        '''
+        if not self.pending:
+            return []
+
+        now = time.perf_counter()
+        with self.lock:
+            return [cq for cq, entries in self.pending.items() if entries[0][0] <= now]
+
+    def post_due(self, cqs=None):
+        ''' Posts all completions that are due, only for cqs if given. Returns how many were
+            posted
+        '''
+        # Nothing held back, which is most of the time without a timing model
+        if not self.pending:
+            return 0
+
+        now = time.perf_counter()
+        posted = 0
+        with self.lock:
+            for cq, entries in list(self.pending.items()):
+                if cqs is not None and cq not in cqs:
+                    continue
+
+                # Completions the host did not make room for yet are tried again later
+                while entries and entries[0][0] <= now and not cq.is_full():
+
+                    # The host moves the SQ head to SQHD, so it has to be the head as of now
+                    #  and not as of when the command was processed
+                    due, sequence, cqe, sq = heapq.heappop(entries)
+                    cqe.SQHD = sq.head.value
+                    cq.post_completion(cqe)
+                    posted += 1
+
+                if not entries:
+                    del self.pending[cq]
+        return posted
+
+    def next_due(self):
+        if not self.pending:
+            return None
+        with self.lock:
+            return min((entries[0][0] for entries in self.pending.values()), default=None)
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+            if self.timing_model is not None:
+                self.timing_model.reset()
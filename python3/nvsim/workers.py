@@ -0,0 +1,80 @@
+import threading
+
+import logging
+logger = logging.getLogger('nvsim_worker')
+
+
+class NVSimWorker(threading.Thread):
+    ''' Thread that processes commands for the queue pairs it is given, and posts the
+        held back completions for the CQs it is given once they are due. A queue pair is
+        always given to the same worker, so only one thread posts to each CQ
+    '''
+    def __init__(self, process_func, post_func, name):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.process_func = process_func
+        self.post_func = post_func
+        self.exception = None
+
+        # Queue pairs with work to do, keyed by sqid, and CQs with completions due
+        self.pending = {}
+        self.due_cqs = set()
+        self.pending_lock = threading.Lock()
+
+        # Held while processing, so quiesce can wait for the current work to finish
+        self.busy_lock = threading.Lock()
+
+        self.work_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def submit(self, sq, cq):
+        with self.pending_lock:
+            self.pending[sq.qid] = (sq, cq)
+        self.work_event.set()
+
+    def submit_due(self, cq):
+        with self.pending_lock:
+            self.due_cqs.add(cq)
+        self.work_event.set()
+
+    def quiesce(self):
+        ''' Waits for the current work to finish, and drops everything not yet started
+        '''
+        with self.busy_lock:
+            with self.pending_lock:
+                self.pending = {}
+                self.due_cqs = set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.work_event.set()
+        self.join()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.work_event.wait()
+            self.work_event.clear()
+
+            with self.busy_lock:
+                with self.pending_lock:
+                    work = list(self.pending.values())
+                    self.pending = {}
+                    due_cqs, self.due_cqs = self.due_cqs, set()
+
+                try:
+                    if due_cqs:
+                        self.post_func(due_cqs)
+
+                    for sq, cq in work:
+                        processed = self.process_func(sq, cq)
+
+                        # Keep going on queues that got more commands while we were at it.
+                        #  Ones that made no progress have a full CQ, the simulator thread
+                        #  hands them back once the host rings its head doorbell
+                        if processed and sq.num_entries() > 0:
+                            self.submit(sq, cq)
+
+                except Exception as e:
+                    # The simulator thread picks this up and fails the controller
+                    logger.exception('{} EXCEPTION!'.format(self.name))
+                    self.exception = e
+                    break
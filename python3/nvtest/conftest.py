@@ -112,6 +112,20 @@ def lone_config(pytestconfig):
     return config
 
 
+def nvsim_kwargs(lone_config):
+    # The dut's nvsim section, if any, configures the simulator. For example:
+    #   dut:
+    #      pci_slot: nvsim
+    #      nvsim:
+    #         storage: sparse
+    #         namespaces:
+    #            - block_size: 4096
+    #              num_blocks: 0x1000
+    if lone_config['dut']['pci_slot'].startswith('nvsim') and 'nvsim' in lone_config['dut']:
+        return lone_config['dut']['nvsim']
+    return {}
+
+
 def cleanup(nvme_device):
     # Disabling will free all memory used by the device
     nvme_device.cc_disable()
@@ -120,7 +134,7 @@ def cleanup(nvme_device):
     del nvme_device.nvme_regs
 
     # Special nvsim handling TODO Make this an interface function instead!
-    if nvme_device.pci_slot == 'nvsim':
+    if nvme_device.pci_slot.startswith('nvsim'):
         nvme_device.sim_thread.stop()
         nvme_device.sim_thread.join()
     else:
@@ -141,7 +155,7 @@ def nvme_device_raw(lone_config):
             'Config must define a dut to use nvme_device_raw fixture')
         assert 'pci_slot' in lone_config['dut'], (
             'Config must define a dut pci_slot to use the nvme_device_raw fixture')
-        nvme_device = NVMeDevice(lone_config['dut']['pci_slot'])
+        nvme_device = NVMeDevice(lone_config['dut']['pci_slot'], **nvsim_kwargs(lone_config))
 
         yield nvme_device
 
@@ -158,7 +172,7 @@ def nvme_device(request, lone_config):
         'Config must define a dut to use nvme_device fixture')
     assert 'pci_slot' in lone_config['dut'], (
         'Config must define a dut pci_slot to use the nvme_device fixture')
-    nvme_device = NVMeDevice(lone_config['dut']['pci_slot'])
+    nvme_device = NVMeDevice(lone_config['dut']['pci_slot'], **nvsim_kwargs(lone_config))
 
     # Default initialization parameters
     asq_entries = 16
@@ -191,3 +205,87 @@ def nvme_device(request, lone_config):
     finally:
         if 'nvme_device' in locals():
             cleanup(nvme_device)
+
+
+@pytest.fixture(scope='function')
+def nvsim_devices(lone_config):
+    from lone.nvme.device import NVMeDevice
+
+    # For tests of the simulator itself. Returns a function that creates nvsim devices,
+    #  initialized with admin and IO queues. Its arguments are NVMeDevice arguments plus
+    #  the IO queues to create:
+    #    def test__test(nvsim_devices):
+    #        nvme_device = nvsim_devices('nvsim:0', storage='sparse', num_io_queues=2)
+    #  All of them are cleaned up when the test is done
+    if lone_config['dut']['pci_slot'] != 'nvsim':
+        pytest.skip('nvsim only test')
+    nvme_devices = []
+
+    def create(pci_slot='nvsim', num_io_queues=1, io_queue_entries=16, **kwargs):
+        nvme_device = NVMeDevice(pci_slot, **kwargs)
+        nvme_devices.append(nvme_device)
+
+        nvme_device.cc_disable()
+        nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
+        nvme_device.cc_enable()
+        nvme_device.init_io_queues(num_queues=num_io_queues, queue_entries=io_queue_entries)
+        nvme_device.identify()
+        return nvme_device
+
+    try:
+        yield create
+
+    finally:
+        for nvme_device in nvme_devices:
+            cleanup(nvme_device)
+
+
+@pytest.fixture(scope='function')
+def nvsim_device(request, nvsim_devices):
+    # A single nvsim device. Allow the caller to pass nvsim_devices arguments with
+    #    @pytest.mark.parametrize('nvsim_device', [{'storage': 'sparse'}], indirect=True)
+    #    def test__test(nvsim_device):
+    #        nvsim_device was created with the params passed above!
+    yield nvsim_devices(**getattr(request, 'param', {}))
+
+
+@pytest.fixture(scope='function')
+def multi_page_write_read(lone_config):
+    from lone.system import DMADirection
+    from lone.nvme.spec.prp import PRP
+    from lone.nvme.spec.commands.nvm.write import Write
+    from lone.nvme.spec.commands.nvm.read import Read
+
+    # Returns a function that writes num_pages pages to the dut's first namespace using
+    #  one command, reads them back and checks the data:
+    #    def test__test(nvme_device, multi_page_write_read):
+    #        multi_page_write_read(nvme_device, 4)
+    def write_read(nvme_device, num_pages):
+        test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+        ns = nvme_device.namespaces[test_nsid]
+        xfer_len = num_pages * nvme_device.mps
+        nlb = (xfer_len // ns.lba_ds_bytes) - 1
+
+        write_prp = PRP(xfer_len, nvme_device.mps)
+        write_prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
+        read_prp = PRP(xfer_len, nvme_device.mps)
+        read_prp.alloc(nvme_device, DMADirection.DEVICE_TO_HOST)
+
+        # Different data in every page, so pages out of order show up as a miscompare
+        data_out = bytes([i // nvme_device.mps for i in range(xfer_len)])
+        write_prp.set_data_buffer(data_out)
+        write_cmd = Write(NSID=test_nsid, SLBA=0, NLB=nlb)
+        write_cmd.DPTR.PRP.PRP1 = write_prp.prp1
+        write_cmd.DPTR.PRP.PRP2 = write_prp.prp2
+        nvme_device.sync_cmd(write_cmd, alloc_mem=False)
+
+        read_cmd = Read(NSID=test_nsid, SLBA=0, NLB=nlb)
+        read_cmd.DPTR.PRP.PRP1 = read_prp.prp1
+        read_cmd.DPTR.PRP.PRP2 = read_prp.prp2
+        nvme_device.sync_cmd(read_cmd, alloc_mem=False)
+        assert read_prp.get_data_buffer() == data_out
+
+        write_prp.free_all_memory()
+        read_prp.free_all_memory()
+
+    return write_read
@@ -1,16 +1,20 @@
 import pytest
 import time
+import ctypes
 from types import SimpleNamespace
 
 from lone.injection import Injector
 from lone.system import DMADirection, MemoryLocation
 from lone.nvme.device import NVMeDevice, NVMeDeviceCommon, NVMeDeviceIntType
+from lone.nvme.spec.registers.pcie_regs import PCIeRegistersDirect
+from lone.nvme.spec.registers.nvme_regs import NVMeRegistersDirect
 from lone.nvme.spec.structures import ADMINCommand, DataInCommon, DataOutCommon, CQE
 from lone.nvme.spec.commands.admin.identify import IdentifyController
 from lone.nvme.spec.commands.admin.format_nvm import FormatNVM
 from lone.nvme.spec.commands.nvm.write import Write
 from lone.nvme.spec.commands.nvm.read import Read
-from lone.nvme.spec.commands.status_codes import status_codes
+from lone.nvme.spec.commands.status_codes import status_codes, NVMeStatusCodeException
+from lone.util.trace import mmio_trace
 
 
 class IgnoreNVMeRegChanges(Injector):
@@ -51,7 +55,7 @@ def test_device_init(nvme_device):
     assert hasattr(nvme_device, 'injectors')
 
 
-def test_cc_disable(nvme_device_raw):
+def test_cc_disable(nvme_device_raw, tmp_path):
     nvme_device_raw.cc_disable()
     assert nvme_device_raw.nvme_regs.CSTS.RDY == 0
 
@@ -80,12 +84,18 @@ def test_cc_disable(nvme_device_raw):
         nvme_device_raw.init_admin_queues()
         nvme_device_raw.cc_enable(timeout_s=5)
 
+        # Trace register writes, and dump them once CFS is seen
+        mmio_trace.enable(num_records=1024, cfs_path=tmp_path / 'cfs_trace.txt')
+
         # Now tell the device to stop listening to CC.EN transitions
         injector = SetCFS(timeout_s=0.1)
         nvme_device_raw.injectors.register(injector)
         injector.wait(1)
         nvme_device_raw.cc_disable()
 
+        mmio_trace.disable()
+        assert (tmp_path / 'cfs_trace.txt').read_text() != ''
+
 
 def test_cc_enable(nvme_device_raw):
     nvme_device_raw.init_admin_queues(asq_entries=16, acq_entries=16)
@@ -157,10 +167,71 @@ def test_get_msix_completions(nvme_device_raw, mocker):
     mocker.patch.object(nvme_device_raw, 'get_completion', side_effect=[True, False])
     nvme_device_raw.get_msix_completions(0)
 
+    # With an MSI-X table, the vector is masked while the queue is drained
+    masked = []
+    nvme_device_raw.msix_table = SimpleNamespace(mask=lambda v: masked.append(v),
+                                                 unmask=lambda v: masked.remove(v))
+    drained = []
+
+    def get_completion(cqid):
+        drained.append(len(masked))
+        return len(drained) < 3
+    mocker.patch.object(nvme_device_raw, 'get_completion', side_effect=get_completion)
+    assert nvme_device_raw.get_msix_completions(0) == 2
+    assert drained == [1, 1, 1]
+    assert masked == []
+    nvme_device_raw.msix_table = None
+
     mocker.patch.object(nvme_device_raw, 'get_msix_vector_pending_count', return_value=False)
     nvme_device_raw.get_msix_completions(0, max_time_s=0.1)
 
 
+def test_init_doorbell_buffer(lone_config, nvme_device_raw):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # Doorbell buffer before the IO queues are created
+    test_init_admin_queues(nvme_device_raw)
+    nvme_device_raw.cc_enable()
+    nvme_device_raw.init_doorbell_buffer()
+    with pytest.raises(AssertionError):
+        nvme_device_raw.init_doorbell_buffer()
+    nvme_device_raw.init_io_queues(num_queues=2, queue_entries=16)
+    nvme_device_raw.identify()
+
+    # Wrap around the IO queues a few times
+    for i in range(40):
+        nvme_device_raw.sync_cmd(Write(NSID=test_nsid, NLB=0))
+        nvme_device_raw.sync_cmd(Read(NSID=test_nsid, NLB=0))
+
+    # Doorbell buffer after the IO queues are created
+    nvme_device_raw.cc_disable()
+    assert nvme_device_raw.dbbuf_shadow_mem is None
+    test_init_admin_queues(nvme_device_raw)
+    nvme_device_raw.cc_enable()
+    nvme_device_raw.init_io_queues(num_queues=2, queue_entries=16)
+    for i in range(10):
+        nvme_device_raw.sync_cmd(Write(NSID=test_nsid, NLB=0))
+    nvme_device_raw.init_doorbell_buffer()
+    for i in range(40):
+        nvme_device_raw.sync_cmd(Write(NSID=test_nsid, NLB=0))
+        nvme_device_raw.sync_cmd(Read(NSID=test_nsid, NLB=0))
+
+    # Failure path, only nvsim supports injectors for now
+    if nvme_device_raw.pci_slot == 'nvsim':
+        nvme_device_raw.cc_disable()
+        test_init_admin_queues(nvme_device_raw)
+        nvme_device_raw.cc_enable()
+        nvme_device_raw.init_io_queues(num_queues=1, queue_entries=16)
+
+        injector = FailCommand(sc=status_codes['Invalid Field in Command'])
+        nvme_device_raw.injectors.register(injector)
+        injector.wait(1)
+        with pytest.raises(NVMeStatusCodeException):
+            nvme_device_raw.init_doorbell_buffer()
+        assert nvme_device_raw.dbbuf_shadow_mem is None
+        nvme_device_raw.sync_cmd(Write(NSID=test_nsid, NLB=0))
+
+
 def test_free_io_queues(nvme_device_raw):
     test_init_admin_queues(nvme_device_raw)
     nvme_device_raw.cc_enable()
@@ -400,11 +471,40 @@ def test_alloc_cmd_memory(lone_config, nvme_device):
     nvme_device.free_cmd_memory(cmd)
 
 
+def test_mocked_physical_device_capability_cache(mocker):
+    ''' Devices created on the same slot walk the capability lists once
+    '''
+    def pci_regs():
+        pcie_regs = PCIeRegistersDirect()
+        pcie_regs.CAP.CP = 0x40
+        pcie_regs.CAPS.DATA[0x00] = pcie_regs.PCICapMSIX._cap_id_
+        return pcie_regs
+
+    mocked_nvme_regs = SimpleNamespace(CC=SimpleNamespace(MPS=4096))
+    mocked_system = SimpleNamespace(pci_regs=pci_regs, nvme_regs=lambda: mocked_nvme_regs)
+    mocker.patch('lone.system.System.PciUserspaceDevice', return_value=mocked_system)
+    mocker.patch('lone.system.System.MemoryMgr', return_value=None)
+    spy = mocker.spy(PCIeRegistersDirect, 'capability_layout')
+
+    PCIeRegistersDirect.invalidate_capabilities('cache_slot')
+    first_dev = NVMeDevice('cache_slot')
+    second_dev = NVMeDevice('cache_slot')
+    assert spy.call_count == 1
+    assert second_dev.pcie_regs._capability_layout is first_dev.pcie_regs._capability_layout
+    assert len(second_dev.pcie_regs.capabilities) == 1
+
+    # Until it is refreshed, after a FLR for example
+    second_dev.pcie_regs.init_capabilities(cache_key='cache_slot', refresh=True)
+    assert spy.call_count == 2
+    PCIeRegistersDirect.invalidate_capabilities('cache_slot')
+
+
 def test_mocked_physical_device(mocker):
     ''' Test a heavily mocked version of a physical PCIe device
     '''
-    mocked_pcie_regs = SimpleNamespace(init_capabilities=lambda: None,
-                                       CMD=SimpleNamespace(BME=0))
+    mocked_pcie_regs = SimpleNamespace(init_capabilities=lambda cache_key=None: None,
+                                       CMD=SimpleNamespace(BME=0),
+                                       capabilities=[])
     mocked_nvme_regs = SimpleNamespace(CC=SimpleNamespace(MPS=4096),
                                        CSTS=SimpleNamespace(CFS=0, RDY=0),
                                        SQNDBS=[])
@@ -434,3 +534,20 @@ def test_mocked_physical_device(mocker):
 
     phys_dev.init_msix_interrupts(2)
     phys_dev.get_msix_vector_pending_count(0)
+    assert phys_dev.msix_table is None
+
+    # With an MSI-X capability, the MSI-X table is at its offset in BAR0
+    phys_dev.pcie_regs = PCIeRegistersDirect()
+    phys_dev.pcie_regs.CAP.CP = 0x40
+    phys_dev.pcie_regs.CAPS.DATA[0x00] = phys_dev.pcie_regs.PCICapMSIX._cap_id_
+    phys_dev.pcie_regs.init_capabilities()
+    phys_dev.pcie_regs.capabilities[0].MTAB.TO = 0x2000 >> 3
+    phys_dev.nvme_regs = NVMeRegistersDirect()
+    phys_dev.init_msix_interrupts(2)
+    assert ctypes.addressof(phys_dev.msix_table.table[0]) == (
+        ctypes.addressof(phys_dev.nvme_regs) + 0x2000)
+
+
+@pytest.mark.parametrize('num_pages', [2, 4, 64])
+def test_multi_page_write_read(nvme_device, multi_page_write_read, num_pages):
+    multi_page_write_read(nvme_device, num_pages)
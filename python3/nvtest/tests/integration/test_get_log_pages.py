@@ -2,6 +2,9 @@ import pytest
 
 from lone.nvme.spec.commands.admin.get_log_page import GetLogPage
 from lone.nvme.spec.commands.admin.get_log_page import GetLogPageSupportedLogPages
+from lone.nvme.spec.commands.admin.get_log_page import GetLogPageSMART
+from lone.nvme.spec.commands.nvm.write import Write
+from lone.nvme.spec.commands.nvm.read import Read
 from lone.nvme.spec.commands.status_codes import NVMeStatusCodeException
 
 
@@ -27,3 +30,23 @@ def test_get_supported_logpages(nvme_device):
             # However if the page is supported, make sure the drive
             #   reports support for LID0
             assert glp_sup_lps.data_in.LIDS[0].LSUPP == 1
+
+
+def test_get_smart_log(lone_config, nvme_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    glp_smart = GetLogPageSMART()
+    nvme_device.sync_cmd(glp_smart, timeout_s=1)
+    before = glp_smart.data_in
+
+    # Host commands and data units count the IO we do
+    for i in range(4):
+        nvme_device.sync_cmd(Write(NSID=test_nsid, SLBA=i, NLB=0))
+    nvme_device.sync_cmd(Read(NSID=test_nsid, SLBA=0, NLB=0))
+
+    glp_smart = GetLogPageSMART()
+    nvme_device.sync_cmd(glp_smart, timeout_s=1)
+    after = glp_smart.data_in
+    assert after.HostWriteCommandsLo >= before.HostWriteCommandsLo + 4
+    assert after.HostReadCommandsLo >= before.HostReadCommandsLo + 1
+    assert after.DataUnitsWrittenLo >= before.DataUnitsWrittenLo
@@ -0,0 +1,1095 @@
+import gc
+import os
+import pytest
+import time
+import threading
+import ctypes
+from types import SimpleNamespace
+
+from lone.injection import InjectionRule
+from lone.system import DMADirection
+from lone.nvme.device import NVMeDevice
+from lone.nvme.spec.structures import CQE
+from lone.nvme.spec.commands.admin.identify import IdentifyController
+from lone.nvme.spec.commands.admin.format_nvm import FormatNVM
+from lone.nvme.spec.commands.admin.create_io_completion_q import CreateIOCompletionQueue
+from lone.nvme.spec.commands.nvm.write import Write
+from lone.nvme.spec.commands.nvm.read import Read
+from lone.nvme.spec.commands.nvm.flush import Flush
+from lone.nvme.spec.commands.nvm.compare import Compare
+from lone.nvme.spec.commands.nvm.write_zeroes import WriteZeroes
+from lone.nvme.spec.commands.nvm.dataset_management import (DatasetManagement,
+                                                            DatasetManagementRange)
+from lone.nvme.spec.commands.admin.identify import (IdentifyNamespaceZoned,
+                                                    IdentifyControllerZoned,
+                                                    IdentifyIoCmdSet)
+from lone.nvme.spec.commands.zns.zone_management_send import ZoneManagementSend
+from lone.nvme.spec.commands.zns.zone_management_receive import (ZoneManagementReceive,
+                                                                 ZoneDescriptor)
+from lone.nvme.spec.commands.zns.zone_append import ZoneAppend
+from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.commands.status_codes import status_codes, NVMeStatusCodeException
+
+
+@pytest.mark.parametrize('nvsim_device', [{'num_workers': 2, 'num_io_queues': 4}], indirect=True)
+def test_nvsim_workers(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    workers = nvme_device.sim_thread.nvme_handler.all_workers()
+    assert len(workers) == 3
+    for i in range(2):
+        # Again after the workers dropped everything on a disable
+        if i > 0:
+            nvme_device.cc_disable()
+            nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
+            nvme_device.cc_enable()
+            nvme_device.init_io_queues(num_queues=4, queue_entries=16)
+            nvme_device.identify()
+
+        # Keep commands outstanding on all IO queues at the same time
+        commands = []
+        for slba in range(12):
+            commands.append(Write(NSID=test_nsid, SLBA=slba, NLB=0))
+            nvme_device.start_cmd(commands[-1])
+        while not all(c.complete for c in commands):
+            nvme_device.process_completions()
+        assert all(c.cqe.SF.SC == 0 for c in commands)
+        for c in commands:
+            nvme_device.free_cmd_memory(c)
+
+    # Workers stop with the simulator
+    nvme_device.cc_disable()
+    nvme_device.sim_thread.stop()
+    nvme_device.sim_thread.join()
+    assert all(not w.is_alive() for w in workers)
+
+
+@pytest.mark.parametrize('nvsim_device', [{'num_io_queues': 0},
+                                          {'num_io_queues': 0, 'num_workers': 1}],
+                         indirect=True)
+def test_nvsim_full_cq(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # A CQ with room for 3 completions, for a SQ with room for 15 commands
+    nvme_device = nvsim_device
+    nvme_device.create_io_queue_pair(4, 1, 1, 1, 1, 16, 1, 0, 1, 0)
+    nvme_handler = nvme_device.sim_thread.nvme_handler
+    process_calls = []
+
+    def process_sq(sq, cq, max_commands=None):
+        process_calls.append(sq.qid)
+        return type(nvme_handler).process_sq(nvme_handler, sq, cq, max_commands)
+
+    nvme_handler.process_sq = process_sq
+    for worker in nvme_handler.all_workers():
+        worker.process_func = process_sq
+
+    # Queue up more commands than the CQ has room for
+    commands = [Write(NSID=test_nsid, SLBA=slba, NLB=0) for slba in range(6)]
+    for command in commands:
+        nvme_device.start_cmd(command)
+    sq = nvme_handler.nvsim_state.queue_mgr.get(1, 1)[0]
+    end_time = time.monotonic() + 1
+    while sq.num_entries() > 3 and time.monotonic() < end_time:
+        time.sleep(0.01)
+    assert sq.num_entries() == 3
+
+    # The simulator waits for the host to make room instead of spinning on the queue
+    num_calls = len(process_calls)
+    time.sleep(0.1)
+    assert len(process_calls) == num_calls
+
+    # Consuming completions rings the CQ head doorbell, which gets the queue going again
+    while not all(c.complete for c in commands):
+        nvme_device.process_completions()
+    assert all(c.cqe.SF.SC == 0 for c in commands)
+    for c in commands:
+        nvme_device.free_cmd_memory(c)
+
+
+@pytest.mark.parametrize('nvsim_device', [{'storage': 'sparse'}], indirect=True)
+def test_nvsim_sparse_storage(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+
+    # Nothing allocated until we write
+    storage = nvme_device.sim_thread.nvsim_state.namespaces[test_nsid].storage
+    assert storage.allocated_bytes == 0
+
+    ns = nvme_device.namespaces[test_nsid]
+    xfer_len = 4096
+    nlb = (xfer_len // ns.lba_ds_bytes) - 1
+    slba = ns.nsze - (nlb + 1)
+
+    write_prp = PRP(xfer_len, nvme_device.mps)
+    write_prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
+    read_prp = PRP(xfer_len, nvme_device.mps)
+    read_prp.alloc(nvme_device, DMADirection.DEVICE_TO_HOST)
+
+    # Write the last LBAs in the namespace, only one chunk gets allocated
+    data_out = bytes([0xED] * xfer_len)
+    write_prp.set_data_buffer(data_out)
+    write_cmd = Write(NSID=test_nsid, SLBA=slba, NLB=nlb)
+    write_cmd.DPTR.PRP.PRP1 = write_prp.prp1
+    nvme_device.sync_cmd(write_cmd, alloc_mem=False)
+    assert storage.allocated_bytes == storage.chunk_size
+
+    read_cmd = Read(NSID=test_nsid, SLBA=slba, NLB=nlb)
+    read_cmd.DPTR.PRP.PRP1 = read_prp.prp1
+    nvme_device.sync_cmd(read_cmd, alloc_mem=False)
+    assert read_prp.get_data_buffer() == data_out
+
+    # LBAs never written read back as zeros, and do not allocate
+    read_cmd = Read(NSID=test_nsid, SLBA=0, NLB=nlb)
+    read_cmd.DPTR.PRP.PRP1 = read_prp.prp1
+    nvme_device.sync_cmd(read_cmd, alloc_mem=False)
+    assert read_prp.get_data_buffer() == bytes(xfer_len)
+    assert storage.allocated_bytes == storage.chunk_size
+
+    # Deallocating only looks at allocated chunks, and zeros the edges of the range
+    from nvsim.state.storage import NVSimSparseStorage
+    big_storage = NVSimSparseStorage(1 << 40)
+    chunk_data = (ctypes.c_uint8 * (3 * storage.chunk_size))()
+    ctypes.memset(chunk_data, 0xED, len(chunk_data))
+    big_storage.write_from(0, ctypes.addressof(chunk_data), len(chunk_data))
+    big_storage.write_from((1 << 40) - storage.chunk_size, ctypes.addressof(chunk_data),
+                           storage.chunk_size)
+    big_storage.deallocate(100, (1 << 40) - 200)
+    assert sorted(big_storage.chunks) == [0, (1 << 40) // storage.chunk_size - 1]
+    check_data = (ctypes.c_uint8 * storage.chunk_size)()
+    big_storage.read_into(0, ctypes.addressof(check_data), storage.chunk_size)
+    assert bytes(check_data[:100]) == bytes([0xED] * 100)
+    assert bytes(check_data[100:]) == bytes(storage.chunk_size - 100)
+    big_storage.read_into((1 << 40) - storage.chunk_size, ctypes.addressof(check_data),
+                          storage.chunk_size)
+    assert bytes(check_data[-100:]) == bytes([0xED] * 100)
+    assert bytes(check_data[:-100]) == bytes(storage.chunk_size - 100)
+
+    # A range inside a single chunk
+    big_storage.deallocate(10, 20)
+    big_storage.read_into(0, ctypes.addressof(check_data), 100)
+    assert bytes(check_data[:100]) == bytes([0xED] * 10) + bytes(20) + bytes([0xED] * 70)
+
+    # Threads writing to the same new or shared chunks at the same time don't lose writes
+    big_storage.snapshot()
+    offsets = [i * storage.chunk_size // 8 for i in range(16)]
+
+    def write(offset):
+        big_storage.write_from(offset, ctypes.addressof(chunk_data), 1)
+
+    threads = [threading.Thread(target=write, args=(offset,)) for offset in offsets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for offset in offsets:
+        big_storage.read_into(offset, ctypes.addressof(check_data), 1)
+        assert check_data[0] == 0xED
+
+
+@pytest.mark.parametrize('nvsim_device', [
+    {'timing': {'latencies': {Write().OPC: {'dist': 'fixed', 'mean_us': 500000}}}}], indirect=True)
+def test_nvsim_timing(lone_config, nvsim_device):
+    from nvsim.timing import NVSimTimingModel, NVSimLatency, NVSimCompletionScheduler
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # Two commands in parallel, the third one waits for one of them
+    model = NVSimTimingModel(default_latency=NVSimLatency('fixed', 100), parallelism=2)
+    assert [model.due_time(0x02, 0, 0) for i in range(3)] == [0.0001, 0.0001, 0.0002]
+
+    # Bandwidth and IOPS limits
+    model = NVSimTimingModel(bandwidth_mbps=1, parallelism=4)
+    assert [model.due_time(0x01, 1000000, 0) for i in range(2)] == [1, 2]
+    model = NVSimTimingModel(iops=10, parallelism=4)
+    assert [round(model.due_time(0x01, 0, 0), 6) for i in range(3)] == [0, 0.1, 0.2]
+
+    for dist in NVSimLatency.dists:
+        latency = NVSimLatency(dist, 50, 10, seed=1)
+        assert latency.sample_us() >= 0
+    with pytest.raises(AssertionError):
+        NVSimLatency('uniform')
+
+    # Writes take at least as long as the profile says
+    nvme_device = nvsim_device
+    write_cmd = Write(NSID=test_nsid, NLB=0)
+    nvme_device.sync_cmd(write_cmd)
+    assert write_cmd.time_s >= 0.5
+    read_cmd = Read(NSID=test_nsid, NLB=0)
+    nvme_device.sync_cmd(read_cmd)
+    assert read_cmd.time_s < 0.5
+
+    # A full CQ only holds back its own completions
+    class TestCQ:
+        def __init__(self, full):
+            self.full = full
+            self.posted = []
+
+        def is_full(self):
+            return self.full
+
+        def post_completion(self, cqe):
+            self.posted.append(cqe)
+
+    scheduler = NVSimCompletionScheduler(None, nvme_device.sim_thread.nvsim_state)
+    full_cq, cq = TestCQ(True), TestCQ(False)
+    sq = SimpleNamespace(head=SimpleNamespace(value=3))
+    scheduler.schedule(Read(), CQE(), sq, full_cq)
+    scheduler.schedule(Read(), CQE(), sq, cq)
+    assert scheduler.post_due() == 1
+    assert cq.posted[0].SQHD == 3
+    assert scheduler.num_held(full_cq) == 1 and scheduler.num_held(cq) == 0
+    full_cq.full = False
+    assert scheduler.post_due() == 1 and scheduler.next_due() is None
+
+    # Outstanding completions go away on disable
+    nvme_device.start_cmd(Write(NSID=test_nsid, NLB=0))
+    time.sleep(0.001)
+    nvme_device.cc_disable()
+    assert nvme_device.sim_thread.nvsim_state.scheduler.next_due() is None
+
+
+@pytest.mark.parametrize('nvsim_device', [{'process': True, 'storage': 'sparse',
+                                           'num_io_queues': 2}], indirect=True)
+def test_nvsim_process(lone_config, nvsim_device, multi_page_write_read):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    nvme_device.init_doorbell_buffer()
+
+    # Addresses the simulator sees are offsets into the shared memory
+    assert nvme_device.nvme_regs.ASQ.ASQB < nvme_device.shm.size
+
+    # The child would never see injectors registered here
+    with pytest.raises(AssertionError):
+        nvme_device.injectors.register(InjectionRule(Write().OPC, delay_us=1))
+
+    for num_pages in [2, 4, 64]:
+        multi_page_write_read(nvme_device, num_pages)
+    for i in range(20):
+        nvme_device.sync_cmd(Write(NSID=test_nsid, SLBA=i, NLB=0))
+        nvme_device.sync_cmd(Read(NSID=test_nsid, SLBA=i, NLB=0))
+
+    # The child process and the shared memory go away with the device. The fixture holds
+    #  on to its device, so use one of our own
+    nvme_device = NVMeDevice('nvsim', process=True)
+    process = nvme_device.sim_thread.process
+    shm = nvme_device.shm
+    del nvme_device
+    gc.collect()
+    assert not process.is_alive()
+    assert shm.mm.closed
+
+
+# A coalesce time much longer than the test, so only the threshold interrupts until the test
+#  lowers it
+@pytest.mark.parametrize('nvsim_device', [{'coalesce_threshold': 4,
+                                           'coalesce_time_us': 60000000}], indirect=True)
+def test_nvsim_msix(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    interrupts = nvme_device.interrupts
+    nvme_device.cc_disable()
+    nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
+    with pytest.raises(AssertionError):
+        nvme_device.init_msix_interrupts(nvme_device.msix_table_size + 1)
+    nvme_device.init_msix_interrupts(2)
+    nvme_device.cc_enable()
+    nvme_device.init_io_queues(num_queues=1, queue_entries=16)
+    nvme_device.identify()
+
+    # Admin completions are not coalesced, and interrupt on vector 0
+    assert nvme_device.get_msix_vector_pending_count(0) == 0
+    nvme_device.sync_cmd(IdentifyController(), timeout_s=1)
+    assert nvme_device.get_msix_vector_pending_count(0) == 0
+
+    # One IO completion is not enough to interrupt, it stays pending on the IO queue's vector
+    vector = nvme_device.queue_mgr.get(1, 1)[1].int_vector
+    write_cmd = Write(NSID=test_nsid, NLB=0)
+    nvme_device.start_cmd(write_cmd)
+    end_time = time.time() + 5
+    while interrupts.pending[vector] == 0 and time.time() < end_time:
+        time.sleep(0.001)
+    assert interrupts.pending[vector] == 1
+    assert nvme_device.get_msix_vector_pending_count(vector) == 0
+
+    # After coalesce_time_us it interrupts anyway
+    interrupts.coalesce_time_us = 0
+    while not write_cmd.complete:
+        nvme_device.process_completions(max_completions=1, max_time_s=1)
+    assert interrupts.pending[vector] == 0
+
+    # Enough completions interrupt without waiting for coalesce_time_us
+    interrupts.coalesce_time_us = 60000000
+    commands = [Write(NSID=test_nsid, SLBA=i, NLB=0) for i in range(4)]
+    for command in commands:
+        nvme_device.start_cmd(command)
+    while not all(c.complete for c in commands):
+        nvme_device.process_completions(max_completions=4, max_time_s=1)
+    assert interrupts.pending[vector] == 0
+
+    # Vectors the device does not have
+    cq_mem = nvme_device.malloc_and_map_iova(4096, DMADirection.DEVICE_TO_HOST)
+    create_iocq_cmd = CreateIOCompletionQueue(QID=2, QSIZE=15, PC=1, IEN=1,
+                                              IV=nvme_device.msix_table_size)
+    create_iocq_cmd.DPTR.PRP.PRP1 = cq_mem.iova
+    with pytest.raises(NVMeStatusCodeException):
+        nvme_device.sync_cmd(create_iocq_cmd, timeout_s=1)
+    nvme_device.free_and_unmap_iova(cq_mem)
+
+    # No interrupts are left behind once the device is gone
+    nvme_device.cc_disable()
+    nvme_device.sim_thread.stop()
+    nvme_device.sim_thread.join()
+    nvme_device.__del__()
+    assert interrupts.eventfds == []
+
+
+@pytest.mark.parametrize('nvsim_device', [{'storage': 'file'}, {'storage': 'sparse'}],
+                         ids=['file', 'sparse'], indirect=True)
+def test_nvsim_format(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    ns = nvme_device.sim_thread.nvsim_state.namespaces[test_nsid]
+    chunk_size = 1024 * 1024
+    data = (ctypes.c_uint8 * (2 * chunk_size))()
+
+    # Data written before a format reads back as zeros after it
+    ctypes.memset(data, 0xED, len(data))
+    ns.storage.write_from(0, ctypes.addressof(data), len(data))
+    nvme_device.sync_cmd(FormatNVM(NSID=test_nsid), timeout_s=1)
+    ns.storage.read_into(0, ctypes.addressof(data), len(data))
+    assert bytes(data) == bytes(len(data))
+
+    # Deallocate part of the data, across a chunk boundary
+    ctypes.memset(data, 0xED, len(data))
+    ns.storage.write_from(0, ctypes.addressof(data), len(data))
+    ns.deallocate(4096 // ns.block_size, (chunk_size + 4096) // ns.block_size)
+    ns.storage.read_into(0, ctypes.addressof(data), len(data))
+    assert bytes(data[:4096]) == bytes([0xED] * 4096)
+    assert bytes(data[4096:chunk_size + 8192]) == bytes(chunk_size + 4096)
+    assert bytes(data[chunk_size + 8192:]) == bytes([0xED] * (chunk_size - 8192))
+
+
+def test_nvsim_arbitration(lone_config, nvsim_device):
+    from nvsim.arbitration import NVSimArbiter
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    def queue(qid, qprio, num_entries):
+        sq = SimpleNamespace(qid=qid, qprio=qprio, num_entries=lambda: num_entries)
+        return (sq, SimpleNamespace(qid=qid))
+
+    def qids(schedule):
+        return [(sq.qid, max_commands) for sq, cq, max_commands in schedule]
+
+    admin = queue(0, None, 4)
+    urgent = queue(1, NVSimArbiter.QPRIO_URGENT, 8)
+    high = [queue(2, NVSimArbiter.QPRIO_HIGH, 8), queue(3, NVSimArbiter.QPRIO_HIGH, 8)]
+    low = queue(4, NVSimArbiter.QPRIO_LOW, 8)
+
+    # Round robin, admin first and the first IO queue rotates every round
+    arbiter = NVSimArbiter(burst=2)
+    busy = [urgent, admin] + high
+    assert qids(arbiter.schedule(busy, NVSimArbiter.AMS_RR)) == [(0, None), (1, 2), (2, 2), (3, 2)]
+    assert qids(arbiter.schedule(busy, NVSimArbiter.AMS_RR)) == [(0, None), (2, 2), (3, 2), (1, 2)]
+
+    # Weighted round robin, urgent queues have strict priority
+    arbiter = NVSimArbiter(burst=2, weights=(3, 2, 1))
+    assert qids(arbiter.schedule([admin, urgent, low] + high, NVSimArbiter.AMS_WRR)) == [
+        (0, None), (1, 2)]
+    assert qids(arbiter.schedule([low] + high, NVSimArbiter.AMS_WRR)) == [(2, 2), (3, 1), (4, 1)]
+    assert qids(arbiter.schedule([low] + high, NVSimArbiter.AMS_WRR)) == [(3, 2), (2, 1), (4, 1)]
+
+    # Weighted round robin against nvsim, with queues in every class
+    nvme_device = nvsim_device
+    nvme_device.cc_disable()
+    nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
+    nvme_device.nvme_regs.CC.AMS = NVSimArbiter.AMS_WRR
+    nvme_device.cc_enable()
+    for qid in range(1, 5):
+        nvme_device.create_io_queue_pair(16, qid, 0, 0, 1, 16, qid, qid - 1, 1, 0)
+    nvme_device.identify()
+
+    commands = []
+    for i in range(3):
+        for sqid in range(1, 5):
+            commands.append(Write(NSID=test_nsid, SLBA=i, NLB=0))
+            nvme_device.start_cmd(commands[-1], sqid=sqid)
+    while not all(c.complete for c in commands):
+        nvme_device.process_completions(max_completions=len(commands), max_time_s=1)
+    assert all(c.cqe.SF.SC == 0 for c in commands)
+
+    # Workers don't go through the arbiter
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim', num_workers=2, arbitration_burst=1)
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim', num_workers=2, wrr_weights=(4, 2, 1))
+
+
+@pytest.mark.parametrize('nvsim_device', [{'storage': 'file'}, {'storage': 'sparse'}],
+                         ids=['file', 'sparse'], indirect=True)
+def test_nvsim_dsm_write_zeroes_compare(lone_config, nvsim_device):
+    from nvsim.state.intervals import NVSimIntervalMap
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # Ranges are merged and split as they are added and removed
+    intervals = NVSimIntervalMap()
+    intervals.add(10, 20)
+    intervals.add(30, 40)
+    intervals.add(20, 25)
+    assert list(zip(intervals.starts, intervals.ends)) == [(10, 25), (30, 40)]
+    intervals.add(5, 35)
+    assert list(zip(intervals.starts, intervals.ends)) == [(5, 40)]
+    intervals.remove(10, 20)
+    intervals.remove(0, 6)
+    intervals.remove(50, 60)
+    assert list(zip(intervals.starts, intervals.ends)) == [(6, 10), (20, 40)]
+    assert intervals.covered() == 24
+    assert list(intervals.split(0, 30)) == [(0, 6, False), (6, 10, True), (10, 20, False),
+                                            (20, 30, True)]
+    assert list(intervals.split(40, 50)) == [(40, 50, False)]
+
+    # Empty ranges are ignored, and changes never touch copies handed out before
+    ranges = intervals.copy()
+    intervals.add(50, 50)
+    intervals.remove(8, 8)
+    assert intervals.copy() == ranges
+    intervals.add(50, 60)
+    assert ranges == ([6, 20], [10, 40])
+    intervals.clear()
+    assert len(intervals) == 0
+    intervals.restore(ranges)
+    assert list(zip(intervals.starts, intervals.ends)) == [(6, 10), (20, 40)]
+    intervals.add(0, 100)
+    assert ranges == ([6, 20], [10, 40])
+
+    nvme_device = nvsim_device
+    ns = nvme_device.sim_thread.nvsim_state.namespaces[test_nsid]
+    nlb = (4 * nvme_device.mps // ns.block_size) - 1
+
+    prp = PRP(4 * nvme_device.mps, nvme_device.mps)
+    prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
+
+    def send(command):
+        command.DPTR.PRP.PRP1 = prp.prp1
+        command.DPTR.PRP.PRP2 = prp.prp2
+        nvme_device.sync_cmd(command, alloc_mem=False, check=False)
+        return command.cqe.SF
+
+    # Compare matches what was written, and fails once the data changes
+    data = bytes([0xED] * (4 * nvme_device.mps))
+    prp.set_data_buffer(data)
+    assert send(Write(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+    assert send(Compare(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+    sf = send(Compare(NSID=test_nsid, SLBA=1, NLB=nlb))
+    assert (sf.SCT, sf.SC) == (2, 0x85)
+    assert status_codes['Compare Failure', Compare].sct == 2
+
+    # Write Zeroes only records the range, the data is still in storage
+    assert send(WriteZeroes(NSID=test_nsid, SLBA=1, NLB=1)).SC == 0
+    assert ns.deallocated.covered() == 2 * ns.block_size
+    assert send(Read(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+    expected = data[:ns.block_size] + bytes(2 * ns.block_size) + data[3 * ns.block_size:]
+    assert prp.get_data_buffer() == expected
+    assert send(Compare(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+
+    # Writing over part of it leaves the rest zeroed
+    prp.set_data_buffer(data)
+    assert send(Write(NSID=test_nsid, SLBA=2, NLB=0)).SC == 0
+    assert ns.deallocated.covered() == ns.block_size
+
+    # Deallocate ranges from Dataset Management and Write Zeroes with DEAC
+    dsm = DatasetManagement(NSID=test_nsid, NR=1, AD=1)
+    dsm.data_out.RANGES[0].SLBA = 0
+    dsm.data_out.RANGES[0].NLB = 2
+    dsm.data_out.RANGES[1].SLBA = 8
+    dsm.data_out.RANGES[1].NLB = 1
+    nvme_device.sync_cmd(dsm)
+    assert send(WriteZeroes(NSID=test_nsid, SLBA=6, NLB=0, DEAC=1)).SC == 0
+    assert send(Read(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+    expected = bytearray(data)
+    for lba in [0, 1, 6, 8]:
+        expected[lba * ns.block_size:(lba + 1) * ns.block_size] = bytes(ns.block_size)
+    assert prp.get_data_buffer() == expected
+
+    # Deallocated data is gone from storage too, not just hidden
+    ns.deallocated.clear()
+    assert send(Compare(NSID=test_nsid, SLBA=0, NLB=nlb)).SC == 0
+
+    # Out of range commands fail without changing anything
+    dsm = DatasetManagement(NSID=test_nsid, NR=1, AD=1)
+    dsm.data_out.RANGES[0].NLB = 1
+    dsm.data_out.RANGES[1].SLBA = ns.num_lbas
+    dsm.data_out.RANGES[1].NLB = 1
+    nvme_device.sync_cmd(dsm, check=False)
+    assert dsm.cqe.SF.SC == status_codes['LBA Out of Range'].value
+    assert len(ns.deallocated) == 0
+    for command in [WriteZeroes(NSID=test_nsid, SLBA=ns.num_lbas, NLB=0),
+                    Compare(NSID=test_nsid, SLBA=ns.num_lbas, NLB=0)]:
+        assert send(command).SC == status_codes['LBA Out of Range'].value
+
+    # Ranges that cross from the page at PRP1 into the page at PRP2
+    ranges_prp = PRP(2 * nvme_device.mps, nvme_device.mps)
+    ranges_prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
+    ranges = (DatasetManagementRange * 2)()
+    ranges[0].SLBA = 2
+    ranges[0].NLB = 1
+    ranges[1].SLBA = 4
+    ranges[1].NLB = 2
+    ranges_data = bytes(ranges)
+    ranges_prp.set_data_buffer(bytes(nvme_device.mps - 16) + ranges_data +
+                               bytes(nvme_device.mps - 16))
+    dsm = DatasetManagement(NSID=test_nsid, NR=1, AD=1)
+    dsm.DPTR.PRP.PRP1 = ranges_prp.prp1 + nvme_device.mps - 16
+    dsm.DPTR.PRP.PRP2 = ranges_prp.prp2
+    nvme_device.sync_cmd(dsm, alloc_mem=False)
+    assert list(zip(ns.deallocated.starts, ns.deallocated.ends)) == [
+        (2 * ns.block_size, 3 * ns.block_size), (4 * ns.block_size, 6 * ns.block_size)]
+    ranges_prp.free_all_memory()
+
+    # Flush one and all namespaces
+    for nsid in [test_nsid, 0xFFFFFFFF]:
+        nvme_device.sync_cmd(Flush(NSID=nsid))
+    nvme_device.sync_cmd(Flush(NSID=0), check=False)
+
+    prp.free_all_memory()
+
+
+def test_nvsim_namespaces(nvsim_devices, tmp_path):
+    namespaces = [{'num_blocks': 0x1000, 'block_size': 512},
+                  {'num_blocks': 0x2000, 'block_size': 4096, 'storage': 'sparse'},
+                  {'num_gbs': 1, 'block_size': 4096}]
+    nvme_devices = [nvsim_devices(namespaces=namespaces, storage_dir=str(tmp_path))
+                    for i in range(2)]
+    for nvme_device in nvme_devices:
+        assert [(ns.nsze, ns.lba_ds_bytes) for ns in nvme_device.namespaces[1:4]] == [
+            (0x1000, 512), (0x2000, 4096), (12212046 + (244188 * -49), 4096)]
+
+    # Nothing is created until a namespace is used
+    assert all(d.sim_thread.nvsim_state.namespaces[1]._storage is None for d in nvme_devices)
+
+    # Both simulators write to their own files, which have no name in the directory so
+    #  they can't be left behind
+    for i, nvme_device in enumerate(nvme_devices):
+        write_cmd = Write(NSID=1, SLBA=0, NLB=7)
+        nvme_device.sync_cmd(write_cmd)
+        nvme_device.sync_cmd(Write(NSID=2, SLBA=0, NLB=0))
+    inodes = [os.fstat(d.sim_thread.nvsim_state.namespaces[1].storage.fh.fileno()).st_ino
+              for d in nvme_devices]
+    assert inodes[0] != inodes[1]
+    assert list(tmp_path.iterdir()) == []
+    assert not hasattr(nvme_devices[0].sim_thread.nvsim_state.namespaces[2].storage, 'fh')
+    assert nvme_devices[0].sim_thread.nvsim_state.namespaces[3]._storage is None
+
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim', namespaces=[{'num_blocks': 0x1000, 'block_size': 1024}])
+
+    # File storage is accessed by address, nothing past its end is touched
+    from nvsim.state.storage import NVSimFileStorage
+    storage = NVSimFileStorage(8192, str(tmp_path))
+    data = (ctypes.c_uint8 * 4096)()
+    for access in [storage.read_into, storage.write_from, storage.compare]:
+        access(4096, ctypes.addressof(data), 4096)
+        with pytest.raises(AssertionError):
+            access(4097, ctypes.addressof(data), 4096)
+    with pytest.raises(AssertionError):
+        storage.deallocate(0, 8193)
+    storage.close()
+
+
+def test_nvsim_health(lone_config, nvsim_device):
+    from lone.nvme.spec.commands.admin.get_log_page import (GetLogPage,
+                                                            GetLogPageSMARTData,
+                                                            GetLogPageErrorInformationData)
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    ns = nvme_device.sim_thread.nvsim_state.namespaces[test_nsid]
+    assert nvme_device.identify_data['controller'].ELPE == 255
+
+    prp = PRP(nvme_device.mps, nvme_device.mps)
+    prp.alloc(nvme_device, DMADirection.DEVICE_TO_HOST)
+
+    def get_log_page(lid, num_bytes, offset=0, check=True):
+        glp_cmd = GetLogPage(LID=lid, NUMDL=(num_bytes // 4) - 1, LPOL=offset & 0xFFFFFFFF,
+                             LPOU=offset >> 32)
+        glp_cmd.DPTR.PRP.PRP1 = prp.prp1
+        nvme_device.sync_cmd(glp_cmd, alloc_mem=False, check=check)
+        return glp_cmd, prp.get_data_buffer()[:num_bytes]
+
+    # 1000 blocks written and read back, plus a Write Zeroes
+    for i in range(125):
+        nvme_device.sync_cmd(Write(NSID=test_nsid, SLBA=i * 8, NLB=7))
+    for i in range(125):
+        nvme_device.sync_cmd(Read(NSID=test_nsid, SLBA=i * 8, NLB=7))
+    nvme_device.sync_cmd(WriteZeroes(NSID=test_nsid, SLBA=0, NLB=7))
+
+    glp_cmd, data = get_log_page(0x02, 512)
+    smart = GetLogPageSMARTData.from_buffer_copy(data)
+    assert smart.HostWriteCommandsLo == 126
+    assert smart.HostReadCommandsLo == 125
+    assert smart.DataUnitsWrittenLo == (1000 * ns.block_size + 511999) // 512000
+    assert smart.DataUnitsReadLo == (1000 * ns.block_size + 511999) // 512000
+    assert smart.PowerCyclesLo == 1
+    assert smart.AvailableSpare == 100
+    assert smart.NumberofErrorInformationLogEntriesLo == 0
+
+    # Byte offsets into the log, reading past its end returns zeros
+    offset = GetLogPageSMARTData.HostReadCommandsLo.offset
+    glp_cmd, data = get_log_page(0x02, 16, offset)
+    assert int.from_bytes(data[:8], 'little') == 125
+    assert int.from_bytes(data[8:], 'little') == 0
+    glp_cmd, data = get_log_page(0x02, 1024, 256)
+    assert data[256:] == bytes(768)
+
+    # Bad offsets fail, and so does a log we don't have. All of them end up in the
+    #  Error Information log, newest first
+    for offset in [2, 512, 1 << 32]:
+        glp_cmd, data = get_log_page(0x02, 16, offset, check=False)
+        assert glp_cmd.cqe.SF.SC == status_codes['Invalid Field in Command'].value
+    glp_cmd, data = get_log_page(0x17, 16, check=False)
+    assert glp_cmd.cqe.SF.SCT == 1
+    write_cmd = Write(NSID=test_nsid, SLBA=ns.num_lbas, NLB=0)
+    nvme_device.sync_cmd(write_cmd, check=False)
+
+    glp_cmd, data = get_log_page(0x01, 4096)
+    errors = GetLogPageErrorInformationData.from_buffer_copy(data + bytes(12288)).ERRORS
+    assert [e.ErrorCount for e in errors[:6]] == [5, 4, 3, 2, 1, 0]
+    assert (errors[0].SQID, errors[0].CID, errors[0].NS) == (1, write_cmd.CID, test_nsid)
+    assert errors[0].SF == status_codes['LBA Out of Range'].value
+    assert errors[1].SF == (1 << 8) | 0x09
+    assert errors[4].SQID == 0
+
+    glp_cmd, data = get_log_page(0x02, 512)
+    smart = GetLogPageSMARTData.from_buffer_copy(data)
+    assert smart.NumberofErrorInformationLogEntriesLo == 5
+
+    # Only the error log's most recent entries are kept
+    health = nvme_device.sim_thread.nvsim_state.health
+    for i in range(health.num_error_entries):
+        health.error(write_cmd, SimpleNamespace(qid=1), status_codes['LBA Out of Range'])
+    assert health.error_information_data().ERRORS[255].ErrorCount == 6
+
+    # Supported log pages only has what we support
+    glp_cmd, data = get_log_page(0x00, 1024)
+    assert [lid for lid in range(256) if data[lid * 4] & 1] == [0, 1, 2]
+
+    prp.free_all_memory()
+
+
+@pytest.mark.parametrize('nvsim_device', [{'storage': 'sparse'}], indirect=True)
+def test_nvsim_snapshots(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    nvme_device = nvsim_device
+    nvsim_state = nvme_device.sim_thread.nvsim_state
+    ns = nvsim_state.namespaces[test_nsid]
+    storage = ns.storage
+    chunk_size = storage.chunk_size
+    blocks_per_chunk = chunk_size // ns.block_size
+
+    def write(chunk_index, value):
+        data = (ctypes.c_uint8 * ns.block_size)(*([value] * ns.block_size))
+        ns.write(chunk_index * blocks_per_chunk, 1, [(ctypes.addressof(data), len(data))])
+
+    def read(chunk_index):
+        data = (ctypes.c_uint8 * ns.block_size)()
+        ns.read(chunk_index * blocks_per_chunk, 1, [(ctypes.addressof(data), len(data))])
+        return data[0]
+
+    # Preload 8 chunks and snapshot them
+    for i in range(8):
+        write(i, 0xA0 + i)
+    first_id = nvsim_state.snapshot()
+    chunks = dict(storage.chunks)
+
+    # Only the chunks written to after the snapshot are copied
+    write(0, 0xFF)
+    ns.write_zeroes(blocks_per_chunk, 1)
+    ns.deallocate(2 * blocks_per_chunk, blocks_per_chunk)
+    ns.deallocate(3 * blocks_per_chunk, 1)
+    write(9, 0xFF)
+    assert [read(i) for i in range(4)] + [read(9)] == [0xFF, 0, 0, 0, 0xFF]
+    assert storage.changed == {0, 2, 3, 9}
+    assert all(storage.chunks[i] is chunks[i] for i in [1, 4, 5, 6, 7])
+    assert chunks[0][0] == 0xA0
+
+    # Restoring only puts back what changed
+    nvsim_state.restore(first_id)
+    assert [read(i) for i in range(10)] == [0xA0 + i for i in range(8)] + [0, 0]
+    assert storage.chunks == chunks
+    assert len(ns.deallocated) == 0
+
+    # Going back to an older snapshot, and after a format
+    write(4, 0xEE)
+    second_id = nvsim_state.snapshot()
+    write(4, 0xDD)
+    nvme_device.sync_cmd(FormatNVM(NSID=test_nsid), timeout_s=1)
+    assert read(5) == 0
+    nvsim_state.restore(first_id)
+    assert read(4) == 0xA4
+    nvsim_state.restore(second_id)
+    assert [read(i) for i in range(8)] == [0xA0, 0xA1, 0xA2, 0xA3, 0xEE, 0xA5, 0xA6, 0xA7]
+
+    nvsim_state.delete_snapshot(first_id)
+    assert first_id not in nvsim_state.snapshots
+    with pytest.raises(KeyError):
+        nvsim_state.restore(first_id)
+
+    # Namespaces never used don't get storage for a snapshot, and go back to having none
+    unused_ns = nvsim_state.namespaces[-1]
+    assert unused_ns._storage is None
+    third_id = nvsim_state.snapshot()
+    assert unused_ns._storage is None
+    write_data = (ctypes.c_uint8 * unused_ns.block_size)()
+    unused_ns.write(0, 1, [(ctypes.addressof(write_data), len(write_data))])
+    nvsim_state.restore(third_id)
+    assert unused_ns._storage is None
+
+    # Only sparse storage supports snapshots
+    from nvsim.state import NVSimNamespace
+    with pytest.raises(AssertionError):
+        NVSimNamespace(num_blocks=0x1000).snapshot()
+
+
+def test_nvsim_snapshots_file_storage(nvsim_device):
+    # The default file storage can't be snapshotted, and nothing is left half done
+    nvsim_state = nvsim_device.sim_thread.nvsim_state
+    with pytest.raises(AssertionError, match='sparse storage'):
+        nvsim_state.snapshot()
+    assert nvsim_state.snapshots == {}
+    assert all(len(ns.snapshots) == 0 for ns in nvsim_state.namespaces[1:])
+
+
+@pytest.mark.parametrize('nvsim_device', [{'idle_max_sleep_us': 60000000}], indirect=True)
+def test_nvsim_idle_backoff(lone_config, nvsim_device):
+    from nvsim.backoff import NVSimBackoff
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # Idle waits double up to the max, any work resets them
+    backoff = NVSimBackoff(max_sleep_us=8)
+    sleeps = []
+    for i in range(6):
+        backoff.wait(False)
+        sleeps.append(backoff.sleep_us)
+    assert sleeps == [1, 2, 4, 8, 8, 8]
+    backoff.wait(True)
+    assert backoff.sleep_us == 0
+
+    # A wake cuts the idle wait short, and resets it. Without one this waits for a minute
+    backoff = NVSimBackoff(max_sleep_us=60000000)
+    backoff.sleep_us = 60000000
+    backoff.wake()
+    backoff.wait(False)
+    assert backoff.sleep_us == 0
+    backoff.close()
+    backoff.close()
+
+    # Commands still complete once the simulator is idle for as long as it can be. It only
+    #  sees them before sync_cmd times out if posting them wakes it up
+    nvme_device = nvsim_device
+    nvme_device.backoff.sleep_us = nvme_device.backoff.max_sleep_us
+    time.sleep(0.5)
+    assert nvme_device.backoff.sleep_us == nvme_device.backoff.max_sleep_us
+    nvme_device.sync_cmd(Write(NSID=test_nsid, SLBA=0, NLB=0), timeout_s=10)
+
+
+def test_nvsim_multi_controller(lone_config, nvsim_devices):
+    import threading
+    from nvsim import NVSimSharedThread
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # nvsim:0 has a subsystem of its own, nvsim:1 and nvsim:2 are in the same one
+    num_threads = threading.active_count()
+    nvme_devices = [nvsim_devices('nvsim:0', storage='sparse'),
+                    nvsim_devices('nvsim:1', storage='sparse', subsystem='shared'),
+                    nvsim_devices('nvsim:2', storage='sparse', subsystem='shared')]
+    shared_thread = NVSimSharedThread.thread
+
+    # All of them are simulated by one thread
+    assert threading.active_count() == num_threads + 1
+    assert all(d.sim_thread.is_alive() for d in nvme_devices)
+
+    id_ctrls = [d.identify_data['controller'] for d in nvme_devices]
+    assert [id_ctrl.CNTLID for id_ctrl in id_ctrls] == [0, 1, 2]
+    assert [id_ctrl.SN for id_ctrl in id_ctrls] == [b'nvsim:0', b'shared', b'shared']
+    assert [id_ctrl.CMIC for id_ctrl in id_ctrls] == [0, 2, 2]
+    assert id_ctrls[1].SUBNQN == id_ctrls[2].SUBNQN != id_ctrls[0].SUBNQN
+
+    # The shared subsystem's controllers see the same namespaces
+    states = [d.sim_thread.nvsim_state for d in nvme_devices]
+    assert states[1].namespaces is states[2].namespaces
+    assert states[0].namespaces[test_nsid] is not states[1].namespaces[test_nsid]
+    assert states[1].identify_namespace_data(test_nsid).NMIC == 1
+    assert states[0].identify_namespace_data(test_nsid).NMIC == 0
+
+    # Data written on one path reads back on the other, and not on another subsystem
+    ns = states[0].namespaces[test_nsid]
+    write_prp = PRP(ns.block_size, nvme_devices[1].mps)
+    write_prp.alloc(nvme_devices[1], DMADirection.HOST_TO_DEVICE)
+    write_prp.set_data_buffer(bytes([0xED] * ns.block_size))
+    write_cmd = Write(NSID=test_nsid, SLBA=7, NLB=0)
+    write_cmd.DPTR.PRP.PRP1 = write_prp.prp1
+    nvme_devices[1].sync_cmd(write_cmd, alloc_mem=False)
+
+    for nvme_device, value in zip(nvme_devices, [0, 0xED, 0xED]):
+        read_prp = PRP(ns.block_size, nvme_device.mps)
+        read_prp.alloc(nvme_device, DMADirection.DEVICE_TO_HOST)
+        read_cmd = Read(NSID=test_nsid, SLBA=7, NLB=0)
+        read_cmd.DPTR.PRP.PRP1 = read_prp.prp1
+        nvme_device.sync_cmd(read_cmd, alloc_mem=False)
+        assert read_prp.get_data_buffer()[:ns.block_size] == bytes([value] * ns.block_size)
+
+    # Commands outstanding on every controller at once
+    write_cmds = [(d, Write(NSID=test_nsid, SLBA=i, NLB=0))
+                  for d in nvme_devices for i in range(8)]
+    for nvme_device, write_cmd in write_cmds:
+        nvme_device.start_cmd(write_cmd)
+    for nvme_device, write_cmd in write_cmds:
+        while not write_cmd.complete:
+            nvme_device.process_completions()
+        assert write_cmd.cqe.SF.SC == 0
+
+    # Stopping a controller leaves the rest running
+    nvme_devices[0].cc_disable()
+    nvme_devices[0].sim_thread.stop()
+    nvme_devices[0].sim_thread.join(5)
+    assert not nvme_devices[0].sim_thread.is_alive()
+    nvme_devices[2].sync_cmd(Read(NSID=test_nsid, SLBA=0, NLB=0))
+
+    # Only nvsim:N controllers have subsystems, and they can't run out of process
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim', subsystem='shared')
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim:3', process=True)
+
+    # CNTLIDs are unique in a subsystem, until their controller goes away
+    with pytest.raises(AssertionError):
+        NVMeDevice('nvsim:2', subsystem='shared')
+    nvme_devices[2].cc_disable()
+    nvme_devices[2].sim_thread.stop()
+    nvme_devices[2].sim_thread.join(5)
+    nvme_devices.append(nvsim_devices('nvsim:2', storage='sparse', subsystem='shared'))
+    assert nvme_devices[-1].identify_data['controller'].CNTLID == 2
+
+    # The shared thread is done once its controllers are
+    for nvme_device in nvme_devices[1:]:
+        nvme_device.cc_disable()
+        nvme_device.sim_thread.stop()
+        nvme_device.sim_thread.join(5)
+    shared_thread.join(5)
+    assert not shared_thread.is_alive()
+    assert NVSimSharedThread.thread is None
+
+
+# nsid 1 is conventional, nsid 2 has 16 zones of 64 blocks with 48 writable in each.
+#  Its 10 extra blocks are not a whole zone, so they are dropped
+@pytest.mark.parametrize('nvsim_device', [{'storage': 'sparse', 'namespaces': [
+    {'num_blocks': 0x1000},
+    {'num_blocks': (16 * 64) + 10, 'zoned': True, 'zone_size': 64, 'zone_capacity': 48,
+     'max_open': 2, 'max_active': 3}]}], indirect=True)
+def test_nvsim_zoned(lone_config, nvsim_device):
+    nsid = 2
+    nvme_device = nvsim_device
+    nvsim_state = nvme_device.sim_thread.nvsim_state
+    ns = nvsim_state.namespaces[nsid]
+    assert ns.num_zones == 16 and ns.num_lbas == 16 * 64
+
+    def check_status(name, command, alloc_mem=True):
+        with pytest.raises(NVMeStatusCodeException) as exc_info:
+            nvme_device.sync_cmd(command, alloc_mem=alloc_mem)
+        assert exc_info.value.code.name == name
+
+    def send(slba, action, sel=0):
+        return ZoneManagementSend(NSID=nsid, SLBA=slba, ZSA=action, SEL=sel)
+
+    def report(zrasf=ZoneManagementReceive.LIST_ALL, slba=0, **kw):
+        zmr_cmd = ZoneManagementReceive(NSID=nsid, SLBA=slba, ZRASF=zrasf, **kw)
+        nvme_device.sync_cmd(zmr_cmd)
+        num_zds = min(zmr_cmd.data_in.NZ, (((zmr_cmd.NUMD + 1) * 4) // 64) - 1)
+        return zmr_cmd.data_in.NZ, [(zd.ZSLBA, zd.ZS, zd.WP) for
+                                    zd in zmr_cmd.data_in.ZDS[:num_zds]]
+
+    def append(zslba, value):
+        prp = PRP(ns.block_size, nvme_device.mps)
+        prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
+        prp.set_data_buffer(bytes([value] * ns.block_size))
+        za_cmd = ZoneAppend(NSID=nsid, ZSLBA=zslba, NLB=0)
+        za_cmd.DPTR.PRP.PRP1 = prp.prp1
+        za_cmd.prp = prp
+        return za_cmd
+
+    def read(slba):
+        prp = PRP(ns.block_size, nvme_device.mps)
+        prp.alloc(nvme_device, DMADirection.DEVICE_TO_HOST)
+        rd_cmd = Read(NSID=nsid, SLBA=slba, NLB=0)
+        rd_cmd.DPTR.PRP.PRP1 = prp.prp1
+        nvme_device.sync_cmd(rd_cmd, alloc_mem=False)
+        return prp.get_data_buffer()[0]
+
+    # Zoned identify data
+    id_ns_zoned_cmd = IdentifyNamespaceZoned(NSID=nsid)
+    nvme_device.sync_cmd(id_ns_zoned_cmd)
+    assert id_ns_zoned_cmd.data_in.MAR == 2
+    assert id_ns_zoned_cmd.data_in.MOR == 1
+    assert id_ns_zoned_cmd.data_in.LBAFE_TBL[0].ZSZE == 64
+    check_status('Invalid Field in Command', IdentifyNamespaceZoned(NSID=1))
+    check_status('Invalid Namespace or Format', IdentifyNamespaceZoned(NSID=3))
+    id_ctrl_zoned_cmd = IdentifyControllerZoned()
+    nvme_device.sync_cmd(id_ctrl_zoned_cmd)
+    assert id_ctrl_zoned_cmd.data_in.ZASL == 0
+    id_io_cmd_set_cmd = IdentifyIoCmdSet()
+    nvme_device.sync_cmd(id_io_cmd_set_cmd)
+    assert id_io_cmd_set_cmd.data_in.IoCmdSetVectors[0].NVMCmdSet == 1
+    assert id_io_cmd_set_cmd.data_in.IoCmdSetVectors[0].ZonedNamespaceCmdSet == 1
+
+    # Writes have to be at the write pointer, and open the zone
+    nvme_device.sync_cmd(Write(NSID=nsid, SLBA=0, NLB=7))
+    check_status('Zone Invalid Write', Write(NSID=nsid, SLBA=0, NLB=0))
+    nvme_device.sync_cmd(Write(NSID=nsid, SLBA=8, NLB=0))
+    assert report()[1][0] == (0, ZoneDescriptor.ZS_IMPLICITLY_OPENED, 9)
+
+    # Opening a third zone closes the implicitly opened zone opened first, and with
+    #  three zones active a fourth can't be opened
+    nvme_device.sync_cmd(Write(NSID=nsid, SLBA=64, NLB=0))
+    nvme_device.sync_cmd(Write(NSID=nsid, SLBA=128, NLB=0))
+    assert report()[1][:3] == [(0, ZoneDescriptor.ZS_CLOSED, 9),
+                               (64, ZoneDescriptor.ZS_IMPLICITLY_OPENED, 65),
+                               (128, ZoneDescriptor.ZS_IMPLICITLY_OPENED, 129)]
+    check_status('Too Many Active Zones', Write(NSID=nsid, SLBA=192, NLB=0))
+    check_status('Too Many Active Zones', send(192, ZoneManagementSend.OPEN))
+
+    # Explicitly opened zones are never closed to make room, so with two of them
+    #  nothing else can be opened
+    nvme_device.sync_cmd(send(64, ZoneManagementSend.CLOSE))
+    nvme_device.sync_cmd(send(0, ZoneManagementSend.OPEN))
+    nvme_device.sync_cmd(send(64, ZoneManagementSend.OPEN))
+    assert report(ZoneManagementReceive.LIST_EXPLICITLY_OPENED)[0] == 2
+    assert report(ZoneManagementReceive.LIST_CLOSED)[1] == [
+        (128, ZoneDescriptor.ZS_CLOSED, 129)]
+    check_status('Too Many Open Zones', Write(NSID=nsid, SLBA=129, NLB=0))
+
+    # Writes can't go past the zone's capacity, and filling it makes the zone full
+    check_status('Zone Boundary Error', Write(NSID=nsid, SLBA=9, NLB=39))
+    nvme_device.sync_cmd(Write(NSID=nsid, SLBA=9, NLB=38))
+    check_status('Zone Is Full', Write(NSID=nsid, SLBA=47, NLB=0))
+    check_status('Invalid Zone State Transition', send(0, ZoneManagementSend.CLOSE))
+    check_status('Invalid Zone State Transition', send(0, ZoneManagementSend.OPEN))
+    nvme_device.sync_cmd(send(64, ZoneManagementSend.FINISH))
+    assert report(ZoneManagementReceive.LIST_FULL)[1] == [
+        (0, ZoneDescriptor.ZS_FULL, 48), (64, ZoneDescriptor.ZS_FULL, 112)]
+
+    # Select All resets every zone that isn't empty
+    nvme_device.sync_cmd(send(0, ZoneManagementSend.RESET, sel=1))
+    assert report(ZoneManagementReceive.LIST_EMPTY)[0] == 16
+    assert read(0) == 0
+
+    # Appends outstanding at the same time all go to the same zone, each one at the
+    #  LBA it is given back in its completion
+    za_cmds = [append(192, i + 1) for i in range(12)]
+    for za_cmd in za_cmds:
+        nvme_device.start_cmd(za_cmd, alloc_mem=False)
+    for za_cmd in za_cmds:
+        while not za_cmd.complete:
+            nvme_device.process_completions()
+        assert za_cmd.cqe.SF.SC == 0
+    assert sorted(za_cmd.alba for za_cmd in za_cmds) == list(range(192, 204))
+    assert all(read(za_cmd.alba) == i + 1 for i, za_cmd in enumerate(za_cmds))
+    check_status('Invalid Field in Command', append(193, 0), alloc_mem=False)
+    assert report(slba=192)[1][0] == (192, ZoneDescriptor.ZS_IMPLICITLY_OPENED, 204)
+
+    # Appending past the zone's capacity fails, write zeroes follow the write pointer
+    nvme_device.sync_cmd(ZoneAppend(NSID=nsid, ZSLBA=192, NLB=34))
+    check_status('Zone Boundary Error', ZoneAppend(NSID=nsid, ZSLBA=192, NLB=1))
+    nvme_device.sync_cmd(append(192, 0), alloc_mem=False)
+    check_status('Zone Is Full', append(192, 0), alloc_mem=False)
+    nvme_device.sync_cmd(WriteZeroes(NSID=nsid, SLBA=256, NLB=3))
+    check_status('Zone Invalid Write', WriteZeroes(NSID=nsid, SLBA=256, NLB=0))
+
+    # Reports can start at any zone, and be partial
+    nvme_device.sync_cmd(send(640, ZoneManagementSend.FINISH))
+    assert report(ZoneManagementReceive.LIST_FULL) == (
+        2, [(192, ZoneDescriptor.ZS_FULL, 240), (640, ZoneDescriptor.ZS_FULL, 688)])
+    assert report(slba=600)[0] == 7
+    assert report(NUMD=(64 * 3 // 4) - 1) == (16, report()[1][:2])
+    assert report(NUMD=(64 * 3 // 4) - 1, PR=1)[0] == 2
+
+    # A snapshot and a format take the zones along with the data
+    snapshot_id = nvsim_state.snapshot()
+    nvme_device.sync_cmd(FormatNVM(NSID=nsid), timeout_s=1)
+    assert report(ZoneManagementReceive.LIST_EMPTY)[0] == 16
+    nvsim_state.restore(snapshot_id)
+    assert report(ZoneManagementReceive.LIST_FULL)[0] == 2
+    assert read(200) == 9
+
+    # Zones that go read only can only be taken offline
+    ns.set_zone_state(15, ZoneDescriptor.ZS_READ_ONLY)
+    check_status('Zone Is Read Only', Write(NSID=nsid, SLBA=15 * 64, NLB=0))
+    check_status('Zone Is Read Only', send(15 * 64, ZoneManagementSend.OPEN))
+    check_status('Invalid Zone State Transition', send(0, ZoneManagementSend.OFFLINE))
+    nvme_device.sync_cmd(send(0, ZoneManagementSend.OFFLINE, sel=1))
+    check_status('Zone Is Offline', Write(NSID=nsid, SLBA=15 * 64, NLB=0))
+    check_status('Zone Is Offline', send(15 * 64, ZoneManagementSend.RESET))
+    assert report(ZoneManagementReceive.LIST_OFFLINE)[0] == 1
+
+    # Invalid requests, and zone commands to a conventional namespace
+    check_status('Invalid Field in Command', send(1, ZoneManagementSend.RESET))
+    check_status('LBA Out of Range', send(16 * 64, ZoneManagementSend.RESET))
+    check_status('Invalid Field in Command',
+                 send(0, ZoneManagementSend.SET_ZONE_DESCRIPTOR_EXTENSION))
+    check_status('Invalid Field in Command', ZoneManagementReceive(
+        NSID=nsid, ZRA=ZoneManagementReceive.EXTENDED_REPORT_ZONES))
+    check_status('LBA Out of Range', ZoneManagementReceive(NSID=nsid, SLBA=16 * 64))
+    check_status('LBA Out of Range', ZoneAppend(NSID=nsid, ZSLBA=16 * 64, NLB=0))
+    check_status('Invalid Command Opcode', ZoneManagementSend(NSID=1))
+    check_status('Invalid Command Opcode', ZoneManagementReceive(NSID=1))
+    check_status('Invalid Command Opcode', ZoneAppend(NSID=1))
+
+
+@pytest.mark.parametrize('nvsim_device', [{'num_workers': 0}, {'num_workers': 2}],
+                         ids=['inline', 'workers'], indirect=True)
+def test_nvsim_injection_rules(lone_config, nvsim_device):
+    test_nsid = lone_config['dut']['namespaces'][0]['nsid']
+
+    # With workers, the worker that owns the CQ posts the delayed completions too
+    nvme_device = nvsim_device
+
+    def wait(commands):
+        for command in commands:
+            while not command.complete:
+                nvme_device.process_completions()
+        return [command.cqe.SF.SC for command in commands]
+
+    def run(commands):
+        for command in commands:
+            nvme_device.start_cmd(command)
+        return wait(commands)
+
+    # Every 4th write to the namespace fails, reads are left alone
+    fail_rule = InjectionRule(Write().OPC, nsid=test_nsid, every=4,
+                              sc=status_codes['Invalid Field in Command'])
+    nvme_device.injectors.register(fail_rule)
+    assert run([Write(NSID=test_nsid, SLBA=i, NLB=0) for i in range(12)]) == [0, 0, 0, 2] * 3
+    assert run([Read(NSID=test_nsid, SLBA=i, NLB=0) for i in range(12)]) == [0] * 12
+    fail_rule.wait(1)
+
+    # Reads in an LBA range complete late, without holding back the rest. The simulator
+    #  schedules completions on the perf_counter() clock, after start is taken
+    delay_rule = InjectionRule(Read().OPC, lba_range=(100, 101), delay_us=1000000)
+    nvme_device.injectors.register(delay_rule)
+    slow_read = Read(NSID=test_nsid, SLBA=100, NLB=0)
+    start = time.perf_counter()
+    nvme_device.start_cmd(slow_read)
+    assert run([Read(NSID=test_nsid, SLBA=i, NLB=0) for i in range(8)]) == [0] * 8
+    assert not slow_read.complete
+    assert wait([slow_read]) == [0]
+    assert time.perf_counter() - start >= 1
+
+    # Once unregistered, rules leave commands alone
+    nvme_device.injectors.unregister(fail_rule)
+    nvme_device.injectors.unregister(delay_rule)
+    assert run([Write(NSID=test_nsid, SLBA=i, NLB=0) for i in range(12)]) == [0] * 12
+    assert fail_rule.triggered == 3 and delay_rule.triggered == 1
@@ -1,6 +1,9 @@
 import pytest
+import threading
+import time
+from types import SimpleNamespace
 
-from lone.injection import Injector, Injection
+from lone.injection import Injector, Injection, InjectionRule, wait_all
 
 
 def test_injector():
@@ -13,6 +16,30 @@ def test_injector():
     # Pretendit acked, test path
     i.ack = True
     i.wait(0.01)
+    i.ack = False
+    assert not i.ack
+
+    # An ack from another thread wakes the waiter up right away
+    timer = threading.Timer(0.05, setattr, (i, 'ack', True))
+    timer.start()
+    start = time.monotonic()
+    i.wait(10)
+    assert time.monotonic() - start < 5
+    timer.join()
+
+
+def test_wait_all():
+    injectors = [Injector() for i in range(100)]
+    for injector in injectors:
+        injector.ack = True
+    wait_all(injectors, 0.01)
+
+    # The timeout is for all of them, not each one
+    injectors.append(Injector())
+    start = time.monotonic()
+    with pytest.raises(AssertionError):
+        wait_all(injectors, 0.1)
+    assert time.monotonic() - start < 1
 
 
 def test_injection():
@@ -32,3 +59,59 @@ def test_injection():
 
     # Test getting an unregistered injector returns None
     assert injection.get('NotRegistered') is None
+
+    # Injectors of the same type are picked up in the order they were registered
+    first, second = InjectorTest(), InjectorTest()
+    injection.register(first)
+    injection.register(second)
+    assert injection.get('InjectorTest') is first
+    assert injection.get('InjectorTest') is second
+    assert injection.get('InjectorTest') is None
+
+    # Nothing is left behind once all of them are picked up
+    assert not injection.injectors
+
+
+def test_injection_rule():
+    injection = Injection()
+    command = SimpleNamespace(OPC=0x01, NSID=1, DW10=0x10, DW11=0)
+
+    # Only sc or delay_us, and only probability or every
+    with pytest.raises(AssertionError):
+        InjectionRule(0x01)
+    with pytest.raises(AssertionError):
+        InjectionRule(0x01, sc=1, delay_us=10)
+    with pytest.raises(AssertionError):
+        InjectionRule(0x01, sc=1, probability=0.5, every=2)
+
+    # No rules for the opcode
+    assert injection.match(command) is None
+
+    # Rules that don't match the NSID or LBA range never trigger
+    other_ns = InjectionRule(0x01, nsid=2, sc=1)
+    other_lbas = InjectionRule(0x01, lba_range=(0x20, 0x30), sc=1)
+    injection.register(other_ns)
+    injection.register(other_lbas)
+    assert injection.match(command) is None
+    assert other_ns.matched == 0 and other_lbas.matched == 0
+
+    # Every Nth match
+    every = InjectionRule(0x01, nsid=1, lba_range=(0x10, 0x20), every=3, delay_us=10)
+    injection.register(every)
+    assert [injection.match(command) for i in range(6)] == [None, None, every] * 2
+    assert every.matched == 6 and every.triggered == 2 and every.ack
+
+    # With a probability, and always
+    injection.unregister(every)
+    probability = InjectionRule(0x01, probability=0.5, sc=1, seed=1)
+    always = InjectionRule(0x01, sc=2)
+    injection.register(probability)
+    injection.register(always)
+    rules = [injection.match(command) for i in range(1000)]
+    assert 400 < rules.count(probability) < 600
+    assert rules.count(probability) + rules.count(always) == 1000
+
+    # Unregistering the last rule for an opcode removes it
+    for rule in [other_ns, other_lbas, probability, always]:
+        injection.unregister(rule)
+    assert injection.rules == {}
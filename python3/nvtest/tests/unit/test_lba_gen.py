@@ -1,4 +1,7 @@
-from lone.util.lba_gen import LBARandGenLFSR
+import pytest
+import time
+
+from lone.util.lba_gen import LBARandGenLFSR, LBARandGenFeistel
 
 
 def test_lba_gen():
@@ -30,3 +33,85 @@ def test_lba_gen():
     assert lbas.initial_state == initial_state
     assert lbas.period == 0
     assert lbas.complete is False
+
+
+def test_lba_gen_next_batch():
+    max_lba = 0x12345
+    bs = 3
+    initial_state = 23
+
+    # Batches return the same LBAs as iterating, and stop when the sequence is complete
+    lba_list = list(LBARandGenLFSR(max_lba, bs, initial_state=initial_state))
+    lbas = LBARandGenLFSR(max_lba, bs, initial_state=initial_state)
+    batches = [lbas.next_batch(1000) for i in range((len(lba_list) // 1000) + 2)]
+    assert all(batch.typecode == 'Q' for batch in batches)
+    assert [lba for batch in batches for lba in batch] == lba_list
+    assert len(batches[-1]) == 0
+    assert lbas.complete
+
+    # Batches and single LBAs can be mixed
+    lbas.reset()
+    mixed = []
+    while not lbas.complete:
+        mixed.append(next(lbas))
+        mixed.extend(lbas.next_batch(7))
+    assert mixed == lba_list
+
+
+def test_lba_gen_next_batch_speed():
+    # Batches are faster than calling next() for every LBA, best of a few runs
+    max_lba = (1 << 30) - 1
+    num_lbas = 50000
+
+    def best_time(func):
+        times = []
+        for i in range(3):
+            lbas = LBARandGenLFSR(max_lba, 1)
+            start = time.perf_counter()
+            func(lbas)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    batch_time = best_time(lambda lbas: lbas.next_batch(num_lbas))
+    next_time = best_time(lambda lbas: [lbas.next() for i in range(num_lbas)])
+    assert batch_time < next_time
+
+
+def test_lba_gen_feistel():
+    max_lba = 0x10000
+    bs = 5
+    start_lba = 11
+    num_ios = (max_lba - start_lba) // bs
+
+    # Every LBA is returned once, in a random order
+    lbas = LBARandGenFeistel(max_lba, bs, seed=23, start_lba=start_lba)
+    lba_list = list(lbas)
+    assert lbas.complete
+    assert sorted(lba_list) == [start_lba + (i * bs) for i in range(num_ios)]
+    assert lba_list != sorted(lba_list)
+
+    # Same order for the same seed, another one for another seed
+    assert list(LBARandGenFeistel(max_lba, bs, seed=23, start_lba=start_lba)) == lba_list
+    assert list(LBARandGenFeistel(max_lba, bs, seed=24, start_lba=start_lba)) != lba_list
+
+    # Seeking picks up anywhere, so workers can each take a part with no overlap
+    lbas.seek(1000)
+    assert next(lbas) == lba_list[1000]
+    parts = []
+    for worker in range(3):
+        lbas.seek(worker * num_ios // 3)
+        parts.append(lbas.next_batch(((worker + 1) * num_ios // 3) - lbas.index))
+    assert [lba for part in parts for lba in part] == lba_list
+    assert parts[0].typecode == 'Q'
+    assert len(lbas.next_batch(10)) == 0
+
+    lbas.reset()
+    assert lbas.index == 0 and not lbas.complete
+    with pytest.raises(AssertionError):
+        lbas.seek(num_ios + 1)
+
+    # Any number of IOs, down to 1
+    for max_lba in [1, 2, 3, 17, 1000]:
+        assert sorted(LBARandGenFeistel(max_lba, 1)) == list(range(max_lba))
+    with pytest.raises(AssertionError):
+        LBARandGenFeistel(4, 8)
@@ -0,0 +1,44 @@
+import pytest
+import ctypes
+from types import SimpleNamespace
+
+from lone.nvme.spec.registers.msix import MSIXTable, MSIXTableEntry
+
+
+def msix_cap(ts=3, to=0x2000, pbao=0x3000, tbir=0, pbir=0):
+    return SimpleNamespace(MXC=SimpleNamespace(TS=ts),
+                           MTAB=SimpleNamespace(TBIR=tbir, TO=to >> 3),
+                           MPBA=SimpleNamespace(PBIR=pbir, PBAO=pbao >> 3))
+
+
+def test_msix_table():
+    bar = (ctypes.c_uint8 * 0x4000)()
+    bar_address = ctypes.addressof(bar)
+    msix_table = MSIXTable(msix_cap(ts=69), bar_address)
+    assert msix_table.size == 70
+    assert len(msix_table.pba) == 2
+    assert ctypes.addressof(msix_table.table[1]) == (bar_address + 0x2000 +
+                                                     ctypes.sizeof(MSIXTableEntry))
+
+    # Masking only changes the mask bit
+    msix_table.table[2].V_CTRL = 0x10
+    assert msix_table.is_masked(2) is False
+    msix_table.mask(2)
+    assert msix_table.is_masked(2) is True
+    assert msix_table.table[2].V_CTRL == 0x11
+    msix_table.unmask(2)
+    assert msix_table.is_masked(2) is False
+    assert msix_table.table[2].V_CTRL == 0x10
+
+    # Pending bits, including in the second PBA qword
+    msix_table.pba[0] = 1 << 3
+    msix_table.pba[1] = 1 << (65 - 64)
+    assert [v for v in range(70) if msix_table.pending(v)] == [3, 65]
+
+    msix_table.log()
+
+    # Only BAR0 is supported
+    with pytest.raises(AssertionError):
+        MSIXTable(msix_cap(tbir=1), bar_address)
+    with pytest.raises(AssertionError):
+        MSIXTable(msix_cap(pbir=1), bar_address)
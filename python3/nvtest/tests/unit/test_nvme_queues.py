@@ -6,6 +6,7 @@ from lone.nvme.spec.queues import (NVMeHeadTail, NVMeQueue, NVMeSubmissionQueue,
                                    NVMeCompletionQueue, QueueMgr)
 from lone.nvme.spec.structures import SQECommon, CQE
 from lone.system import MemoryLocation
+from lone.util.trace import mmio_trace
 
 
 def test_nvme_queues_head_tail():
@@ -31,7 +32,9 @@ def test_nvme_queues_head_tail():
     assert ht.value == 1
 
     # Test increment
+    mmio_trace.enable(num_records=8)
     ht.set(0)
+    mmio_trace.disable()
     assert ht.value == 0
 
     # Test incr doesnt change value
@@ -42,6 +45,53 @@ def test_nvme_queues_head_tail():
     assert ht.incr(256) == 0
 
 
+def test_nvme_queues_head_tail_shadow():
+    db_mem = ctypes.c_uint32(0)
+    shadow_mem = ctypes.c_uint32(0)
+    ei_mem = ctypes.c_uint32(0)
+
+    ht = NVMeHeadTail(256, ctypes.addressof(db_mem))
+    ht.enable_shadow(ctypes.addressof(shadow_mem), ctypes.addressof(ei_mem))
+
+    # Moving past the EventIdx rings the doorbell register
+    ht.add(1)
+    assert ht.value == 1
+    assert shadow_mem.value == 1
+    assert db_mem.value == 1
+
+    # Not moving past it only updates the shadow doorbell
+    ht.add(2)
+    assert ht.value == 3
+    assert shadow_mem.value == 3
+    assert db_mem.value == 1
+
+    # Moving past it again rings it, including with wrapping
+    ei_mem.value = 3
+    ht.add(5)
+    assert db_mem.value == 8
+    ei_mem.value = 255
+    ht.set(255)
+    assert db_mem.value == 8
+    ht.add(1)
+    assert ht.value == 0
+    assert db_mem.value == 0
+
+    # Writes are traced when tracing is enabled
+    ei_mem.value = 0
+    mmio_trace.enable(num_records=8)
+    ht.add(1)
+    mmio_trace.disable()
+    assert [o for t, k, o, v in mmio_trace.records()] == [ctypes.addressof(shadow_mem),
+                                                          ctypes.addressof(db_mem)]
+
+    # Back to the doorbell register only
+    ht.disable_shadow()
+    ht.set(7)
+    assert ht.value == 7
+    assert db_mem.value == 7
+    assert shadow_mem.value == 1
+
+
 def test_nvme_queues_nvme_queue():
     q_mem = (ctypes.c_uint8 * 16 * 256)()
     q_address = ctypes.addressof(q_mem)
@@ -111,6 +161,7 @@ def test_nvme_queues_q_mgr():
     q_mgr.add(SimpleNamespace(qid=1, int_vector=0), SimpleNamespace(qid=1, int_vector=0))
     assert len(q_mgr.all_cqids) == 2
     assert len(q_mgr.all_cq_vectors) == 2
+    assert [k for k, v in q_mgr.queue_pairs()] == [(0, 0), (1, 1)]
 
     q_mgr.get(0, 0)
     q_mgr.get(1, 1)
@@ -5,6 +5,7 @@ from lone.nvme.spec.registers.pcie_regs import (PCIeRegistersDirect,
                                                 pcie_reg_struct_factory,
                                                 PCIeRegisters,
                                                 PCIeAccessData)
+from lone.util.trace import mmio_trace
 
 
 def check_registers(pcie_regs):
@@ -73,6 +74,13 @@ def test_reg_access_direct():
     assert ctypes.sizeof(direct) == 4096
     check_registers(direct)
 
+    # Direct writes are traced with the full register value
+    mmio_trace.enable(num_records=8)
+    direct.CMD.BME = 1
+    mmio_trace.disable()
+    t, k, o, v = list(mmio_trace.records())[0]
+    assert o == ctypes.addressof(direct.CMD) and v == direct.CMD.BME << 2
+
 
 def test_log():
     pcie_regs = PCIeRegistersDirect()
@@ -168,6 +176,14 @@ def test_indirect_access(mocker):
 
     pcie_regs.init_capabilities()
 
+    # Write capabilities straight into the backing data, one generic and one extended
+    test_data[0x34] = 0x40
+    test_data[0x40:0x42] = [0x01, 0x00]
+    test_data[0x100:0x104] = [0x03, 0x00, 0x00, 0x00]
+    pcie_regs.init_capabilities(refresh=True)
+    assert [c._cap_id_ for c in pcie_regs.capabilities] == [0x01, 0x03]
+    assert pcie_regs.capabilities[1]._base_offset_ == 0x100
+
 
 def test_caps_direct():
     # Capabilities, TODO: Clean this up!
@@ -193,3 +209,34 @@ def test_caps_direct():
     pcie_regs.CAPS.DATA[0xC7] = 0x00
 
     pcie_regs.init_capabilities()
+
+
+def test_caps_cache():
+    pcie_regs = PCIeRegistersDirect()
+    pcie_regs.CAP.CP = 0x40
+    pcie_regs.CAPS.DATA[0x00] = 0x11
+    pcie_regs.CAPS.DATA[0x01] = 0x40 + 0x10
+    pcie_regs.CAPS.DATA[0x10] = 0x10
+    pcie_regs.CAPS.DATA[0x11] = 0x00
+
+    # Walk once, then reuse the cached layout even after the registers change
+    pcie_regs.init_capabilities(cache_key='cache_test')
+    assert [c._cap_id_ for c in pcie_regs.capabilities] == [0x11, 0x10]
+    pcie_regs.CAPS.DATA[0x11] = 0x40
+    pcie_regs.init_capabilities(cache_key='cache_test')
+    assert [c._cap_id_ for c in pcie_regs.capabilities] == [0x11, 0x10]
+
+    # Other objects with the same key use the cache too
+    other_regs = PCIeRegistersDirect()
+    other_regs.init_capabilities(cache_key='cache_test')
+    assert len(other_regs.capabilities) == 2
+
+    # Refreshing walks the lists again, this time with a loop in them
+    pcie_regs.init_capabilities(cache_key='cache_test', refresh=True)
+    assert [c._cap_id_ for c in pcie_regs.capabilities] == [0x11, 0x10]
+    assert len(pcie_regs._capability_layout) == 3
+
+    # Invalidating drops the cached layout for the key
+    PCIeRegisters.invalidate_capabilities('cache_test')
+    assert 'cache_test' not in PCIeRegisters._capability_layouts
+    PCIeRegisters.invalidate_capabilities('cache_test')
@@ -1,8 +1,9 @@
 import pytest
 import ctypes
+import mmap
 
 from lone.system import DMADirection
-from lone.nvme.spec.prp import PRP
+from lone.nvme.spec.prp import PRP, walk_prp
 
 
 def test_prp(nvme_device):
@@ -26,19 +27,84 @@ def test_prp_from_address():
     prp1_mem = (ctypes.c_uint8 * 4096)()
     prp1_address = ctypes.addressof(prp1_mem)
 
-    prp2_mem = (ctypes.c_uint8 * 4096)()
+    prp2_mem = (ctypes.c_uint64 * 512)()
     prp2_address = ctypes.addressof(prp2_mem)
-    prp2_mem[0] = 0xFF
+    for i in range(19):
+        prp2_mem[i] = 0xFF + (i * 0x1000)
 
     prp = PRP(4096, 4096)
     prp.from_address(prp1_address, prp2_address)
 
+    # Both PRP1 and PRP2 point to data
     prp = PRP(2 * 4096, 4096)
     prp.from_address(prp1_address, prp2_address)
+    assert [m.vaddr for m in prp.mem_list] == [prp1_address, prp2_address]
 
     prp = PRP(20 * 4096, 4096)
     prp.from_address(prp1_address, prp2_address)
 
+    # PRP addresses as offsets from iova_base
+    iova_base = prp1_address - 0x1000
+    prp = PRP(20 * 4096, 4096)
+    prp.from_address(0x1000, prp2_address - iova_base, iova_base)
+    assert prp.prp1_mem.vaddr == prp1_address
+    assert prp.prp2_mem.vaddr == prp2_address
+    assert len(prp.mem_list) == 21
+    assert prp.mem_list[2].iova == 0xFF
+    assert prp.mem_list[-1].vaddr == iova_base + 0xFF + (18 * 0x1000)
+
+
+def test_walk_prp():
+    mps = 4096
+    iova_base = 0x10000000
+
+    # Two list pages, the last entry of the first one points to the second one. List
+    #  entries are found by their offset into a page, so the pages have to be aligned
+    lists_mem = mmap.mmap(-1, 2 * mps)
+    lists = (ctypes.c_uint64 * 1024).from_buffer(lists_mem)
+    lists_iova = ctypes.addressof(lists) - iova_base
+    for i in range(511):
+        lists[i] = 0x100000 + (i * mps)
+    lists[511] = lists_iova + mps
+    for i in range(512):
+        lists[512 + i] = 0x800000 + (i * mps)
+
+    # Only PRP1, which may start at an offset into its page
+    assert walk_prp(0x1000, 0, 512, mps, iova_base) == [(iova_base + 0x1000, 512)]
+    assert walk_prp(0x1200, 0, 4096, mps, iova_base) == [(iova_base + 0x1200, 3584),
+                                                         (iova_base, 512)]
+
+    # PRP2 is a data page
+    assert walk_prp(0x1000, 0x3000, 2 * mps, mps) == [(0x1000, mps), (0x3000, mps)]
+
+    # PRP2 is a list, only the entries needed are used
+    segments = walk_prp(0x1000, lists_iova, 4 * mps - 8, mps, iova_base)
+    assert segments == [(iova_base + 0x1000, mps),
+                        (iova_base + 0x100000, mps),
+                        (iova_base + 0x101000, mps),
+                        (iova_base + 0x102000, mps - 8)]
+
+    # A list filling up a list page exactly uses its last entry for data, it only points
+    #  to the next list page when more than one page is left
+    segments = walk_prp(0x1000, lists_iova, 513 * mps, mps, iova_base)
+    assert len(segments) == 513
+    assert segments[-1] == (iova_base + lists[511], mps)
+    segments = walk_prp(0x1000, lists_iova, 514 * mps, mps, iova_base)
+    assert len(segments) == 514
+    assert segments[-3:] == [(iova_base + 0x100000 + (510 * mps), mps),
+                             (iova_base + 0x800000, mps),
+                             (iova_base + 0x800000 + mps, mps)]
+
+    # A list starting at an offset into its page, then chained
+    segments = walk_prp(0x1000, lists_iova + (8 * 500), 20 * mps, mps, iova_base)
+    assert [a - iova_base for a, _ in segments[:13]] == (
+        [0x1000] + [0x100000 + (i * mps) for i in range(500, 511)] + [0x800000])
+    assert len(segments) == 20
+    assert sum(length for _, length in segments) == 20 * mps
+
+    del lists
+    lists_mem.close()
+
 
 def test_prp_str(nvme_device):
     prp = PRP(4096, 4096)
@@ -76,8 +142,8 @@ def test_get_data_segments(nvme_device):
 
     prp = PRP(2 * 4096, 4096)
     prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
-    prp.get_data_segments()
+    assert prp.get_data_segments() == [prp.prp1_mem, prp.prp2_mem]
 
     prp = PRP(4 * 4096, 4096)
     prp.alloc(nvme_device, DMADirection.HOST_TO_DEVICE)
-    prp.get_data_segments()
+    assert prp.get_data_segments() == [prp.prp1_mem] + prp.mem_list[2:]
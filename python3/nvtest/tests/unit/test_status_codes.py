@@ -10,6 +10,9 @@ def test_status_codes():
     code = NVMeStatusCode(0x00, 'Test', ADMINCommand)
     assert code.failure is False
     assert code.success is True
+    assert code.sct == 1
+    assert NVMeStatusCode(0x00, 'Test').sct == 0
+    assert NVMeStatusCode(0x00, 'Test', ADMINCommand, sct=2).sct == 2
 
     # Add our code so we can test it
     status_codes.add(code)
@@ -8,6 +8,8 @@ from types import SimpleNamespace
 from lone.system.linux.requirements import LinuxRequirements
 from lone.system.linux.vfio import VfioIoctl, VfioGetApiVersion
 from lone.system.linux.vfio import SysVfioIfc, SysVfio
+from lone.util.trace import mmio_trace, TraceRing
+from lone.nvme.spec.registers.pcie_regs import PCIeRegisters
 
 
 def test_system_picker(mocker):
@@ -349,7 +351,18 @@ def test_sysvfioifc_pci_regs(mocker):
     pci_regs = ifc.pci_regs()
 
     assert pci_regs.ID.VID == 0x0000
+    mocker.patch('os.pwrite', return_value=1)
+    mmio_trace.enable(num_records=8)
     pci_regs.ID.VID = 0x1234
+    mmio_trace.disable()
+    assert list(mmio_trace.records())[0][1:] == (TraceRing.PCIE_CONFIG, 0, 0x34)
+    pci_regs.ID.VID = 0x1234
+
+    # Capabilities are found with a single bulk read of config space
+    mocker.patch('os.pread', return_value=bytes(4096))
+    pci_regs.init_capabilities(cache_key='test')
+    assert pci_regs.capabilities == []
+    os.pread.assert_called_once_with(1, 4096, 0)
 
 
 def test_sysvfioifc_nvme_regs(mocker):
@@ -377,8 +390,12 @@ def test_sysvfioifc_reset(mocker):
     ifc = SysVfioIfc('test', init=False)
     mocker.patch('fcntl.ioctl', return_value=0)
     ifc.device_fd = 1
+    PCIeRegisters._capability_layouts['test'] = []
     ifc.reset()
 
+    # Resets keep the capability layout cached for the slot
+    assert PCIeRegisters._capability_layouts.pop('test') == []
+
 
 def test_sysvfioifc_clean(mocker):
     ifc = SysVfioIfc('test', init=False)
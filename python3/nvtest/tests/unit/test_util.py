@@ -2,6 +2,7 @@ import ctypes
 from lone.util import logging
 from lone.util.hexdump import hexdump, hexdump_print
 from lone.util.struct_tools import ComparableStruct, StructFieldsIterator
+from lone.util.trace import TraceRing
 
 
 def test_hexdump(mocker):
@@ -78,3 +79,34 @@ def test_struct_field_iterator():
 
 def test_logging():
     logging
+
+
+def test_trace_ring(tmp_path):
+    trace = TraceRing()
+    trace.dump_on_cfs()
+
+    # Records come back oldest first
+    trace.enable(num_records=4, cfs_path=tmp_path / 'cfs.txt')
+    trace.record(TraceRing.DOORBELL, 0x1000, 1)
+    trace.record(TraceRing.PCIE_CONFIG, 0x04, 2)
+    records = [(k, o, v) for t, k, o, v in trace.records()]
+    assert records == [(TraceRing.DOORBELL, 0x1000, 1), (TraceRing.PCIE_CONFIG, 0x04, 2)]
+
+    # Wrap around, only the last 4 are kept
+    for i in range(6):
+        trace.record(TraceRing.DOORBELL, 0x1000, i)
+    assert [v for t, k, o, v in trace.records()] == [2, 3, 4, 5]
+
+    # Fields are recorded at their address with their full value
+    s = STest()
+    s.TEST = 0x1234
+    trace.record_field(s, 'TEST')
+    trace.record_field(s, 'NOT_A_FIELD')
+    t, k, o, v = list(trace.records())[-1]
+    assert k == TraceRing.REGISTER and o == ctypes.addressof(s) and v == 0x1234
+
+    trace.dump(tmp_path / 'dump.txt')
+    assert len((tmp_path / 'dump.txt').read_text().splitlines()) == 4
+    trace.dump_on_cfs()
+    assert (tmp_path / 'cfs.txt').exists()
+    trace.disable()
@@ -34,6 +34,9 @@ def main():
     time.sleep(0.2)
     assert nvme_device.nvme_regs.CC.EN == 0, "Device not disabled after FLR"
 
+    # The device may come back from a FLR with different capabilities, find them again
+    nvme_device.pcie_regs.init_capabilities(cache_key=args.pci_slot, refresh=True)
+
     # Re-initialize the device and get the identify data again
     nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
     nvme_device.cc_enable()
@@ -4,6 +4,7 @@ import ctypes
 
 # lone imports
 from lone.nvme.device import NVMeDevice
+from lone.nvme.spec.registers.msix import MSIXTable
 
 
 def main():
@@ -20,39 +21,10 @@ def main():
     msix_cap = [cap for cap in nvme_device.pcie_regs.capabilities if
                 cap._cap_id_ is nvme_device.pcie_regs.PCICapMSIX._cap_id_][0]
 
-    msix_tbir = msix_cap.MTAB.TBIR
-    msix_table_offset = msix_cap.MTAB.TO << 3
-    msix_table_size = msix_cap.MXC.TS + 1
-    msix_pir = msix_cap.MPBA.PBIR
-    msix_pba_offset = msix_cap.MPBA.PBAO << 3
-    msix_pba_num_qwords = msix_table_size // 64
-
-    assert msix_tbir == 0, 'Need something different for vectors NOT in BAR0/1'
-    assert msix_pir == 0, 'Need something different for vectors NOT in BAR0/1'
+    msix_table = MSIXTable(msix_cap, ctypes.addressof(nvme_device.nvme_regs))
 
     print('MSI-X MXE: 0x{:x} FM: 0x{:x}'.format(msix_cap.MXC.MXE, msix_cap.MXC.FM))
-    print('MSI-X Table Size: {} Offset: 0x{:x}'.format(msix_table_size, msix_table_offset))
-    print('MSI-X PBA Offset: 0x{:x}'.format(msix_pba_offset))
-
-    class MSIXTableEntry(ctypes.Structure):
-        _fields_ = [
-            ('ADDR_LO', ctypes.c_uint32),
-            ('ADDR_HI', ctypes.c_uint32),
-            ('DATA', ctypes.c_uint32),
-            ('V_CTRL', ctypes.c_uint32),
-        ]
-
-    msix_table = (MSIXTableEntry * msix_table_size).from_address(
-        ctypes.addressof(nvme_device.nvme_regs.CAP) + msix_table_offset)
-
-    for i, table_entry in enumerate(msix_table[:16]):
-        print('Table Entry {:04}: ADDR: 0x{:08x}{:08x} DATA: 0x{:08x}, V_CTRL: 0x{:08x}'.format(
-            i, table_entry.ADDR_HI, table_entry.ADDR_LO, table_entry.DATA, table_entry.V_CTRL))
-
-    msix_pba = (ctypes.c_uint64 * (msix_pba_num_qwords)).from_address(
-        ctypes.addressof(nvme_device.nvme_regs) + (msix_pba_offset))
-    for i, pba_entry in enumerate(msix_pba):
-        print('PBA Entry {}: 0x{:016x}'.format(i, pba_entry))
+    msix_table.log(printer=print)
 
     nvme_device.init_admin_queues(asq_entries=16, acq_entries=16)
     nvme_device.cc_enable()
@@ -61,11 +33,7 @@ def main():
     nvme_device.init_io_queues(1, 256)
 
     print('MSI-X MXE: 0x{:x} FM: 0x{:x}'.format(msix_cap.MXC.MXE, msix_cap.MXC.FM))
-    print('MSI-X Table Size: {} Offset: 0x{:x}'.format(msix_table_size, msix_table_offset))
-    print('MSI-X PBA Offset: 0x{:x}'.format(msix_pba_offset))
-    for i, table_entry in enumerate(msix_table[:16]):
-        print('Table Entry {:04}: ADDR: 0x{:08x}{:08x} DATA: 0x{:08x}, V_CTRL: 0x{:08x}'.format(
-            i, table_entry.ADDR_HI, table_entry.ADDR_LO, table_entry.DATA, table_entry.V_CTRL))
+    msix_table.log(printer=print)
 
     from lone.nvme.spec.commands.nvm.read import Read
     from lone.nvme.spec.prp import PRP